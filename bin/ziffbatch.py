@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+# ================ #
+#                  #
+#   MAIN           #
+#                  #
+# ================ #
+if  __name__ == "__main__":
+
+    import argparse
+    from ziff import __version__
+    from ziff.scripts import batch
+    
+    parser = argparse.ArgumentParser(
+        description=""" Run ziffit (download, psf, shapes) on the given files using a local process pool.
+The stage status of each file is stored in the manifest: re-running the same command
+skips the completed stages and retries the failed ones. see ziff.scripts.batch """,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    # On what file
+    parser.add_argument('infile', type=str, nargs="*",
+                        help='ztf filenames (or text files listing them, one per line, with --fromfile)')
+
+    parser.add_argument('--fromfile', action="store_true", default=False,
+                        help='infile are text files listing the ztf filenames.')
+
+    parser.add_argument('--manifest', type=str, default="ziffbatch_manifest.sqlite",
+                        help='sqlite manifest storing the stage status of each file.')
+
+    #
+    # - Pool options
+    #
+    parser.add_argument('--nworkers', type=int, default=None,
+                        help='number of worker processes (number of cpus by default).')
+
+    parser.add_argument('--maxmemory', type=float, default=None,
+                        help='memory limit of each worker (GB).')
+
+    parser.add_argument('--maxtasksperchild', type=int, default=None,
+                        help='restart the worker processes after this number of files.')
+
+    parser.add_argument('--stages', type=str, nargs="*", default=batch.STAGES,
+                        help=f'stages to run, within {batch.STAGES}.')
+
+    parser.add_argument('--noretry', action="store_true", default=False,
+                        help='do not retry the failed stages.')
+
+    parser.add_argument('--force', action="store_true", default=False,
+                        help='re-run all the stages, even those already done.')
+
+    #
+    # - PSF options
+    #
+    parser.add_argument('--interporder', type=int, default=3,
+                        help='Order of the PSF spatial Interpolation.')
+
+    parser.add_argument('--nstars', type=int, default=800,
+                        help='Maximum number of stars used to fit the PSF.')
+
+    parser.add_argument('--maxoutliers', type=int, default=None,
+                        help='Maximum number of outliers removed during the fit.')
+
+    parser.add_argument('--stampsize', type=int, default=15,
+                        help='Size of the star stamps.')
+
+    #
+    # = ending
+    args = parser.parse_args()
+
+    print("\nINFORMATION\n".center(80,'-'))
+    print(f"* ziff version {__version__}")
+
+    if args.fromfile:
+        files = [l_.strip() for f_ in args.infile for l_ in open(f_).read().splitlines()
+                     if len(l_.strip())>0]
+    else:
+        files = args.infile
+    print(f"* {len(files)} files requested, manifest: {args.manifest}")
+
+    ziffbatch = batch.ZiffitBatch(args.manifest, nworkers=args.nworkers, maxmemory=args.maxmemory,
+                                  maxtasksperchild=args.maxtasksperchild, stages=args.stages,
+                                  ziffitprop=dict(interporder=args.interporder, nstars=args.nstars,
+                                                  maxoutliers=args.maxoutliers, stamp_size=args.stampsize))
+
+    print("\nPROCESSING\n".center(80,'-'))
+    status = ziffbatch.run(files, retry=not args.noretry, force=args.force)
+
+    print("\nSUMMARY\n".center(80,'-'))
+    print(status.groupby(["stage","status"]).size().unstack(fill_value=0) if len(status)>0 else "nothing processed")
+    print("\nZIFFBATCH END\n".center(80,'-'))
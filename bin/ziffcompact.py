@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+# ================ #
+#                  #
+#   MAIN           #
+#                  #
+# ================ #
+if  __name__ == "__main__":
+
+    import argparse
+    from ziff import container, __version__
+    
+    parser = argparse.ArgumentParser(
+        description=""" Pack the per-quadrant ziff outputs (psfshape, psfcat, shapecat, piff, json)
+in night (or exposure) containers, see ziff.container """,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    # On what file
+    parser.add_argument('infile', type=str, nargs="*",
+                        help='files or directories to compact')
+
+    #
+    # - Options
+    #
+    parser.add_argument('--grouping', type=str, default="night",
+                        help='night or exposure containers.')
+
+    parser.add_argument('--pattern', type=str, default="ztf_*",
+                        help='pattern of the files to compact in the given directories.')
+    
+    parser.add_argument('--containerdir', type=str, default=None,
+                        help='root directory of the containers (see container.get_container_rootdir).')
+
+    parser.add_argument('--remove', action="store_true", default=False,
+                        help='remove the original files once stored in their container.')
+
+    #
+    # = ending
+    args = parser.parse_args()
+
+    print("\nINFORMATION\n".center(80,'-'))
+    print(f"* ziff version {__version__}")
+
+    import os
+    files = [f_ for f_ in args.infile if not os.path.isdir(f_)]
+    directories = [f_ for f_ in args.infile if os.path.isdir(f_)]
+    print(f"* {len(files)} files and {len(directories)} directories requested")
+
+    updated = container.compact_files(files, grouping=args.grouping, dirpath=args.containerdir,
+                                      remove=args.remove)
+    for directory in directories:
+        updated += container.compact_directory(directory, pattern=args.pattern, grouping=args.grouping,
+                                               dirpath=args.containerdir, remove=args.remove)
+
+    print(f"* {len(np.unique(updated))} containers updated")
+    print("\nZIFFCOMPACT END\n".center(80,'-'))
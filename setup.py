@@ -27,7 +27,7 @@ setup(name='ziff',
       url='https://github.com/MickaelRigault/Ziff',
       packages=packages,
       package_data={'ziff': ['data/*']},
-      scripts=["bin/ziffit.py","bin/qsub_ziffit.sh"]
+      scripts=["bin/ziffit.py","bin/ziffcompact.py","bin/ziffbatch.py","bin/qsub_ziffit.sh"]
     #['ziff/scripts/run_ccd.py','ziff/scripts/download_query.py','ziff/scripts/download_target.py']
      )
 # End of setupy.py ========================================================
@@ -0,0 +1,37 @@
+""" process-level object cache """
+
+import time
+import threading
+import numpy as np
+
+from ziff.cache import ObjectCache
+
+
+def test_get_or_load_once():
+    """ concurrent requests of the same key load the object once """
+    cache = ObjectCache(maxbytes=1e6)
+    nloads = []
+    def loader(value):
+        nloads.append(value)
+        time.sleep(0.05)
+        return np.full(10, value)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("key", loader, 1.)))
+               for _ in range(8)]
+    _ = [t_.start() for t_ in threads]
+    _ = [t_.join() for t_ in threads]
+    assert len(nloads) == 1
+    assert len(results) == 8 and all(r_ is results[0] for r_ in results)
+    assert cache.stats["misses"] == 1 and cache.stats["hits"] == 7
+
+def test_eviction():
+    """ least recently used entries are dropped beyond the byte budget """
+    cache = ObjectCache(maxbytes=200)
+    cache.set("a", np.zeros(10)) # 80 bytes
+    cache.set("b", np.zeros(10))
+    _ = cache.get("a")
+    cache.set("c", np.zeros(10))
+    assert cache.has("a") and cache.has("c") and not cache.has("b")
+    cache.set("big", np.zeros(100))
+    assert not cache.has("big") and cache.nbytes <= 200
@@ -0,0 +1,169 @@
+""" ziff catalogs """
+
+import numpy as np
+import pandas
+import pytest
+from astropy.io import fits
+
+from ziff.catalog import Catalog
+
+
+def make_catalog(size=6):
+    """ """
+    rng = np.random.default_rng(1)
+    return Catalog(pandas.DataFrame({"xpos": rng.uniform(10, 100, size), "ypos": rng.uniform(10, 100, size),
+                                     "gmag": np.linspace(14.25, 17.75, size)}), name="gaia")
+
+def test_filter_missing_values():
+    """ missing values (pd.NA after convert_dtypes) are not rejected """
+    data = make_catalog().data[["xpos", "ypos", "gmag"]]
+    data.loc[data.index[1], "gmag"] = np.nan
+    cat = Catalog(data, name="gaia")
+    cat.add_filter("gmag", [10, 16], name="gmag_range")
+    expected = data["gmag"].to_numpy(dtype=float, na_value=np.nan) > 16
+    assert expected.sum() == 3
+    np.testing.assert_array_equal(cat.filterout, expected)
+
+def test_fits_without_filterbits(tmp_path):
+    """ filterbits are not written to fits files """
+    cat = make_catalog()
+    cat.add_filter("gmag", [10, 16], name="gmag_range")
+    cat.to_fits(str(tmp_path / "cat.fits"), filtered=False)
+    names = fits.getdata(str(tmp_path / "cat.fits"), 1).columns.names
+    assert "filterbits" not in names and "gmag" in names
+
+@pytest.mark.parametrize("kwargs", [{}, {"filtered": True}, {"filtered": True, "xyformat": "fortran"}])
+def test_view_as_copy(kwargs):
+    """ views have the data (columns and dtypes) of get_catalog() copies """
+    cat = make_catalog()
+    cat.data["masked"] = False
+    cat.add_filter("gmag", [10, 16], name="gmag_range")
+    copied, view = cat.get_catalog(**kwargs), cat.get_catalog(asview=True, **kwargs)
+    pandas.testing.assert_frame_equal(view.get_data(), copied.data)
+    pandas.testing.assert_frame_equal(view.data, copied.data)
+
+def test_view_isolation():
+    """ changes of the parent after the view is taken are not seen by the view, and conversely """
+    cat = make_catalog()
+    view = cat.get_view(xyformat="fortran")
+    subview = view.get_view(filtered=True)
+    gmag = cat.data["gmag"].to_numpy(dtype=float)
+    cat.data["gmag"] = 99.
+    cat.add_filter("gmag", [10, 16], name="gmag_range")
+    for view_ in [view, subview]:
+        np.testing.assert_array_equal(view_.get_data()["gmag"].to_numpy(dtype=float), gmag)
+        assert not np.any(view_.filterout)
+
+    view.data["gmag"] = 0.
+    assert np.all(cat.data["gmag"] == 99.)
+
+def make_radec_catalog(size=300, seed=2):
+    """ """
+    rng = np.random.default_rng(seed)
+    return Catalog(pandas.DataFrame({"ra": rng.uniform(150.01, 150.21, size),
+                                     "dec": rng.uniform(2.01, 2.21, size),
+                                     "xpos": rng.uniform(10, 3000, size), "ypos": rng.uniform(10, 3000, size),
+                                     "gmag": rng.uniform(14.1, 17.9, size)}), name="gaia")
+
+def test_match_vs_astropy():
+    """ Catalog.match gives the pairs of SkyCoord.search_around_sky """
+    from astropy import units
+    from astropy.coordinates import SkyCoord
+    cat, refcat = make_radec_catalog(seed=2), make_radec_catalog(size=3000, seed=3)
+    idx, ref_idx = cat.match(refcat, seplimit=20*units.arcsec)
+    idx_ref, ref_idx_ref, _, _ = SkyCoord(cat.data["ra"], cat.data["dec"], unit="deg").search_around_sky(
+                                SkyCoord(refcat.data["ra"], refcat.data["dec"], unit="deg"), 20*units.arcsec)
+    assert len(idx) > 10
+    assert sorted(zip(idx, ref_idx)) == sorted(zip(ref_idx_ref, idx_ref))
+
+def test_match_xy():
+    """ match_xy finds the catalog entries at the given positions """
+    cat = make_radec_catalog()
+    rows = np.asarray([4, 50, 7])
+    xpos = cat.data["xpos"].to_numpy(dtype=float)[rows] + 0.05
+    ypos = cat.data["ypos"].to_numpy(dtype=float)[rows] - 0.05
+    input_idx, cat_idx = cat.match_xy(np.append(xpos, -100), np.append(ypos, -100), seplimit=0.2)
+    np.testing.assert_array_equal(input_idx, [0, 1, 2])
+    np.testing.assert_array_equal(cat_idx, rows)
+
+def test_spatialindex_version():
+    """ the spatial index is kept until the coordinates or the filters change """
+    cat = make_radec_catalog()
+    tree = cat.get_spatialindex("xy")
+    assert cat.get_spatialindex("xy") is tree
+    assert cat.get_spatialindex("xy", filtered=True) is not tree
+
+    cat.add_filter("gmag", [10, 16], name="gmag_range")
+    tree_filtered = cat.get_spatialindex("xy", filtered=True)
+    assert tree_filtered.n == np.sum(~cat.filterout) < len(cat.data)
+    assert cat.get_spatialindex("xy") is not tree
+
+    cat.data["xpos"] = cat.data["xpos"] + 1 # by hand
+    cat.touch_data()
+    np.testing.assert_allclose(cat.get_spatialindex("xy").data[:,0], cat.data["xpos"].to_numpy(dtype=float))
+
+def test_deferred_enrichment():
+    """ deferred columns are those of the direct computations for the candidates,
+    placeholders for the others """
+    rng = np.random.default_rng(4)
+    size = 60
+    data = pandas.DataFrame({"ra": rng.uniform(150.01, 150.03, size), "dec": rng.uniform(2.01, 2.03, size),
+                             "xpos": rng.uniform(10, 190, size), "ypos": rng.uniform(10, 190, size),
+                             "gmag": rng.uniform(14.1, 17.9, size)})
+    bkgd = rng.normal(100, 3, (200, 200))
+    maskimg = rng.uniform(size=(200, 200)) < 0.002
+    cat, cat_ref = [Catalog(data, name="gaia", xyformat="numpy") for _ in range(2)]
+    for cat_ in [cat, cat_ref]:
+        cat_.add_filter("gmag", [10, 16.5], name="gmag_range")
+    cat.add_deferred("sky", "build_sky_from_bkgdimg", bkgdimg=bkgd, stampsize=15)
+    cat.add_deferred("mask", "build_mask_from_maskimg", maskimg=maskimg, stampsize=15,
+                     filters=[["masked", [-0.5, 0.5], "not_masked"]])
+    cat.add_deferred("isolation", "measure_isolation", seplimit=8)
+    candidates = ~cat.filterout
+    cat.compute_deferred()
+    assert len(cat.deferred) == 0
+
+    cat_ref.build_sky_from_bkgdimg(bkgd, 15)
+    cat_ref.build_mask_from_maskimg(maskimg, 15)
+    cat_ref.measure_isolation(seplimit=8)
+    np.testing.assert_allclose(cat.data["sky"][candidates], cat_ref.data["sky"][candidates])
+    np.testing.assert_array_equal(cat.data["masked"][candidates], cat_ref.data["masked"][candidates])
+    # isolation only measured for the not masked candidates (still against the full catalog)
+    isolation = candidates & ~np.asarray(cat_ref.data["masked"], dtype=bool)
+    assert 0 < isolation.sum() < candidates.sum()
+    np.testing.assert_array_equal(cat.data["n_nearsources"][isolation], cat_ref.data["n_nearsources"][isolation])
+
+    assert np.all(np.isnan(cat.data["sky"][~candidates].to_numpy(dtype=float)))
+    assert np.all(cat.data["masked"][~candidates])
+    assert np.all(cat.data["n_nearsources"][~isolation] == -1) and not np.any(cat.data["is_isolated"][~isolation])
+    np.testing.assert_array_equal(cat.filterout, ~isolation)
+
+@pytest.mark.parametrize("fmt", ["parquet", "feather"])
+def test_arrow_roundtrip(tmp_path, fmt):
+    """ data (dtypes and index), name, xyformat, filters and header survive the arrow files """
+    cat = make_catalog()
+    cat.data.index = pandas.Index(np.arange(len(cat.data))*3 + 100, name="sourceid")
+    cat.data["label"] = [f"star{i}" for i in range(len(cat.data))]
+    cat.data["masked"] = np.arange(len(cat.data)) % 2 == 0
+    cat.set_header({"CCDID": 7, "FILTER": "ztfg"})
+    cat._xyformat = "fortran"
+    cat.add_filter("gmag", [10, 16], name="gmag_range")
+    filename = str(tmp_path / f"cat.{fmt}")
+    cat.write_to(filename, filtered=False)
+
+    cat_read = getattr(Catalog, f"read_{fmt}")(filename)
+    pandas.testing.assert_frame_equal(cat_read.data, cat.data, check_dtype=False)
+    # dtypes as any catalog built from the data (set_data's convert_dtypes)
+    pandas.testing.assert_series_equal(cat_read.data.dtypes, Catalog(cat.data).data.dtypes)
+    assert cat_read.name == "gaia" and cat_read.xyformat == "fortran"
+    assert cat_read.filters == cat.filters
+    assert cat_read.header["CCDID"] == 7 and cat_read.header["FILTER"] == "ztfg"
+    np.testing.assert_array_equal(cat_read.filterout, cat.filterout)
+
+    # filters stay usable
+    cat_read.add_filter("gmag", [10, 15], name="gmag_range")
+    cat.add_filter("gmag", [10, 15], name="gmag_range")
+    np.testing.assert_array_equal(cat_read.filterout, cat.filterout)
+
+    columns = getattr(Catalog, f"read_{fmt}")(filename, columns=["xpos", "gmag"]).data.columns
+    assert {"xpos", "gmag"} <= set(columns) and "label" not in columns
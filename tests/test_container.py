@@ -0,0 +1,81 @@
+""" night/exposure containers of the quadrant output files """
+
+import os
+import json
+import numpy as np
+import pandas
+import piff
+import pytest
+
+from ziff import container
+from ziff.catalog import Catalog
+
+from test_pixelgridconvol import fit_psf
+
+
+PREFIXES = ["ztf_20190301123456_000600_zg_c01_o_q1_", "ztf_20190301123456_000600_zg_c01_o_q2_"]
+
+@pytest.fixture(scope="module")
+def psf():
+    """ """
+    return fit_psf(piff.PixelGrid(scale=1.0, size=17), 0, nstars=10)
+
+def write_outputs(dirpath, prefix, psf, seed=0):
+    """ psfshape, psfcat_gaia, piff and piff_config files of a quadrant """
+    rng = np.random.default_rng(seed)
+    shapes = pandas.DataFrame({"sigma_data": rng.uniform(1, 2, 30), "flag_data": rng.integers(0, 2, 30)},
+                              index=pandas.Index(rng.integers(0, 1e9, 30), name="Source"))
+    cat = Catalog(pandas.DataFrame({"xpos": rng.uniform(1, 100, 20), "gmag": rng.uniform(14.1, 17.9, 20),
+                                    "masked": False},
+                                   index=pandas.Index(np.arange(20)*7 + seed, name="Source")), name="gaia")
+    files = {k: os.path.join(dirpath, prefix + k) for k in ["psfshape.parquet", "psfcat_gaia.fits",
+                                                            "psf_PixelGrid_BasisPolynomial0.piff",
+                                                            "piff_config.json"]}
+    shapes.to_parquet(files["psfshape.parquet"])
+    cat.to_fits(files["psfcat_gaia.fits"], header=None, filtered=False, store_filename=False)
+    psf.write(files["psf_PixelGrid_BasisPolynomial0.piff"])
+    with open(files["piff_config.json"], "w") as f_:
+        json.dump({"seed": seed}, f_)
+    return files
+
+def test_compact_and_read(tmp_path, psf):
+    """ compacted files are read back as the original ones """
+    os.makedirs(tmp_path / "sci")
+    files = [write_outputs(str(tmp_path / "sci"), p_, psf, seed=i) for i, p_ in enumerate(PREFIXES)]
+    rootdir = str(tmp_path / "containers")
+    updated = container.compact_files([f_ for files_ in files for f_ in files_.values()], dirpath=rootdir)
+    assert updated == [os.path.join(rootdir, "2019", "0301")]
+
+    for files_ in files:
+        container_ = container.get_file_container(files_["psfshape.parquet"], dirpath=rootdir)
+        pandas.testing.assert_frame_equal(container_.read_table(files_["psfshape.parquet"]),
+                                          pandas.read_parquet(files_["psfshape.parquet"]))
+        pandas.testing.assert_frame_equal(container_.read_table(files_["psfshape.parquet"], columns=["sigma_data"]),
+                                          pandas.read_parquet(files_["psfshape.parquet"], columns=["sigma_data"]))
+
+        cat, cat_ref = container_.read_catalog(files_["psfcat_gaia.fits"]), Catalog.read_fits(files_["psfcat_gaia.fits"])
+        pandas.testing.assert_frame_equal(cat.data, cat_ref.data)
+        assert cat.header.tostring() == cat_ref.header.tostring()
+
+        image = container_.read_psf(files_["psf_PixelGrid_BasisPolynomial0.piff"]).draw(x=50., y=60., stamp_size=17)
+        np.testing.assert_array_equal(image.array, psf.draw(x=50., y=60., stamp_size=17).array)
+        assert container_.read_json(files_["piff_config.json"]) == json.load(open(files_["piff_config.json"]))
+
+def test_memoized_containers(tmp_path, psf):
+    """ containers (and their index) are memoized per directory, and updated by add_files """
+    os.makedirs(tmp_path / "sci")
+    rootdir = str(tmp_path / "containers")
+    files = [write_outputs(str(tmp_path / "sci"), p_, psf, seed=i) for i, p_ in enumerate(PREFIXES)]
+    container.compact_files(list(files[0].values()), dirpath=rootdir)
+    container_ = container.get_file_container(files[0]["psfshape.parquet"], dirpath=rootdir)
+    assert container.get_file_container(files[0]["psfcat_gaia.fits"], dirpath=rootdir) is container_
+    assert container.get_file_container(files[1]["psfshape.parquet"], dirpath=rootdir) is None
+
+    # another Container of the directory adds files: the memoized one is replaced
+    container.Container(container_.dirpath).add_files(list(files[1].values()))
+    container_new = container.get_file_container(files[1]["psfshape.parquet"], dirpath=rootdir)
+    assert container_new is not None and container_new.has_file(files[0]["psfshape.parquet"])
+    assert container.get_container(container_.dirpath) is container_new
+
+    container.clear_containers()
+    assert container.get_container(container_.dirpath) is not container_new
@@ -0,0 +1,65 @@
+""" image product (data, mask) cache of the ziff image holders """
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from ztfimg import image as ztfimage
+
+from ziff.base import _ZIFFImageHolder_
+
+
+@pytest.fixture
+def holder(tmp_path):
+    """ image holder of a single science image (64x80 float32, int16 mask) """
+    rng = np.random.default_rng(0)
+    data = rng.normal(100, 3, (64, 80)).astype("float32")
+    mask = (np.arange(data.size).reshape(data.shape) % 7 == 0).astype("int16")
+    fits.writeto(str(tmp_path / "image.fits"), data)
+    fits.writeto(str(tmp_path / "mask.fits"), mask)
+    holder = _ZIFFImageHolder_()
+    holder.set_images([ztfimage.ScienceImage(str(tmp_path / "image.fits"), str(tmp_path / "mask.fits"))])
+    return holder, data, mask.astype(bool)
+
+def get_nbytes(holder):
+    """ recomputed memory size of the cached products """
+    return sum(v_.nbytes for v_ in holder._imagecache.values())
+
+def test_cached_readonly(holder):
+    """ products are computed once, stored as read-only arrays of the cache dtype """
+    holder, data, mask = holder
+    holder.set_imagecache(dtype="float64")
+    masked = holder.get_data(rmbkgd=False)
+    assert holder.get_data(rmbkgd=False) is masked and holder.get_mask() is holder.get_mask()
+    assert masked.dtype == "float64" and not masked.flags.writeable
+    with pytest.raises(ValueError):
+        masked[0, 0] = 0
+    np.testing.assert_array_equal(masked, np.where(mask, np.nan, data))
+    np.testing.assert_array_equal(holder.get_mask(), mask)
+    assert set(holder._imagecache) == {("mask",), ("data", True, "nan", False, "default")}
+    assert holder.imagecache_nbytes == get_nbytes(holder) == data.size * (8 + 1)
+
+    holder.set_imagecache(enabled=False)
+    assert holder.get_data(rmbkgd=False) is not holder.get_data(rmbkgd=False)
+    assert holder.imagecache_nbytes == 0 and len(holder._imagecache) == 0
+
+def test_eviction_and_clear(holder):
+    """ the running imagecache_nbytes follows evictions and clears """
+    holder, data, _ = holder
+    holder.set_imagecache(maxbytes=data.size * 4 * 2.5, dtype="float32")
+    _ = holder.get_data(rmbkgd=False, maskvalue=0)
+    _ = holder.get_data(rmbkgd=False, maskvalue=-1) # mask (1 byte/pixel) and 2 float32 data
+    assert len(holder._imagecache) == 3 and holder.imagecache_nbytes == get_nbytes(holder)
+    _ = holder.get_data(rmbkgd=False, maskvalue=-2) # least recently used (maskvalue=0) dropped
+    assert set(holder._imagecache) == {("mask",), ("data", True, "-1", False, "default"),
+                                       ("data", True, "-2", False, "default")}
+    assert holder.imagecache_nbytes == get_nbytes(holder) == data.size * (4 * 2 + 1)
+
+    _ = holder.get_mask()
+    holder.clear_imagecache("mask") # also drops the data built on it
+    assert len(holder._imagecache) == 0 and holder.imagecache_nbytes == 0
+
+    holder.set_imagecache(maxbytes=data.size * 2)
+    _ = holder.get_data(applymask=False, rmbkgd=False) # memory mapped, not counted
+    assert len(holder._imagecache) == 1 and holder.imagecache_nbytes == 0
+    _ = holder.get_data(rmbkgd=False) # larger than the budget, not kept
+    assert len(holder._imagecache) == 0 and holder.imagecache_nbytes == 0
@@ -0,0 +1,86 @@
+""" lazily loaded (memory mapped or per-tile decoded) images """
+
+import mmap
+import numpy as np
+import galsim
+import pytest
+from astropy.io import fits
+from ztfimg import image as ztfimage
+
+from ziff.lazyimage import LazyFitsArray, LazyScienceImage
+from ziff.star import build_piffstars
+
+
+def is_memmapped(array):
+    """ """
+    while isinstance(array, np.ndarray):
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+@pytest.fixture
+def imagefiles(tmp_path):
+    """ uncompressed and tile-compressed (lossless) images and a mask """
+    rng = np.random.default_rng(0)
+    data = rng.normal(100, 5, (64, 80)).astype("float32")
+    for x, y in [(20.3, 30.8), (50.6, 12.1), (61.2, 44.7)]:
+        image = galsim.ImageF(80, 64)
+        galsim.Gaussian(sigma=2., flux=1e4).drawImage(image, center=galsim.PositionD(x, y))
+        data += image.array
+    mask = (np.arange(data.size).reshape(data.shape) % 7 == 0).astype("int16")
+    files = {k: str(tmp_path / f"{k}.fits") for k in ["image", "compressed", "mask"]}
+    fits.writeto(files["image"], data)
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(data, compression_type="GZIP_1", quantize_level=0.0,
+                                    tile_shape=(16, 16))]).writeto(files["compressed"])
+    fits.writeto(files["mask"], mask)
+    return files, data, mask
+
+@pytest.mark.parametrize("which", ["image", "compressed"])
+def test_lazyfitsarray(imagefiles, which):
+    """ sections and full arrays of LazyFitsArray match the data """
+    files, data, _ = imagefiles
+    lazy = LazyFitsArray(files[which])
+    assert lazy.shape == data.shape and lazy.is_compressed() == (which == "compressed")
+    np.testing.assert_array_equal(lazy[3:9, 4:20], data[3:9, 4:20])
+    assert lazy.is_loaded() == (which == "image") # sections of compressed files only decode tiles
+    np.testing.assert_array_equal(np.asarray(lazy), data)
+    assert lazy.is_loaded() and is_memmapped(lazy.array) == (which == "image")
+    lazy.close()
+    assert not lazy.is_open() and not lazy.is_loaded()
+
+def test_lazyscienceimage(imagefiles):
+    """ LazyScienceImage gives the data and mask of ScienceImage """
+    files, data, mask = imagefiles
+    lazy = LazyScienceImage(files["image"], files["mask"])
+    eager = ztfimage.ScienceImage(files["image"], files["mask"])
+    assert lazy.shape == eager.shape
+    np.testing.assert_array_equal(lazy.data, eager.data)
+    np.testing.assert_array_equal(lazy.mask, eager.mask)
+    assert is_memmapped(lazy.data)
+    lazy.close()
+
+@pytest.mark.parametrize("which", ["image", "compressed"])
+def test_build_piffstars_lazy(imagefiles, which):
+    """ stars built from lazy images are those from the loaded data """
+    files, data, _ = imagefiles
+    kwargs = dict(xpos=[20.3, 50.6, 61.2], ypos=[30.8, 12.1, 44.7], wcs=galsim.PixelScale(1.),
+                  stamp_size=15, sky=100., gain=5.)
+    stars = build_piffstars(data, **kwargs)
+    stars_lazy = build_piffstars(LazyFitsArray(files[which]), **kwargs)
+    assert len(stars) == len(stars_lazy) == 3
+    for star, star_lazy in zip(stars, stars_lazy):
+        np.testing.assert_array_equal(star_lazy.image.array, star.image.array)
+        np.testing.assert_array_equal(star_lazy.weight.array, star.weight.array)
+        assert star_lazy.image.bounds == star.image.bounds
+        assert star_lazy.data.properties == star.data.properties
+
+def test_rawdata_not_copied(imagefiles):
+    """ the raw data of lazy images are not copied, even with a cache dtype """
+    from ziff.base import _ZIFFImageHolder_
+    files, data, _ = imagefiles
+    holder = _ZIFFImageHolder_()
+    holder.set_images([LazyScienceImage(files["image"], files["mask"])])
+    holder.set_imagecache(dtype="float32")
+    rawdata = holder.get_data(applymask=False, rmbkgd=False)
+    np.testing.assert_array_equal(rawdata, data)
+    assert is_memmapped(rawdata)
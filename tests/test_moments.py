@@ -0,0 +1,58 @@
+""" adaptive moments against galsim's HSM """
+
+import numpy as np
+import galsim
+import piff
+
+from ziff.moments import get_moments
+from ziff.star import get_stars_hsm
+
+
+def make_stamps(nstars=20, size=25, seed=3):
+    """ sheared gaussian stamps with noise, the last one is empty (failed fit) """
+    rng = np.random.default_rng(seed)
+    stamps = []
+    for i in range(nstars):
+        image = galsim.ImageD(size, size)
+        galsim.Gaussian(sigma=rng.uniform(1.5, 3), flux=1e4).shear(g1=rng.uniform(-0.2, 0.2),
+                                                                    g2=rng.uniform(-0.2, 0.2)
+                      ).drawImage(image, offset=rng.uniform(-1, 1, 2))
+        stamps.append(image.array + rng.normal(0, 1, (size, size)))
+    stamps.append(np.zeros((size, size)))
+    return np.asarray(stamps)
+
+def test_moments_vs_hsm():
+    """ the vectorized engine reproduces galsim.hsm.FindAdaptiveMom, failures are NaN """
+    stamps = make_stamps()
+    moments = get_moments(stamps, engine="numpy")
+    for i, stamp in enumerate(stamps):
+        mom = galsim.Image(stamp, xmin=0, ymin=0).FindAdaptiveMom(strict=False)
+        if mom.moments_status != 0:
+            assert i == len(stamps)-1 and moments["flag"][i] != 0
+            assert np.all(np.isnan([moments[k][i] for k in ["amp", "x", "sigma", "g1", "g2"]]))
+            continue
+        assert moments["flag"][i] == 0
+        np.testing.assert_allclose([moments["amp"][i], moments["sigma"][i]],
+                                   [mom.moments_amp, mom.moments_sigma], rtol=1e-6)
+        np.testing.assert_allclose([moments["x"][i], moments["y"][i],
+                                    moments["g1"][i], moments["g2"][i]],
+                                   [mom.moments_centroid.x, mom.moments_centroid.y,
+                                    mom.observed_shape.g1, mom.observed_shape.g2], atol=1e-6)
+    
+    hsm = get_moments(stamps, engine="hsm")
+    for k in ["amp", "x", "y", "sigma", "g1", "g2", "flag"]:
+        np.testing.assert_allclose(moments[k], hsm[k], rtol=1e-6, atol=1e-6)
+
+def test_stars_hsm_engines():
+    """ get_stars_hsm gives the same measurements (NaN for failures) with both engines """
+    wcs = galsim.JacobianWCS(0.26, 0.01, -0.02, 0.25)
+    stars = []
+    for stamp in make_stamps(nstars=5):
+        target = piff.Star.makeTarget(x=100, y=100, wcs=wcs, stamp_size=stamp.shape[0])
+        target.image.array[:] = stamp
+        stars.append(target)
+    
+    hsm_numpy = get_stars_hsm(stars, engine="numpy")
+    hsm_galsim = get_stars_hsm(stars, engine="hsm")
+    assert np.all(np.isnan(hsm_galsim[-1, :6])) and np.all(np.isnan(hsm_numpy[-1, :6]))
+    np.testing.assert_allclose(hsm_numpy[:-1], hsm_galsim[:-1], rtol=1e-5, atol=1e-6)
@@ -0,0 +1,142 @@
+""" ConvolvedPixelGrid fits of simulated stars """
+
+import numpy as np
+import galsim
+import piff
+import pytest
+
+from ziff.models.pixelgridconvol import ConvolvedPixelGrid
+
+
+def make_stars(nstars=40, size=17, noise=1., seed=1):
+    """ gaussian stars whose width varies with x, on a 1 arcsec/pixel grid """
+    rng = np.random.default_rng(seed)
+    wcs = galsim.PixelScale(1.0)
+    stars = []
+    for x, y in rng.uniform(20, 1000, (nstars, 2)):
+        target = piff.Star.makeTarget(x=x, y=y, wcs=wcs, stamp_size=size)
+        image = target.image.copy()
+        galsim.Gaussian(sigma=1.5 + 0.3*x/1000, flux=rng.uniform(5e3, 5e4)
+                        ).drawImage(image, center=target.image_pos)
+        image.array[:] += rng.normal(0, noise, image.array.shape)
+        weight = galsim.ImageF(image.bounds, init_value=1/noise**2, wcs=image.wcs)
+        stars.append(piff.Star(piff.StarData(image, target.image_pos, weight=weight), None))
+    return stars, wcs
+
+def fit_psf(model, order, **kwargs):
+    """ """
+    stars, wcs = make_stars(**kwargs)
+    psf = piff.SimplePSF(model, piff.BasisPolynomial(order=order))
+    psf.fit(stars, {0:wcs}, None)
+    return psf
+
+
+@pytest.mark.parametrize("order", [1, 2])
+def test_fit_interpolated(order):
+    """ the convolution width must not diverge when interpolated (order>=1) """
+    psf_ref = fit_psf(piff.PixelGrid(scale=1.0, size=17), order)
+    psf = fit_psf(ConvolvedPixelGrid(scale=1.0, size=17), order)
+
+    sigmas = np.asarray([star.fit.params[-1] for star in psf.stars])
+    assert np.all(np.isfinite(sigmas))
+    assert np.all((sigmas > 0) & (sigmas < 2))
+    assert psf.chisq < 1.1 * psf_ref.chisq
+
+def test_write_read_kwargs(tmp_path):
+    """ the convolution options are kept by written PSFs """
+    model = ConvolvedPixelGrid(scale=1.0, size=17, sigma_convol_start=0.3, sigma_convol_damping=1e-2)
+    psf = fit_psf(model, 1, nstars=20)
+    psf.write(str(tmp_path / "psf.piff"))
+    model_read = piff.PSF.read(str(tmp_path / "psf.piff")).model
+    assert model_read.sigma_convol_start == 0.3
+    assert model_read.sigma_convol_damping == 1e-2
+
+def test_sparse_design_matrix():
+    """ sparse=True gives the same normal equations and fit as the dense matrix """
+    stars, _ = make_stars(nstars=2)
+    model, model_sparse = [ConvolvedPixelGrid(scale=1.0, size=17, sparse=sparse_)
+                           for sparse_ in [False, True]]
+    star = model.initialize(stars[0])
+    fit, fit_sparse = model.chisq(star).fit, model_sparse.chisq(star).fit
+    np.testing.assert_allclose(fit_sparse.A.toarray(), fit.A, atol=1e-10*np.abs(fit.A).max())
+    np.testing.assert_allclose(fit_sparse.alpha, fit.alpha, atol=1e-10*np.abs(fit.alpha).max())
+    np.testing.assert_allclose(fit_sparse.beta, fit.beta, atol=1e-10*np.abs(fit.beta).max())
+
+    psf = fit_psf(ConvolvedPixelGrid(scale=1.0, size=17), 1, nstars=20)
+    psf_sparse = fit_psf(ConvolvedPixelGrid(scale=1.0, size=17, sparse=True), 1, nstars=20)
+    assert psf_sparse.chisq == pytest.approx(psf.chisq, rel=1e-6)
+
+def test_sparse_unsupported():
+    """ sparse=True is rejected where piff uses the dense design matrix """
+    from ziff.models.pixelgridconvol import check_sparse_interp
+    model = ConvolvedPixelGrid(scale=1.0, size=17, sparse=True)
+    check_sparse_interp(model, piff.BasisPolynomial(order=1))
+    with pytest.raises(NotImplementedError):
+        check_sparse_interp(model, piff.BasisPolynomial(order=1, use_qr=True))
+    with pytest.raises(NotImplementedError):
+        check_sparse_interp(model, piff.Mean())
+
+    stars, _ = make_stars(nstars=1)
+    with pytest.raises(NotImplementedError):
+        model.fit(model.initialize(stars[0]))
+
+@pytest.mark.parametrize("fit_center", [True, False])
+def test_reflux_stars(fit_center):
+    """ the batched reflux_stars matches reflux star by star """
+    stars, _ = make_stars(nstars=5)
+    model = ConvolvedPixelGrid(scale=1.0, size=17)
+    stars = [model.initialize(star) for star in stars]
+    for star in stars:
+        star.fit.center = (0.1, -0.2)
+    refluxed = model.reflux_stars(stars, fit_center=fit_center)
+    for star, star_batch in zip(stars, refluxed):
+        star_single = model.reflux(star, fit_center=fit_center)
+        assert star_batch.fit.flux == pytest.approx(star_single.fit.flux, rel=1e-8)
+        np.testing.assert_allclose(star_batch.fit.center, star_single.fit.center, atol=1e-8)
+        assert star_batch.fit.chisq == pytest.approx(star_single.fit.chisq, rel=1e-6)
+
+def test_kernel_table():
+    """ the lanczos lookup table reproduces piff.PixelGrid's kernel and coefficients """
+    model, model_ref = ConvolvedPixelGrid(scale=1.0, size=17), piff.PixelGrid(scale=1.0, size=17)
+    rng = np.random.default_rng(0)
+    n = int(np.ceil(model.interp.xrange))
+    frac = rng.uniform(0, 1, 5000)
+    kernel, _ = model._kernel1d_table_(frac)
+    np.testing.assert_allclose(kernel, model_ref._kernel1d(frac[:,None] + np.arange(-n, n)), atol=1e-6)
+
+    u, v = rng.uniform(-8, 8, (2, 5000))
+    coeffs, psfx, psfy, dcdu, dcdv = model.interp_calculate(u, v, True)
+    coeffs_ref, psfx_ref, psfy_ref, dcdu_ref, dcdv_ref = model_ref.interp_calculate(u, v, True)
+    np.testing.assert_array_equal(psfx, psfx_ref)
+    np.testing.assert_array_equal(psfy, psfy_ref)
+    np.testing.assert_allclose(coeffs, coeffs_ref, atol=2e-6)
+    np.testing.assert_allclose(dcdu, dcdu_ref, atol=1e-3)
+    np.testing.assert_allclose(dcdv, dcdv_ref, atol=1e-3)
+
+def test_memoization():
+    """ memoized grids are read only, keyed on the params values, bounded and cleared """
+    from scipy.ndimage import gaussian_filter
+    model = ConvolvedPixelGrid(scale=1.0, size=17)
+    rng = np.random.default_rng(0)
+    params = np.append(rng.uniform(0, 1, 17**2), 0.7)
+    grid = model.get_pixelparams(params, flatten=False)
+    np.testing.assert_allclose(grid, gaussian_filter(params[:-1].reshape(17,17), 0.7, mode="reflect"),
+                               atol=1e-12)
+    assert not grid.flags.writeable
+    assert model.get_pixelparams(params.copy(), flatten=False) is grid
+
+    params[-1] = 0.8 # new values, new entry
+    grid_new = model.get_pixelparams(params, flatten=False)
+    assert grid_new is not grid and not np.allclose(grid_new, grid)
+
+    for sigma in np.linspace(0.1, 1, model._CACHE_SIZE + 5):
+        _ = model.get_gaussian_kernel(sigma)
+    assert len(model._cache["kernel"]) == model._CACHE_SIZE
+    assert 0.1 not in model._cache["kernel"] # least recently used dropped
+
+    model.clear_cache("kernel")
+    assert "kernel" not in model._cache and "pixelparams" in model._cache
+    assert model.get_pixelparams(params, flatten=False) is grid_new
+    model.clear_cache()
+    assert model._cache == {}
+    assert model.get_pixelparams(params, flatten=False) is not grid_new
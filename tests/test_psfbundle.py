@@ -0,0 +1,32 @@
+""" piff-free PSF bundles """
+
+import numpy as np
+import piff
+import pytest
+
+from ziff.psfbundle import export_psf, PSFBundle
+from ziff.models.pixelgridconvol import ConvolvedPixelGrid
+from test_pixelgridconvol import fit_psf
+
+XYRANGE = (0.5, 1024.5, 0.5, 1024.5)
+
+@pytest.fixture(scope="module", params=[piff.PixelGrid, ConvolvedPixelGrid])
+def psf(request):
+    """ """
+    return fit_psf(request.param(scale=1.0, size=17), 1, nstars=30)
+
+def test_draw(psf):
+    """ bundle stamps match psf.draw within the documented tolerance (1e-4 of the peak) """
+    bundle = export_psf(psf, xyrange=XYRANGE)
+    x, y = np.asarray([100.3, 500.7, 900.1]), np.asarray([200.6, 650.2, 80.9])
+    cube = bundle.draw(x, y, 21, flux=3.)
+    expected = np.asarray([psf.draw(x_, y_, stamp_size=21, flux=3.).array for x_, y_ in zip(x, y)])
+    np.testing.assert_allclose(cube, expected, rtol=0, atol=1e-4*expected.max())
+
+def test_write_read(psf, tmp_path):
+    """ writeto/read round-trip """
+    bundle = export_psf(psf, savefile=str(tmp_path / "psf.npz"), xyrange=XYRANGE)
+    bundle_read = PSFBundle.read(str(tmp_path / "psf.npz"))
+    x, y = np.asarray([10.5, 700.2]), np.asarray([900.1, 33.3])
+    np.testing.assert_array_equal(bundle_read.draw(x, y, 15), bundle.draw(x, y, 15))
+    assert bundle_read.model == bundle.model
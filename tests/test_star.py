@@ -0,0 +1,43 @@
+""" in memory piff stars """
+
+import numpy as np
+import galsim
+import piff
+import pytest
+
+from ziff.star import build_piffstars, draw_psf_batch
+from ziff.models.pixelgridconvol import ConvolvedPixelGrid
+from test_pixelgridconvol import fit_psf
+
+
+def make_image(positions, sigma=1.5, shape=(200, 200), seed=1):
+    """ gaussian stars on a noisy image (fits positions) """
+    image = galsim.ImageF(shape[1], shape[0])
+    for x, y in positions:
+        galsim.Gaussian(sigma=sigma, flux=1e4).drawImage(image, center=galsim.PositionD(x, y), add_to_image=True)
+    return image.array + np.random.default_rng(seed).normal(0, 1, shape)
+
+def test_mask_and_edge_cuts():
+    """ max_mask_pixels and max_edge_frac discard the stars as piff does """
+    positions = np.asarray([[50.2, 50.7], [120.4, 80.1], [150.5, 150.3]])
+    image = make_image(positions)
+    image[67:71, 107:112] += 1e3 # extra flux in a corner of the second stamp
+    weight = np.ones_like(image)
+    weight[145:150, 145:152] = 0 # masked pixels on the third star
+    kwargs = dict(wcs=galsim.PixelScale(1.), stamp_size=25, weight=weight, max_snr=0)
+
+    stars = build_piffstars(image, *positions.T, **kwargs)
+    assert len(stars) == 3
+    stars = build_piffstars(image, *positions.T, max_mask_pixels=10, **kwargs)
+    assert [star.x for star in stars] == [50.2, 120.4]
+    stars = build_piffstars(image, *positions.T, max_edge_frac=0.1, **kwargs)
+    assert [star.x for star in stars] == [50.2, 150.5]
+
+@pytest.mark.parametrize("model", [piff.PixelGrid, ConvolvedPixelGrid])
+def test_draw_psf_batch(model):
+    """ draw_psf_batch matches psf.draw """
+    psf = fit_psf(model(scale=1.0, size=17), 1, nstars=30)
+    x, y = np.asarray([100.3, 500.7, 900.1]), np.asarray([200.6, 650.2, 80.9])
+    cube = draw_psf_batch(psf, x, y, 21, flux=3.)
+    expected = np.asarray([psf.draw(x_, y_, stamp_size=21, flux=3.).array for x_, y_ in zip(x, y)])
+    np.testing.assert_allclose(cube, expected, rtol=0, atol=2e-5*expected.max())
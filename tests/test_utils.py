@@ -0,0 +1,40 @@
+""" ziff utilities """
+
+import numpy as np
+import pytest
+from ztfimg.stamps import stamp_it
+
+from ziff.utils import STAMP_STATISTICS, get_stamp_statistics
+
+
+NPFUNCS = {"sum": np.sum, "nansum": np.nansum, "mean": np.mean, "nanmean": np.nanmean,
+           "count": lambda s_, axis: np.sum(s_ != 0, axis=axis),
+           "any": lambda s_, axis: np.any(s_ != 0, axis=axis),
+           "nfinite": lambda s_, axis: np.sum(np.isfinite(s_), axis=axis)}
+
+@pytest.mark.parametrize("statistic", STAMP_STATISTICS)
+@pytest.mark.parametrize("dx, dy", [(15, None), (8, 11)])
+def test_stamp_statistics(statistic, dx, dy):
+    """ summed-area statistics match the reduction of the ztfimg stamps """
+    rng = np.random.default_rng(0)
+    array = rng.normal(10, 3, (120, 150))
+    array[rng.uniform(size=array.shape) < 0.2] = 0
+    array[rng.uniform(size=array.shape) < 0.01] = np.nan
+    x0, y0 = rng.uniform(-5, 155, 300), rng.uniform(-5, 125, 300)
+
+    values = get_stamp_statistics(array, x0, y0, dx, dy=dy, statistic=statistic)
+    stamps = stamp_it(array, x0, y0, dx, dy=dy, asarray=True)
+    flagout = np.all(np.isnan(stamps), axis=(1,2))
+    assert 0 < flagout.sum() < len(x0)
+    with np.errstate(invalid="ignore"):
+        expected = NPFUNCS[statistic](stamps[~flagout], axis=(1,2))
+    np.testing.assert_allclose(values[~flagout], expected, rtol=1e-10, atol=1e-8)
+    if statistic == "any":
+        assert np.all(values[flagout])
+    else:
+        assert np.all(np.isnan(values[flagout]))
+
+def test_stamp_statistics_unknown():
+    """ """
+    with pytest.raises(NotImplementedError):
+        get_stamp_statistics(np.zeros((10, 10)), [5], [5], 3, statistic="median")
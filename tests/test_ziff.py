@@ -0,0 +1,88 @@
+""" ZIFF built from (small, local) science images """
+
+import numpy as np
+import galsim
+import pandas
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from ziff.base import ZIFF, get_shapes
+from ziff.catalog import Catalog
+from ziff.star import get_stars_index
+
+
+def make_ziff(tmp_path, nstars=12, shape=(200, 240), seed=0):
+    """ ZIFF of a simulated science image (gaussian stars on a TAN wcs) and its gaia-like catalog
+    (fortran xyformat, 'Source' index) """
+    rng = np.random.default_rng(seed)
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval, wcs.wcs.crpix = [150., 2.], [shape[1]/2, shape[0]/2]
+    wcs.wcs.cd = np.diag([-1., 1.]) * 1.012/3600
+    header = wcs.to_header()
+    header.update({"RA": 150., "DEC": 2., "TELRA": 150., "TELDEC": 2., "GAIN": 6.2, "SATURATE": 5e4})
+
+    xpos, ypos = rng.uniform(15, shape[1]-15, nstars), rng.uniform(15, shape[0]-15, nstars) # fortran
+    data = rng.normal(100, 3, shape).astype("float32")
+    for x_, y_ in zip(xpos, ypos):
+        image = galsim.ImageF(shape[1], shape[0]) # origin (1,1), as the fits file
+        galsim.Gaussian(sigma=1.8, flux=rng.uniform(1e4, 3e4)).drawImage(image, center=galsim.PositionD(x_, y_),
+                                                                        add_to_image=False)
+        data += image.array
+    fits.writeto(str(tmp_path / "sciimg.fits"), data, header)
+    fits.writeto(str(tmp_path / "mskimg.fits"), np.zeros(shape, dtype="int16"), header)
+
+    ra, dec = wcs.pixel_to_world_values(xpos-1, ypos-1)
+    catalog = Catalog(pandas.DataFrame({"ra": ra, "dec": dec, "xpos": xpos, "ypos": ypos,
+                                        "gmag": rng.uniform(14.1, 16.9, nstars), "sky": 100.,
+                                        "flag": np.arange(nstars) % 4, "masked": False},
+                                       index=pandas.Index(np.arange(nstars)*11 + 5, name="Source")),
+                      name="gaia", xyformat="fortran")
+    ziff = ZIFF(str(tmp_path / "sciimg.fits"), str(tmp_path / "mskimg.fits"), download=False)
+    return ziff, catalog
+
+@pytest.mark.parametrize("ioconfig", [{},
+                                      {"nstars": 8, "min_snr": 20, "max_edge_frac": 0.2, "stamp_center_size": 9}])
+def test_build_stars_vs_makestars(tmp_path, ioconfig):
+    """ in memory stars are those of piff.InputFiles.makeStars reading the files """
+    import piff
+    ziff, catalog = make_ziff(tmp_path)
+    catalog.to_fits(str(tmp_path / "catalog.fits"), filtered=False)
+    ioconfig = {"stamp_size": 15, "sky_col": "sky", "gain": "GAIN", "satur": "SATURATE", "noise": 1.,
+                **ioconfig}
+    stars_ref = piff.InputFiles({**ioconfig, "image_file_name": str(tmp_path / "sciimg.fits"), "image_hdu": 0,
+                                 "cat_file_name": str(tmp_path / "catalog.fits"), "cat_hdu": 1,
+                                 "x_col": "xpos", "y_col": "ypos", "ra": "TELRA", "dec": "TELDEC"}
+                                ).makeStars()
+    stars = ziff.build_stars(catalog, ioconfig=ioconfig)
+    assert len(stars) == len(stars_ref) > 0
+    for star, star_ref in zip(stars, stars_ref):
+        assert star.image_pos == star_ref.image_pos and star.image.bounds == star_ref.image.bounds
+        np.testing.assert_array_equal(star.image.array, star_ref.image.array)
+        np.testing.assert_array_equal(star.weight.array, star_ref.weight.array)
+        assert (star.u, star.v) == pytest.approx((star_ref.u, star_ref.v), abs=1e-10)
+        properties = {k: v for k, v in star.data.properties.items() if k != "catindex"}
+        assert properties.keys() == star_ref.data.properties.keys()
+        for key, value in star_ref.data.properties.items():
+            assert properties[key] == pytest.approx(value, rel=1e-12), key
+
+def test_stars_catindex(tmp_path):
+    """ stars carry the catalog index of their entry, after the flag and nstars selections """
+    ziff, catalog = make_ziff(tmp_path)
+    stars = ziff.build_stars(catalog, ioconfig={"stamp_size": 15, "sky_col": "sky", "gain": "GAIN",
+                                                "flag_col": "flag", "skip_flag": 1, "nstars": 5})
+    data = catalog.data[(catalog.data["flag"] & 1) == 0].iloc[:5]
+    np.testing.assert_array_equal(get_stars_index(stars), data.index)
+    np.testing.assert_allclose([s_.image_pos.x for s_ in stars], data["xpos"].to_numpy(dtype=float))
+    np.testing.assert_allclose([s_.image_pos.y for s_ in stars], data["ypos"].to_numpy(dtype=float))
+
+def test_get_shapes_mismatch(tmp_path, monkeypatch):
+    """ stars not in the given catalog raise a ValueError """
+    ziff, catalog = make_ziff(tmp_path)
+    stars = ziff.build_stars(catalog, ioconfig={"stamp_size": 15, "sky_col": "sky", "gain": "GAIN"})
+    # the catalog lacks some of the star entries
+    subcat = catalog.get_catalog(index=catalog.data.index[::2])
+    monkeypatch.setattr(ziff, "get_stars", lambda *args, **kwargs: stars[:subcat.npoints])
+    with pytest.raises(ValueError, match="stars but only"):
+        get_shapes(ziff, psf=object(), cat=subcat, store=False)
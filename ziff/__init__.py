@@ -14,11 +14,15 @@ def limit_numpy(nthreads=4):
 
 
 
-import piff
 __version__="0.3.3"
 
-from .models.pixelgridconvol import ConvolvedPixelGrid
-piff.ConvolvedPixelGrid = ConvolvedPixelGrid
+try:
+    import piff
+except ImportError: # light install, e.g. psfbundle evaluation only
+    piff = None
+else:
+    from .models.pixelgridconvol import ConvolvedPixelGrid
+    piff.ConvolvedPixelGrid = ConvolvedPixelGrid
 
 
 
@@ -4,11 +4,14 @@
 """ Base ZIFF Classes """
 
 import os
+import mmap
 import numpy as np
 import logging
 import json
 import warnings
+import threading
 import pandas
+from collections import OrderedDict
 # PIFF 
 import piff
 
@@ -18,10 +21,28 @@ from ztfimg import image as ztfimage
 from . import catalog as catlib
 from . import io
 
+# piff i/o options (with their disabled value) not implemented by ZIFF.build_stars()
+INMEMORY_UNSUPPORTED_IO = {"weight_hdu":None, "badpix_hdu":None, "ra_col":None,
+                           "hsm_size_reject":0, "use_partial":False}
+
+def get_inmemory_unsupported(ioconfig):
+    """ piff i/o options of ioconfig that in memory stars (ZIFF.build_stars) do not handle """
+    return [k for k, off_ in INMEMORY_UNSUPPORTED_IO.items() if ioconfig.get(k) not in (None, off_)]
+
+def check_inmemory(ioconfig, inmemory=True):
+    """ inmemory unless ioconfig uses options build_stars() does not handle, then
+    a warning is raised and False is returned (piff reads the image and catalog files).
+    """
+    unsupported = get_inmemory_unsupported(ioconfig) if inmemory else []
+    if len(unsupported) > 0:
+        warnings.warn(f"{unsupported} i/o options not implemented for in memory stars, using the image and catalog files")
+        return False
+    return inmemory
+
 def estimate_psf(ziff, catalog,
                      stamp_size=None,
                      nstars=None, interporder=None, maxoutliers=None,
-                     store=True, verbose=True):
+                     store=True, verbose=True, inmemory=True):
     """ """
     if not ziff.has_images():
         warnings.warn("No image in the given ziff")
@@ -32,7 +53,10 @@ def estimate_psf(ziff, catalog,
         return None
 
     import piff
-    config = ziff.get_config(catfile=catalog.filename)
+    inmemory = check_inmemory(ziff.config["io"], inmemory)
+    if not inmemory and not catalog.has_filename():
+        raise ValueError("piff reads the stars from the catalog file but the given catalog has no filename")
+    config = ziff.get_config(catfile=catalog.filename if not inmemory else None)
     
     if interporder is not None:
         config["psf"]["interp"]["order"]=int(interporder)
@@ -47,13 +71,19 @@ def estimate_psf(ziff, catalog,
         config['io']['stamp_size'] = int(stamp_size)
         
         
-    inputfile = piff.InputFiles(config["io"], logger=None)
-    inputfile.setPointing('RA','DEC')
-    wcs = inputfile.getWCS()
-    pointing = inputfile.getPointing()
-    stars = inputfile.makeStars(logger=None)
+    if inmemory: # no fits file round trip
+        wcs, pointing = ziff.get_wcspointing()
+        stars = ziff.build_stars(catalog, ioconfig=config["io"])
+    else:
+        inputfile = piff.InputFiles(config["io"], logger=None)
+        inputfile.setPointing('RA','DEC')
+        wcs = inputfile.getWCS()
+        pointing = inputfile.getPointing()
+        stars = inputfile.makeStars(logger=None)
     
     psf = piff.SimplePSF.process(config['psf'])
+    from .models.pixelgridconvol import check_sparse_interp
+    check_sparse_interp(psf.model, psf.interp)
     psf.fit(stars, wcs, pointing, logger=None)
     
     if store:
@@ -81,8 +111,17 @@ def get_gaia_catalog(ziff, writeto="default", gmag_range=[15, 16], isolationlimi
 
 
 def get_shapes(ziff, psf, cat, incl_residual=False, incl_stars=False, store=True,
-                   stamp_size=None, **kwargs):
-    """ """
+                   stamp_size=None, engine="numpy", stampprop={}, shapestore=None, **kwargs):
+    """ 
+    stampprop: [dict] -optional-
+        kwargs of stampstore.write_stamps() used to store the stamps,
+        e.g. dict(encoding="quantized", maxerror=1e-4, shuffle=True, compression="zstd")
+        (see stampstore.encode_stamps())
+
+    shapestore: [ShapeStore or string or None] -optional-
+        if given, the shapes are also appended to this ShapeStore (or store directory),
+        see ziff.shapestore.
+    """
     if not ziff.has_images():
         warnings.warn("No image in the given ziff")
         return None
@@ -98,20 +137,24 @@ def get_shapes(ziff, psf, cat, incl_residual=False, incl_stars=False, store=True
     ziff.set_psf(psf)
     stars     = ziff.get_stars(cat, fullreturn=False, stamp_size=stamp_size)
 
-    
+    from .star import get_stars_index
     if len(stars) > cat.npoints:
         # This should never happen
         raise ValueError("This is unexpected, more stars than cat entries....")
-    if len(stars) < cat.npoints:
+
+    # stars carry their catalog index (in memory stars, see ZIFF.build_stars)
+    stars_index = get_stars_index(stars)
+    if stars_index is None and len(stars) < cat.npoints:
         # Matching them to discard the missing cat entries
-        from astropy import coordinates, units
-        skycat   = coordinates.SkyCoord(*cat.data[["xpos","ypos"]].values.T, unit="arcsec")
-        skystars = coordinates.SkyCoord([[s.image_pos.x, s.image_pos.y] for s in stars],
-                                            unit="arcsec")
-        catalog_idx, self_idx, d2d, d3d = skycat.search_around_sky(skystars,
-                                                            seplimit=0.2*units.arcsec)
+        stars_idx, self_idx = cat.match_xy([s.image_pos.x for s in stars],
+                                           [s.image_pos.y for s in stars], seplimit=0.2)
+        stars_index = cat.data.index[self_idx]
+        
+    if stars_index is not None and not cat.data.index.equals(pandas.Index(stars_index)):
         npoints_star = cat.npoints
-        cat = cat.get_catalog(index=cat.data.index[self_idx], shuffled=False)
+        cat = cat.get_catalog(index=stars_index, shuffled=False)
+        if cat.npoints != len(stars):
+            raise ValueError(f"{len(stars)} stars but only {cat.npoints} of them in the catalog.")
         warnings.warn(f"{npoints_star-cat.npoints}/{npoints_star} have been drop from the cat when loading stars.")
         
     starmodel = ziff.get_stars_psfmodel(stars)
@@ -123,9 +166,10 @@ def get_shapes(ziff, psf, cat, incl_residual=False, incl_stars=False, store=True
     
     #
     # - DataFrame
-    df_model  = pandas.DataFrame( np.asarray([s.hsm for s in starmodel]),
+    from .star import get_stars_hsm
+    df_model  = pandas.DataFrame( get_stars_hsm(starmodel, engine=engine),
                                       columns=columns, index=catdata.index)
-    df_data   = pandas.DataFrame( np.asarray([s.hsm for s in   stars  ]),
+    df_data   = pandas.DataFrame( get_stars_hsm(  stars  , engine=engine),
                                       columns=columns, index=catdata.index)
     
     df_uv     = pandas.DataFrame(  [[s.u,s.v]       for s in   stars  ],
@@ -141,17 +185,32 @@ def get_shapes(ziff, psf, cat, incl_residual=False, incl_stars=False, store=True
     keys = ["ccdid","qid","rcid","obsjd","fieldid","filterid","maglim"]
     shapes[keys] = [getattr(ziff,k_) for k_ in keys]
 
+    stamps = {}
     if incl_stars:
-        shapes["stars"] = [np.ravel(s_.image.array) for s_ in stars]
-        kwargs["engine"]="pyarrow"
+        stamps["stars"] = np.asarray([s_.image.array for s_ in stars])
         
     if incl_residual:
-        residual = [np.ravel(s_.image.array - m_.image.array) for s_,m_ in zip(stars, starmodel)]
-        shapes["residual"] = residual
-        kwargs["engine"]="pyarrow"
-    
+        stamps["residual"] = np.asarray([s_.image.array - m_.image.array for s_,m_ in zip(stars, starmodel)])
+
+    for key, cube in stamps.items():
+        shapes[key] = list(cube.reshape(len(cube), -1))
+        
     if store:
-        shapes.to_parquet(ziff.build_filename("psfshape",".parquet")[0], **kwargs)
+        # stamps are stored in the stamp store next to the parquet file (see ziff.stampstore)
+        from .stampstore import write_stamps, get_stampstore_filename
+        shapefile = ziff.build_filename("psfshape",".parquet")[0]
+        shapes.drop(columns=list(stamps.keys())).to_parquet(shapefile, **kwargs)
+        if len(stamps)>0:
+            write_stamps(get_stampstore_filename(shapefile), stamps, index=shapes.index,
+                         index_name=shapes.index.name if shapes.index.name is not None else "Source",
+                         **stampprop)
+
+    if shapestore is not None:
+        from .shapestore import ShapeStore
+        if not isinstance(shapestore, ShapeStore):
+            shapestore = ShapeStore(shapestore)
+        prefix = ziff.get_prefix(basename=True)[0]
+        shapestore.add_shapes(shapes, filefracday=prefix.split("_")[1], basename=prefix.rstrip("_"))
         
     return shapes
         
@@ -328,6 +387,11 @@ class _ZIFFLogConfig_( object ):
 class _ZIFFImageHolder_( _ZIFFLogConfig_ ):
     # IMAGES & MASK (on top of logger & config)
 
+    # image product (data, background, mask) cache, see set_imagecache()
+    _IMAGECACHE_MAXBYTES = 2**30
+    _IMAGECACHE_DTYPE = None
+    _IMAGECACHE_LOCK = threading.RLock()
+
     @classmethod
     def from_filename(cls, filename, logger=None, **kwargs):
         """ """
@@ -356,9 +420,17 @@ class _ZIFFImageHolder_( _ZIFFLogConfig_ ):
     #   Methods        #
     # ================ #
     def load_images(self, imagefile, maskfile=None, download=False,
-                        handle_nofiles=True):
-        """ Builds the ztfimages from the given filepath and calls self.set_images() """
-        from ztfimg import image
+                        handle_nofiles=True, lazy=False):
+        """ Builds the ztfimages from the given filepath and calls self.set_images() 
+
+        lazy: [bool] -optional-
+            only read the headers, the pixels are memory-mapped (or decoded per tile)
+            when accessed (see ziff.lazyimage.LazyScienceImage)
+        """
+        if lazy:
+            from .lazyimage import LazyScienceImage as ImageClass
+        else:
+            ImageClass = ztfimage.ScienceImage
         
         # Handles list / single
         imagefile = np.atleast_1d(imagefile)
@@ -372,7 +444,7 @@ class _ZIFFImageHolder_( _ZIFFLogConfig_ ):
             maskfile = [None for i in range(len(imagefile))]
 
         # Build the ztfimage
-        zimages = [ztfimage.ScienceImage.from_filename(image_, filenamemask=mask_, download=download)
+        zimages = [ImageClass.from_filename(image_, filenamemask=mask_, download=download)
                          for (image_, mask_) in zip(imagefile, maskfile)
                        if (handle_nofiles and os.path.isfile(image_))]
         if len(zimages)>0:
@@ -389,8 +461,55 @@ class _ZIFFImageHolder_( _ZIFFLogConfig_ ):
                 raise TypeError("The given images must be image.ZTFImage (or inherite from) ")
             
         self._images = ztfimg
+        self.clear_imagecache()
         # add the filename
         self.config['io']['image_file_name'] = self._sciimg
+
+    def set_imagecache(self, maxbytes=None, dtype=None, enabled=True):
+        """ configure the image product cache used by get_data(), get_background() and get_mask().
+        Products are stored per call arguments and evicted (least recently used first) 
+        when above the memory budget. Cached arrays are returned read-only.
+
+        Parameters
+        ----------
+        maxbytes: [int or None] -optional-
+            memory budget of the cache (in bytes), _IMAGECACHE_MAXBYTES if None.
+
+        dtype: [string or None] -optional-
+            if given (e.g. 'float32') float products are stored in this dtype.
+
+        enabled: [bool] -optional-
+            set to False to disable the cache (this clears it)
+
+        Returns
+        -------
+        None
+        """
+        self._imagecache_config = {"maxbytes": self._IMAGECACHE_MAXBYTES if maxbytes is None else maxbytes,
+                                   "dtype": dtype, "enabled": enabled}
+        self.clear_imagecache()
+        
+    def clear_imagecache(self, which=None):
+        """ invalidate cached image products.
+
+        Parameters
+        ----------
+        which: [string, list or None] -optional-
+            product(s) to drop: 'data', 'background', 'mask'. All if None.
+            (dropping the background or the mask also drops the data built on them)
+        """
+        if which is None or not hasattr(self, "_imagecache"):
+            with self._IMAGECACHE_LOCK:
+                self._imagecache = OrderedDict()
+                self._imagecache_nbytes = 0
+            return
+        
+        which = list(np.atleast_1d(which))
+        if "background" in which or "mask" in which:
+            which.append("data")
+        with self._IMAGECACHE_LOCK:
+            for key in [k_ for k_ in self._imagecache if k_[0] in which]:
+                self._pop_imageproduct_(key)
         
     # -------- #
     #  GETTER  #
@@ -488,11 +607,48 @@ class _ZIFFImageHolder_( _ZIFFLogConfig_ ):
         return self._read_images_property_(key, isfunc=False, **kwargs)
     
         
-    def get_data(self, applymask=True, maskvalue=np.NaN, rmbkgd=True, whichbkgd="default"):
-        """ """
-        return self._read_images_property_("get_data", isfunc=True,
-                                               applymask=applymask,
-                                            maskvalue=maskvalue, rmbkgd=rmbkgd, whichbkgd=whichbkgd)
+    def get_data(self, applymask=True, maskvalue=np.NaN, rmbkgd=True, whichbkgd="default", **kwargs):
+        """ image{s} data, as ztfimg's image.get_data() but built from 
+        the (cached) get_mask() and get_background() products. 
+        
+        **kwargs goes to get_mask()
+        """
+        def _build_data_():
+            rawdata = self._read_images_property_("data")
+            masks = self.get_mask(**kwargs) if applymask else None
+            bkgds = self.get_background(method=whichbkgd, rmbkgd=False) if rmbkgd else None
+            if self.is_single():
+                rawdata, masks, bkgds = [rawdata], [masks], [bkgds]
+            else:
+                masks = masks if applymask else [None]*len(rawdata)
+                bkgds = bkgds if rmbkgd else [None]*len(rawdata)
+
+            datas = []
+            for data_, mask_, bkgd_ in zip(rawdata, masks, bkgds):
+                if not applymask and not rmbkgd: # only copied for a dtype change (see _as_dtype_)
+                    datas.append(self._as_dtype_(data_, self.imagecache_config["dtype"]))
+                    continue
+                
+                data_ = np.array(data_, dtype=self.imagecache_config["dtype"])
+                if applymask:
+                    data_[mask_] = maskvalue
+                if rmbkgd:
+                    data_ -= bkgd_
+                datas.append(data_)
+            return datas[0] if self.is_single() else datas
+
+        return self._get_imageproduct_(("data", applymask, str(maskvalue), rmbkgd, whichbkgd),
+                                       _build_data_, **kwargs)
+        
+    def get_rawdata(self):
+        """ image{s} data as stored in the sciimg (no background subtraction nor masking).
+        This is not a copy, for lazy images (see load_images) this is the 
+        LazyFitsArray (only the sliced parts are read).
+        """
+        rawdata = [img_.lazydata if getattr(img_, "lazydata", None) is not None else img_.data
+                   for img_ in np.atleast_1d(self._images)]
+        return rawdata[0] if self.is_single() else rawdata
+        
     def get_mask(self, **kwargs):
         """ 
         **kwargs goes to ztfimg's image{s}.get_mask().
@@ -506,7 +662,9 @@ class _ZIFFImageHolder_( _ZIFFLogConfig_ ):
            verbose=False, getflags=False
 
         """
-        return self._read_images_property_("get_mask", isfunc=True, **kwargs)
+        return self._get_imageproduct_(("mask",),
+                                       lambda: self._read_images_property_("get_mask", isfunc=True, **kwargs),
+                                       **kwargs)
 
     def get_background(self, method=None, rmbkgd=False, backup_default='sep', **kwargs):
         """ Get the image{s} background using their get_background() method.
@@ -532,13 +690,108 @@ class _ZIFFImageHolder_( _ZIFFLogConfig_ ):
         -------
         float/array (see method)
         """
-        return self._read_images_property_("get_background", isfunc=True,
-                                            method=method, rmbkgd=rmbkgd, backup_default=backup_default, **kwargs)
+        return self._get_imageproduct_(("background", "default" if method is None else method,
+                                        rmbkgd, backup_default),
+                                       lambda: self._read_images_property_("get_background", isfunc=True,
+                                                                           method=method, rmbkgd=rmbkgd,
+                                                                           backup_default=backup_default,
+                                                                           **kwargs),
+                                       **kwargs)
 
     def load_image_sourcebackground(self, **kwargs):
         """ runs load_source_background on the images. """
+        self.clear_imagecache("background")
         return self._read_images_property_("load_source_background", isfunc=True, **kwargs)
+
+    def _get_imageproduct_(self, key, func, **kwargs):
+        """ returns the cached func() image product for key (+kwargs), computing and storing it if needed.
+        Not cached if disabled or if kwargs are not hashable (e.g. from_sources dataframe).
+        """
+        config = self.imagecache_config
+        try:
+            key = key + tuple(sorted(kwargs.items()))
+            hash(key)
+        except TypeError:
+            return func()
         
+        if not config["enabled"]:
+            return func()
+
+        with self._IMAGECACHE_LOCK:
+            if not hasattr(self, "_imagecache"):
+                self.clear_imagecache()
+            
+            if key in self._imagecache:
+                self._imagecache.move_to_end(key)
+                return self._imagecache[key]
+
+        # computed outside the lock, the cache may be shared by threads (see ziff.cache.get_ziff)
+        value = func()
+        if type(value) is list:
+            value = [self._as_cacheproduct_(v_, config["dtype"]) for v_ in value]
+        else:
+            value = self._as_cacheproduct_(value, config["dtype"])
+
+        with self._IMAGECACHE_LOCK:
+            if key in self._imagecache: # concurrently computed
+                self._pop_imageproduct_(key)
+            self._imagecache[key] = value
+            self._imagecache_nbytes += self._get_productnbytes_(value)
+            # LRU eviction, a product larger than the budget is not kept.
+            while len(self._imagecache)>0 and self._imagecache_nbytes > config["maxbytes"]:
+                self._pop_imageproduct_(next(iter(self._imagecache)))
+            
+        return value
+
+    def _pop_imageproduct_(self, key):
+        """ drops the key product from the cache, keeping the running imagecache_nbytes 
+        (to be called with _IMAGECACHE_LOCK) """
+        self._imagecache_nbytes -= self._get_productnbytes_(self._imagecache.pop(key))
+
+    @staticmethod
+    def _get_productnbytes_(value):
+        """ memory size of a (list of) cached product(s) """
+        if type(value) is list:
+            return int(np.sum([_ZIFFImageHolder_._get_productnbytes_(v_) for v_ in value]))
+        # memory mapped arrays are not loaded in memory.
+        base_ = value
+        while isinstance(base_, np.ndarray):
+            base_ = base_.base
+        return 0 if isinstance(base_, mmap.mmap) else int(getattr(value, "nbytes", 0))
+
+    @staticmethod
+    def _as_dtype_(array, dtype=None):
+        """ array converted to dtype, not copied if only the byte order differs
+        (big-endian fits data, memory mapped for lazy images, are kept as is) """
+        array = np.asarray(array)
+        if dtype is None or array.dtype.newbyteorder("=") == np.dtype(dtype).newbyteorder("="):
+            return array
+        return array.astype(dtype)
+
+    @staticmethod
+    def _as_cacheproduct_(value, dtype=None):
+        """ read-only (and dtype converted for floats) view of array products """
+        if not isinstance(value, np.ndarray):
+            return value
+        
+        if value.dtype.kind == "f":
+            value = _ZIFFImageHolder_._as_dtype_(value, dtype)
+        value = value.view()
+        value.flags.writeable = False
+        return value
+
+    def get_wcspointing(self, inputfile=None, verbose=False):
+        """ get the piff wcs (dict, one per chipnum) and pointing.
+        If no inputfile is given, these are derived from the image headers (no file I/O).
+        """
+        if inputfile is not None or not self.has_images():
+            return super().get_wcspointing(inputfile=inputfile, verbose=verbose)
+
+        from .star import get_piff_wcs, get_piff_pointing
+        headers = self.get_header()
+        wcs = {chipnum: get_piff_wcs(header_) for chipnum, header_ in enumerate(headers)}
+        return wcs, get_piff_pointing(headers[0], ra="RA", dec="DEC")
+
 
     # ================ #
     #   Properties     #
@@ -567,6 +820,19 @@ class _ZIFFImageHolder_( _ZIFFLogConfig_ ):
         """ """
         return self.nimgs==1
 
+    @property
+    def imagecache_config(self):
+        """ image product cache configuration (see set_imagecache) """
+        if not hasattr(self, "_imagecache_config"):
+            self._imagecache_config = {"maxbytes": self._IMAGECACHE_MAXBYTES,
+                                       "dtype": self._IMAGECACHE_DTYPE, "enabled": True}
+        return self._imagecache_config
+
+    @property
+    def imagecache_nbytes(self):
+        """ memory size of the cached image products (running total, see _get_productnbytes_) """
+        return getattr(self, "_imagecache_nbytes", 0)
+
     def _read_images_property_(self, key, isfunc=False, *args, **kwargs):
         """ """
         if not isfunc:
@@ -665,7 +931,7 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
     def __init__(self, sciimg=None, mskimg=None, psffile=None,
                       logger=None, catalog=None,
                       config="default", fetch_psf=False,
-                      download=True):
+                      download=True, lazy=False):
         """Wrapper of PIFF for ZTF 
 
         Single fit of potentially multi images.
@@ -680,6 +946,9 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
 
         logger: [logger or None] -optional-
             logger passed to piff. 
+
+        lazy: [bool] -optional-
+            load the images lazily (memory mapped, see load_images)
         
         """
         # Must start with config.
@@ -688,7 +957,7 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
 
         # - Data
         if sciimg is not None:
-            self.load_images(sciimg, mskimg, download=download)
+            self.load_images(sciimg, mskimg, download=download, lazy=lazy)
 
         # - Catalog
         if catalog is not None:
@@ -736,9 +1005,11 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
     # ------- #
     # LOADER  #
     # ------- #
-    def load_psf(self, psffilename=None, fetch=True):
+    def load_psf(self, psffilename=None, fetch=True, use_cache=True):
         """ loads a piff output file: `bla`_output.piff'
         This contains the PSF properties
+
+        use_cache: the loaded PSF is kept in (and read from) the process cache (see ziff.cache)
         """
         if psffilename is None and fetch:
             from ztfquery import buildurl
@@ -747,13 +1018,16 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
                                                             check_suffix=False)
                                for prefix_ in self.get_prefix()]
                 
-            psffilename = [None if not os.path.isfile(psf_) else psf_ for psf_ in psffilename_]
+            # on disk or compacted in a container (see ziff.container)
+            from .container import file_exists
+            psffilename = [None if not file_exists(psf_) else psf_ for psf_ in psffilename_]
             if self.is_single():
                 psffilename = psffilename[0]
                 
         # TO BE TESTED, CASE WITH MULTI IMAGES.
         if psffilename is not None:
-            self.set_psf( piff.PSF.read(file_name=psffilename, logger=self.logger) )
+            from .cache import get_psf
+            self.set_psf( get_psf(psffilename, logger=self.logger, use_cache=use_cache) )
             # tmp patch:
             #self.psf.wcs = list(np.atleast_1d(self.psf.wcs))        
         
@@ -810,8 +1084,8 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
     def _fetch_calibrators_(self, which, name=None,
                                 setsky=True, setwcs=True, setmask=True,
                                 add_boundfilter=True, bound_padding=50,
-                                isolationlimit=10):
-        """ """
+                                isolationlimit=10, lazy=False):
+        """ lazy: sky, mask and isolation are deferred (see _enrich_cat_) """
         if name is None:
             name = which
             
@@ -831,7 +1105,8 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
                                         setsky=setsky, setwcs=setwcs, setmask=setmask,
                                         add_boundfilter=add_boundfilter,
                                         bound_padding=bound_padding,
-                                        isolationlimit=isolationlimit)
+                                        isolationlimit=isolationlimit,
+                                        lazy=lazy)
 
         return catalog_
         
@@ -849,7 +1124,8 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
                                             setsky=setsky, setwcs=setwcs, setmask=setmask,
                                             add_boundfilter=add_boundfilter,
                                             bound_padding=bound_padding,
-                                            isolationlimit=isolationlimit)
+                                            isolationlimit=isolationlimit,
+                                            lazy=True)
 
         if gmag_range is not None:
             catalog_.add_filter('gmag', gmag_range, name='gmag_outrange')
@@ -861,6 +1137,9 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
         if colormag_range is not None:
             catalog_.add_filter('colormag', colormag_range, name='colormag_outrange')
 
+        # sky, mask and isolation only for the remaining entries
+        catalog_.compute_deferred()
+
         if not setit:
             return catalog_
 
@@ -880,6 +1159,7 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
                                             add_boundfilter=add_boundfilter,
                                             bound_padding=bound_padding,
                                             isolationlimit=isolationlimit,
+                                            lazy=True,
                                             )
 
         
@@ -892,6 +1172,9 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
         if zmag_range is not None:
             catalog_.add_filter('zmag', zmag_range, name='zmag_outrange')
 
+        # sky, mask and isolation only for the remaining entries
+        catalog_.compute_deferred()
+
         if not setit:
             return catalog_
 
@@ -900,13 +1183,24 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
     def _enrich_cat_(self, catalog_, name=None,
                          setsky=True, setwcs=True, setmask=True,
                          add_boundfilter=True, bound_padding=50,
-                         isolationlimit=None):
-        """ """
+                         isolationlimit=None, lazy=False):
+        """ 
+        lazy: [bool] -optional-
+            if True, only the bound filters are applied. Mask, isolation and sky are registered
+            as deferred columns, to be computed (catalog_.compute_deferred()) once the
+            cheap (e.g. magnitude) filters are set.
+        """
         if catalog_.name is None:
             catalog_.change_name(name)
 
         if setwcs:
             catalog_.set_wcs(self.wcs)
+
+        if lazy:
+            return self._enrich_cat_lazy_(catalog_, setsky=setsky, setmask=setmask,
+                                          add_boundfilter=add_boundfilter,
+                                          bound_padding=bound_padding,
+                                          isolationlimit=isolationlimit)
             
         if setsky:
             sky = self.get_background()
@@ -931,6 +1225,43 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
             catalog_.add_filter('is_isolated', True, name='not_isolated')
 
         return catalog_
+
+    def _enrich_cat_lazy_(self, catalog_, setsky=True, setmask=True,
+                              add_boundfilter=True, bound_padding=50,
+                              isolationlimit=None):
+        """ lazy version of _enrich_cat_ (see there) """
+        if add_boundfilter and bound_padding is not None:
+            ymax, xmax = self.shape
+            catalog_.add_filter('xpos',[bound_padding, xmax-bound_padding],
+                                    name = 'xpos_out')
+            catalog_.add_filter('ypos',[bound_padding, ymax-bound_padding],
+                                    name = 'ypos_out')
+
+        stampsize = self.get_config_value("stamp_size")
+        def _add_deferred_(name, func, imgkey, images, filters=None):
+            """ deferred with per catalog image and stampsize """
+            if self.is_single():
+                return catalog_.add_deferred(name, func, filters=filters,
+                                             stampsize=stampsize, **{imgkey:images})
+            
+            stampsizes = np.broadcast_to(np.atleast_1d(stampsize), self.nimgs)
+            enumkwargs = [{imgkey:img_, "stampsize":stampsize_}
+                              for img_, stampsize_ in zip(images, stampsizes)]
+            return catalog_.add_deferred(name, func, filters=filters, enumkwargs=enumkwargs)
+            
+        # - cheapest and most selective first, isolation still against all entries.
+        if setmask:
+            _add_deferred_("mask", "build_mask_from_maskimg", "maskimg", self.get_mask(),
+                           filters=[('masked', False, 'maskedout')])
+            
+        if isolationlimit is not None:
+            catalog_.add_deferred("isolation", "measure_isolation",
+                                  filters=[('is_isolated', True, 'not_isolated')],
+                                  seplimit=isolationlimit)
+        if setsky:
+            _add_deferred_("sky", "build_sky_from_bkgdimg", "bkgdimg", self.get_background())
+            
+        return catalog_
     
     # ------- #
     # GETTER  #
@@ -957,6 +1288,73 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
         
         return galsimimg
 
+    def eval_psf_batch(self, xpos, ypos, chipnum=0, flux=1.0, offset=(0, 0),
+                           stamp_size=None, informat="numpy", chunksize=256,
+                           dtype="float32", **kwargs):
+        """ evaluate the psf at many positions at once.
+
+        This is the vectorized equivalent of eval_psf() (see star.draw_psf_batch()):
+        the interpolation is evaluated for all positions with a single matrix product
+        and the pixel grid is rendered with numpy (no galsim image drawn).
+        Only a SimplePSF with a PixelGrid (or ConvolvedPixelGrid) model and a BasisPolynomial
+        interpolation is handled.
+
+        Parameters
+        ----------
+        xpos, ypos: [array]
+            positions where the psf should be evaluated (see informat)
+
+        chipnum: [int or array] -optional-
+            chip number of each position.
+
+        flux: [float or array] -optional-
+            flux of the psfs.
+
+        offset: [(float, float)] -optional-
+            offset of the psf centers (in pixels)
+
+        stamp_size: [int or None] -optional-
+            size of the stamps. If None, the config stamp_size is used.
+
+        informat: [string] -optional-
+            xpos, ypos convention: numpy (starts at 0) or fortran (starts at 1)
+
+        chunksize: [int] -optional-
+            number of psfs rendered at once (memory control).
+
+        dtype: [string] -optional-
+            dtype of the returned cube.
+
+        **kwargs goes to star.draw_psf_batch() (extra interpolation properties)
+
+        Returns
+        -------
+        3d array (N, stamp_size, stamp_size)
+        """
+        from .star import draw_psf_batch
+        if not self.has_psf():
+            raise AttributeError("No PSF loaded.")
+
+        if stamp_size is None:
+            stamp_size = self.get_config_value("stamp_size")
+
+        formatoffset = -1 if informat == "numpy" else 0
+        xpos = np.atleast_1d(np.asarray(xpos, dtype=float)) - formatoffset
+        ypos = np.atleast_1d(np.asarray(ypos, dtype=float)) - formatoffset
+        chipnum = np.broadcast_to(chipnum, xpos.shape)
+        flux = np.broadcast_to(flux, xpos.shape)
+
+        cube = np.empty((len(xpos), stamp_size, stamp_size), dtype=dtype)
+        for chipnum_ in np.unique(chipnum):
+            flagchip = chipnum == chipnum_
+            cube[flagchip] = draw_psf_batch(self.psf, xpos[flagchip], ypos[flagchip],
+                                            stamp_size=int(stamp_size), chipnum=chipnum_,
+                                            flux=flux[flagchip], offset=offset,
+                                            chunksize=chunksize, dtype=dtype,
+                                            **{k:np.broadcast_to(v, xpos.shape)[flagchip]
+                                                   for k,v in kwargs.items()})
+        return cube
+
     def get_psf(self, catalog, chipnum=0, flux=1.0, iloc=None, **kwargs):
         """ """
         cat = self.get_catalog(catalog, chipnum=chipnum)
@@ -966,7 +1364,8 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
                     for xpos_, ypos_ in zip(xpos, ypos) ]
 
     def get_starcollection(self, catalog, psf=None, filtered=True, verbose=False,
-                               which=["stars", "psfmodel"], nopsf=False, add_filter=None):
+                               which=["stars", "psfmodel"], nopsf=False, add_filter=None,
+                               engine="numpy"):
         """ """
         from . import star        
         stars, (cat, inputfile) = self.get_stars( catalog, filtered=filtered,
@@ -979,7 +1378,7 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
                     psf = self.psf
                 soll.measure_psfmodel(psf)
             
-        soll.measure_shapes(which, nopsf=nopsf)
+        soll.measure_shapes(which, nopsf=nopsf, engine=engine)
         return soll, cat
     
     def get_psfshape(self, catalog, psf=None,
@@ -1050,8 +1449,8 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
 
     def get_stars(self, catalog, writeto="tmp", fullreturn=False,
                       nstars="no_limit", imagefile=None, stamp_size=None,
-                      filtered=True, verbose=False, **kwargs):
-        """ return PIFF stars for the given catalog using get_piff_inputfile().makeStars() 
+                      filtered=True, verbose=False, inmemory=True, **kwargs):
+        """ return PIFF stars for the given catalog.
 
         Parameters
         ----------
@@ -1061,25 +1460,41 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
             - 'tmp': temporary name: tmp_`bla`
             - None or 'default': using the cat.build_filename(prefix) method
             - rest: considered as the actuel filename.
+            = 'tmp' is ignored if inmemory is True =
 
         fullreturn: [bool] -optional-
-            returns the catalog and the piff inputfile in addition to the stars 
+            returns the catalog and the piff inputfile in addition to the stars
             (stars, cat)
 
+        inmemory: [bool] -optional-
+            if True, stars are build from the loaded images and the catalog data
+            (see build_stars()), otherwise using get_piff_inputfile().makeStars()
+            that reads the image and catalog files.
+            = inputfile is None if inmemory is True =
+
         Returns
         -------
         piff.Stars or piff.Stars, (catalog, inputfile)
         """
         # 1.
         # - parse catalog
-        if type(catalog) == catlib.Catalog and catalog.has_filename() and \
-          os.path.isfile(catalog.filename) and catalog.xyformat == "fortran":
+        inmemory = check_inmemory(self.config["io"], inmemory)
+        if inmemory and writeto == "tmp":
+            writeto = None
+
+        is_ready = type(catalog) == catlib.Catalog and catalog.xyformat == "fortran"
+        if is_ready and inmemory:
+            is_ready = not filtered or not np.any(catalog.filterout)
+        elif is_ready:
+            is_ready = catalog.has_filename() and os.path.isfile(catalog.filename)
+
+        if is_ready:
             print("Input catalog ready")
             cat = catalog # ready
         else:
             cat = self.get_catalog(catalog, writeto=writeto, filtered=filtered,
                                                 **{**{"xyformat":"fortran"},**kwargs})
-            
+
         catfile = cat.filename
         
         if cat.npoints == 0:
@@ -1105,18 +1520,117 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
                     raise ValueError("Cannot parse given nstars")
             else:
                 ioconfig["nstars"] = nstars
-            
-        inputfile = self.get_piff_inputfile(ioconfig=ioconfig, verbose=verbose)
 
         # 3.
-        # - build stars from the inputfil
-        stars = inputfile.makeStars(logger=self.logger)
-        
+        # - build stars from the images in memory or from the inputfile
+        if inmemory:
+            inputfile = None
+            stars = self.build_stars(cat, ioconfig=ioconfig)
+        else:
+            inputfile = self.get_piff_inputfile(ioconfig=ioconfig, verbose=verbose)
+            stars = inputfile.makeStars(logger=self.logger)
+
         if not fullreturn:
             return stars
 
         return stars, (cat, inputfile)
 
+    def build_stars(self, catalog, ioconfig=None):
+        """ build the piff stars from the loaded images and the catalog data.
+        This does not read nor write any file (see star.build_piffstars()).
+
+        Parameters
+        ----------
+        catalog: [Catalog or CatalogCollection]
+            catalog of the stars in the fortran/fits xyformat.
+            For multiple images, a CatalogCollection with one catalog per image.
+
+        ioconfig: [dict or None] -optional-
+            piff i/o configuration. Uses: stamp_size, nstars, noise, sky_col/sky,
+            gain_col/gain, satur, min_snr, max_snr, flag_col (skip_flag, use_flag),
+            max_mask_pixels, max_edge_frac (stamp_center_size) and reserve_frac (seed).
+            If None, self.config["io"] is used.
+            = other options raise a NotImplementedError (see get_inmemory_unsupported) =
+
+        Returns
+        -------
+        list of piff.Star
+        """
+        from .star import build_piffstars, get_header_value
+        if ioconfig is None:
+            ioconfig = self.config["io"]
+
+        notimplemented = get_inmemory_unsupported(ioconfig)
+        if len(notimplemented) > 0:
+            raise NotImplementedError(f"{notimplemented} i/o options not implemented for in memory stars, use inmemory=False")
+
+        if ioconfig.get("sky_col") is not None and ioconfig.get("sky") is not None:
+            raise ValueError("Cannot provide both sky_col and sky.")
+        if ioconfig.get("gain_col") is not None and ioconfig.get("gain") is not None:
+            raise ValueError("Cannot provide both gain_col and gain.")
+
+        catalogs = catalog.catalogs if catlib.CatalogCollection in catalog.__class__.__mro__ \
+          else [catalog]
+        if len(catalogs) != self.nimgs:
+            raise ValueError(f"{len(catalogs)} catalogs given for {self.nimgs} images.")
+
+        images  = self.get_rawdata()
+        if self.is_single():
+            images = [images]
+
+        headers = self.get_header()
+        wcs, pointing = self.get_wcspointing()
+
+        rng = np.random.default_rng(ioconfig.get("seed", None))
+        reserve_frac = ioconfig.get("reserve_frac", 0)
+        stars = []
+        for chipnum, (cat_, image_, header_) in enumerate(zip(catalogs, images, headers)):
+            catdata = cat_.get_data()
+            xpos = cat_.get_xpos(filtered=False, xyformat="fortran", asserie=False)
+            ypos = cat_.get_ypos(filtered=False, xyformat="fortran", asserie=False)
+            flag_col = ioconfig.get("flag_col")
+            if flag_col is not None: # as piff: skip flag & skip_flag != 0, keep flag & use_flag != 0
+                if flag_col not in catdata:
+                    raise ValueError(f"flag_col = {flag_col} is not a column of the catalog")
+                flag = catdata[flag_col].values.astype(int)
+                use_flag, skip_flag = ioconfig.get("use_flag"), ioconfig.get("skip_flag", -1)
+                skipped = (flag & skip_flag) != 0 if use_flag is None or skip_flag != -1 else False
+                if use_flag is not None:
+                    skipped |= (flag & use_flag) == 0
+                catdata = catdata[~skipped]
+                xpos, ypos = np.asarray(xpos)[~skipped], np.asarray(ypos)[~skipped]
+
+            colprop = {}
+            for key in ["sky", "gain"]:
+                colname = ioconfig.get(f"{key}_col")
+                if colname is not None:
+                    if colname not in catdata:
+                        raise ValueError(f"{key}_col = {colname} is not a column of the catalog")
+                    colprop[key] = catdata[colname].values
+                else:
+                    colprop[key] = get_header_value(ioconfig.get(key), header_)
+
+            stars_ = build_piffstars(image_, xpos, ypos,
+                                     wcs[chipnum], int(ioconfig.get("stamp_size", 32)),
+                                     chipnum=chipnum, pointing=pointing,
+                                     satur=get_header_value(ioconfig.get("satur"), header_),
+                                     noise=ioconfig.get("noise"),
+                                     nstars=ioconfig.get("nstars"),
+                                     min_snr=ioconfig.get("min_snr"),
+                                     max_snr=ioconfig.get("max_snr", 100),
+                                     max_mask_pixels=ioconfig.get("max_mask_pixels"),
+                                     max_edge_frac=ioconfig.get("max_edge_frac"),
+                                     stamp_center_size=ioconfig.get("stamp_center_size", 13),
+                                     index=np.asarray(catdata.index),
+                                     logger=self.logger, **colprop)
+            # reserve a fraction of the stars of each chip, as piff.
+            if reserve_frac and len(stars_) > 0:
+                reserved = rng.choice(len(stars_), int(reserve_frac * len(stars_)), replace=False)
+                for i, star in enumerate(stars_):
+                    star.data.properties['is_reserve'] = i in reserved
+            stars += stars_
+        return stars
+
     def get_gaia_catalog(self, isolation=15, gmag_range=None, writeto=None,
                              shuffled=True, xyformat="fortran", **kwargs):
         """ """
@@ -1177,9 +1691,15 @@ class ZIFF( _ZIFFImageHolder_, catlib._CatalogHolder_  ):
             new_s = self.psf.interpolateStar(self.psf.model.initialize( s ))
             new_s.fit.flux = s.hsm[0]
             new_s.fit.center = (0,0)
-            new_s = self.psf.model.reflux(new_s, fit_center = fit_center)    
             new_stars.append(new_s)
 
+        # - batched reflux if the model has it.
+        if hasattr(self.psf.model, "reflux_stars"):
+            new_stars = self.psf.model.reflux_stars(new_stars, fit_center = fit_center)
+        else:
+            new_stars = [self.psf.model.reflux(new_s, fit_center = fit_center)
+                         for new_s in new_stars]
+
         return new_stars, stars
 
     def run_piff(self, catalog="default",
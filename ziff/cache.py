@@ -0,0 +1,271 @@
+""" Process-level cache of the loaded quadrant inputs (PSFs, ZIFF image holders, Catalogs).
+
+Workers (dask or local pools) often run several tasks on the same quadrant
+(shapes, residual stacks, metapixel fetches). The loaders of this module
+(get_psf, get_ziff, get_catalog) keep the loaded objects in a least-recently-used
+cache keyed by the file path(s) and their modification time (a modified or
+re-compacted file is reloaded), within a byte budget:
+
+    ZIFF_CACHE_MAXBYTES  environment variable (bytes, default 2GB, 0 disables the cache)
+    set_cache_maxbytes() to change it at runtime
+
+The cache is thread safe and an object is loaded once, even when requested concurrently.
+
+= Cached PSF are shared between tasks of a process. ZIFF are returned as per-task copies
+sharing the images (and their image product cache) but with their own psf, config and catalogs.
+Cached Catalogs are returned as copies (their data are modified downstream) =
+"""
+
+import os
+import copy
+import threading
+import numpy as np
+import pandas
+from collections import OrderedDict
+
+CACHE_MAXBYTES = int(os.getenv("ZIFF_CACHE_MAXBYTES", 2*1024**3))
+SIZEOF_DEPTH = 6 # depth of the object attributes inspected by get_nbytes()
+
+def get_file_stamp(filename):
+    """ (filename, mtime_ns, size) of the file, or of its container index
+    if the file has been compacted (see ziff.container).
+    """
+    filename = os.path.abspath(filename) if filename is not None else None
+    if filename is not None and os.path.isfile(filename):
+        stat = os.stat(filename)
+        return (filename, stat.st_mtime_ns, stat.st_size)
+
+    if filename is not None:
+        from .container import get_file_container
+        container = get_file_container(filename)
+        if container is not None:
+            stat = os.stat(container.indexfile)
+            return (filename, stat.st_mtime_ns, stat.st_size)
+
+    return (filename, None, None)
+
+def get_cache_key(kind, filenames, **kwargs):
+    """ hashable cache key for the given object kind, files and loading options """
+    filenames = [filenames] if type(filenames) is str or filenames is None else filenames
+    return (kind, tuple(get_file_stamp(f_) for f_ in filenames),
+                tuple(sorted((k, repr(v)) for k,v in kwargs.items())))
+
+def get_nbytes(obj, depth=SIZEOF_DEPTH, _seen=None):
+    """ approximated memory size of the object: sum of the numpy arrays and dataframes
+    it holds (following containers and attributes down to the given depth).
+    """
+    _seen = set() if _seen is None else _seen
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (pandas.DataFrame, pandas.Series)):
+        return int(obj.memory_usage(index=True, deep=False).sum())
+    if depth<=0 or isinstance(obj, (str, bytes, int, float, type(None))):
+        return 0
+
+    if isinstance(obj, dict):
+        values = obj.values()
+    elif isinstance(obj, (list, tuple, set)):
+        values = obj
+    elif hasattr(obj, "__dict__"):
+        values = vars(obj).values()
+    else:
+        return 0
+    values = list(values) # snapshot, shared objects may be modified by other threads
+
+    return sum(get_nbytes(v_, depth=depth-1, _seen=_seen) for v_ in values)
+
+def set_cache_maxbytes(maxbytes):
+    """ set the byte budget of the process cache (0 disables it) """
+    get_cache().set_maxbytes(maxbytes)
+
+def get_cache():
+    """ the process level ObjectCache """
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = ObjectCache(maxbytes=CACHE_MAXBYTES)
+    return _CACHE
+
+_CACHE = None
+
+# ================ #
+#    Loaders       #
+# ================ #
+def get_psf(filename, logger=None, use_cache=True):
+    """ cached ziff.container.read_psf() (piff.PSF on disk or in a container) """
+    from .container import read_psf
+    if not use_cache:
+        return read_psf(filename, logger=logger)
+
+    return get_cache().get_or_load(get_cache_key("psf", filename),
+                                   read_psf, filename, logger=logger)
+
+def get_ziff(sciimg, mskimg=None, use_cache=True, **kwargs):
+    """ cached ziff.base.ZIFF(sciimg, mskimg, **kwargs).
+
+    = A per-task copy of the cached ZIFF is returned: the images are shared, the psf,
+    config and catalogs are not (set_psf() does not affect other tasks) =
+    """
+    from .base import ZIFF
+    if not use_cache:
+        return ZIFF(sciimg, mskimg, **kwargs)
+
+    ziff = get_cache().get_or_load(get_cache_key("ziff", list(np.atleast_1d(sciimg))+list(np.atleast_1d(mskimg)),
+                                                 **kwargs),
+                                   ZIFF, sciimg, mskimg, **kwargs)
+    return _copy_ziff_(ziff)
+
+def get_catalog(filename, wcs=None, use_cache=True, **kwargs):
+    """ cached ziff.catalog.Catalog.load(filename, **kwargs) with the given wcs.
+
+    = A copy of the cached catalog is returned =
+    """
+    from .catalog import Catalog
+    if not use_cache:
+        return Catalog.load(filename, wcs=wcs, **kwargs)
+
+    cat = get_cache().get_or_load(get_cache_key("catalog", filename, **kwargs),
+                                  Catalog.load, filename, **kwargs)
+    cat = _copy_catalog_(cat)
+    if wcs is not None:
+        cat.set_wcs(wcs)
+    return cat
+
+def _copy_catalog_(cat):
+    """ shallow copy of the catalog with its own data (dataframes and filters) """
+    copied = cat.__class__.__new__(cat.__class__)
+    copied.__dict__.update({k: v.copy() if isinstance(v, (pandas.DataFrame, pandas.Series, dict)) else v
+                                for k,v in vars(cat).items()})
+    return copied
+
+def _copy_ziff_(ziff):
+    """ shallow copy of the ZIFF sharing its images and image product cache,
+    with its own config and catalogs and without psf.
+    """
+    copied = ziff.__class__.__new__(ziff.__class__)
+    copied.__dict__.update({k: v for k,v in vars(ziff).items() if k not in ["_psf", "_fitcatalog"]})
+    if "_config" in vars(ziff):
+        copied._config = copy.deepcopy(ziff._config)
+    if "_catalog" in vars(ziff):
+        copied._catalog = {k: _copy_catalog_(v) for k,v in ziff._catalog.items()}
+    return copied
+
+# ================ #
+#    Classes       #
+# ================ #
+class ObjectCache( object ):
+    """ least-recently-used cache of python objects within a byte budget """
+
+    def __init__(self, maxbytes=CACHE_MAXBYTES):
+        """ """
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._loading = {} # key -> lock held while loading this key
+        self._nhits = 0
+        self._nmisses = 0
+        self.set_maxbytes(maxbytes)
+
+    # ------- #
+    # SETTER  #
+    # ------- #
+    def set_maxbytes(self, maxbytes):
+        """ set the byte budget and evict the least recently used entries accordingly """
+        with self._lock:
+            self._maxbytes = int(maxbytes)
+            self._evict_()
+
+    def set(self, key, obj, nbytes=None):
+        """ add (or replace) the given entry, evicting the least recently used ones.
+        Objects larger than the budget are not cached.
+        """
+        nbytes = get_nbytes(obj) if nbytes is None else nbytes
+        with self._lock:
+            self._entries.pop(key, None)
+            if nbytes > self.maxbytes:
+                return
+            self._entries[key] = [obj, nbytes]
+            self._evict_()
+
+    def clear(self):
+        """ drop all entries """
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def _evict_(self):
+        """ (to be called with the lock held) """
+        while len(self._entries)>0 and self.nbytes > self.maxbytes:
+            self._entries.popitem(last=False)
+
+    # ------- #
+    # GETTER  #
+    # ------- #
+    def has(self, key):
+        """ """
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """ cached object (marked as most recently used), default if not cached.
+        The entry size is updated (lazy objects grow once used).
+        """
+        with self._lock:
+            if key not in self._entries:
+                self._nmisses += 1
+                return default
+
+            self._nhits += 1
+            self._entries.move_to_end(key)
+            entry = self._entries[key]
+            entry[1] = get_nbytes(entry[0])
+            self._evict_()
+            return entry[0]
+
+    def get_or_load(self, key, loader, *args, **kwargs):
+        """ cached object or loader(*args, **kwargs), which is then cached.
+        Concurrent requests of the same key wait for a single load.
+        """
+        with self._lock:
+            if key in self._entries:
+                return self.get(key)
+            keylock = self._loading.setdefault(key, threading.Lock())
+
+        with keylock:
+            with self._lock:
+                if key in self._entries: # loaded while waiting
+                    return self.get(key)
+                self._nmisses += 1
+            try:
+                obj = loader(*args, **kwargs)
+                self.set(key, obj)
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+        return obj
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def maxbytes(self):
+        """ byte budget of the cache """
+        return self._maxbytes
+
+    @property
+    def nbytes(self):
+        """ current (approximated) size of the cached objects """
+        with self._lock:
+            return sum(entry[1] for entry in self._entries.values())
+
+    @property
+    def nentries(self):
+        """ number of cached objects """
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def stats(self):
+        """ dict of cache usage statistics """
+        return {"nentries":self.nentries, "nbytes":self.nbytes, "maxbytes":self.maxbytes,
+                "hits":self._nhits, "misses":self._nmisses}
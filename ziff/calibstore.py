@@ -0,0 +1,343 @@
+""" Local HEALPix-tiled calibrator (gaia, ps1) store.
+
+The store is a directory of parquet tiles, one per HEALPix (nested) pixel:
+{dirpath}/{catname}/order{order}/hpx{pixel}.parquet
+"""
+
+import os
+import json
+import numpy as np
+import pandas
+
+STORE_ORDER = 5 # nside=32, ~1.8 deg pixels, about 4 tiles per quadrant query
+RADEC_KEYS = {"ra": ["RA_ICRS", "RA", "ra", "raMean"],
+              "dec": ["DE_ICRS", "DE", "de", "DEC", "dec", "decMean"]}
+
+
+def get_store_dir(dirpath=None):
+    """ directory of the calibrator store.
+    $ZIFF_CALIBSTORE if defined, {ZIFFDIR}/calibrators otherwise. """
+    if dirpath is not None:
+        return dirpath
+    if "ZIFF_CALIBSTORE" in os.environ:
+        return os.environ["ZIFF_CALIBSTORE"]
+
+    from .io import ZIFFDIR
+    return os.path.join(ZIFFDIR, "calibrators")
+
+# ============= #
+#   HEALPix     #
+# ============= #
+def radec_to_healpix(ra, dec, order=STORE_ORDER):
+    """ nested HEALPix pixel index of the given coordinates (in deg).
+    (same as healpy.ang2pix(2**order, ra, dec, nest=True, lonlat=True)) """
+    nside = 2**order
+    z = np.sin(np.radians(np.asarray(dec, dtype="float")))
+    tt = np.mod(np.radians(np.asarray(ra, dtype="float")), 2*np.pi) * 2/np.pi # [0,4)
+    z, tt = np.broadcast_arrays(np.atleast_1d(z), np.atleast_1d(tt))
+    za = np.abs(z)
+    face = np.zeros(z.shape, dtype="int64")
+    ix, iy = np.zeros(z.shape, dtype="int64"), np.zeros(z.shape, dtype="int64")
+
+    # - equatorial region
+    eq = za <= 2/3
+    temp1, temp2 = nside*(0.5+tt[eq]), nside*z[eq]*0.75
+    jp, jm = (temp1-temp2).astype("int64"), (temp1+temp2).astype("int64")
+    ifp, ifm = jp//nside, jm//nside
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm+8))
+    ix[eq] = jm & (nside-1)
+    iy[eq] = nside - (jp & (nside-1)) - 1
+
+    # - polar caps
+    pol = ~eq
+    ntt = np.minimum(3, tt[pol].astype("int64"))
+    tp = tt[pol] - ntt
+    tmp = nside*np.sqrt(3*(1-za[pol]))
+    jp = np.minimum((tp*tmp).astype("int64"), nside-1)
+    jm = np.minimum(((1-tp)*tmp).astype("int64"), nside-1)
+    north = z[pol] >= 0
+    face[pol] = np.where(north, ntt, ntt+8)
+    ix[pol] = np.where(north, nside-jm-1, jp)
+    iy[pol] = np.where(north, nside-jp-1, jm)
+
+    # - bit interleaving (x on even, y on odd bits)
+    pix = np.zeros(z.shape, dtype="int64")
+    for b in range(order):
+        pix |= ((ix >> b) & 1) << (2*b) | ((iy >> b) & 1) << (2*b+1)
+
+    return face*nside**2 + pix
+
+def get_cone_healpix(ra, dec, radius, order=STORE_ORDER):
+    """ HEALPix (nested) pixels overlapping the cone (inclusive).
+
+    The disc, enlarged by a pixel size, is sampled at a quarter of the pixel size.
+
+    Parameters
+    ----------
+    ra, dec, radius: [float]
+        cone center and radius [in deg]
+
+    Returns
+    -------
+    array of pixel index
+    """
+    pixsize = np.degrees(np.sqrt(4*np.pi/(12*4**order)))
+    rmax = np.radians(radius + pixsize)
+    step = np.radians(pixsize/4)
+    # rings of points around the pole, then rotated to (ra, dec)
+    theta = np.arange(0, rmax+step, step)
+    thetas, phis = [], []
+    for theta_ in theta:
+        nphi = max(1, int(np.ceil(2*np.pi*np.sin(theta_)/step)))
+        thetas.append(np.full(nphi, theta_))
+        phis.append(np.linspace(0, 2*np.pi, nphi, endpoint=False))
+    theta, phi = np.concatenate(thetas), np.concatenate(phis)
+    ra0, dec0 = np.radians(ra), np.radians(dec)
+    sindec = np.sin(dec0)*np.cos(theta) + np.cos(dec0)*np.sin(theta)*np.cos(phi)
+    dec_ = np.arcsin(np.clip(sindec, -1, 1))
+    ra_ = ra0 + np.arctan2(np.sin(phi)*np.sin(theta)*np.cos(dec0),
+                           np.cos(theta) - np.sin(dec0)*sindec)
+    return np.unique(radec_to_healpix(np.degrees(ra_), np.degrees(dec_), order=order))
+
+def _get_separation_(ra, dec, ra0, dec0):
+    """ angular distance [deg] """
+    ra, dec, ra0, dec0 = [np.radians(np.asarray(k_, dtype="float")) for k_ in [ra, dec, ra0, dec0]]
+    sindra, sinddec = np.sin((ra-ra0)/2), np.sin((dec-dec0)/2)
+    return np.degrees(2*np.arcsin(np.sqrt(sinddec**2 + np.cos(dec)*np.cos(dec0)*sindra**2)))
+
+def _parse_column_filters_(dataframe, column_filters):
+    """ boolean selection of vizier like column_filters ({'Gmag': '10..20'}) """
+    flag = np.ones(len(dataframe), dtype="bool")
+    if column_filters is None:
+        return flag
+
+    for key, value in column_filters.items():
+        if type(value) is str and ".." in value:
+            vmin, vmax = value.split("..")
+            if vmin.strip() != "":
+                flag &= (dataframe[key] >= float(vmin)).values
+            if vmax.strip() != "":
+                flag &= (dataframe[key] <= float(vmax)).values
+        elif type(value) is str and value[0] in "<>":
+            flag &= (dataframe[key] < float(value[1:])).values if value[0] == "<" \
+              else (dataframe[key] > float(value[1:])).values
+        else:
+            flag &= (dataframe[key] == value).values
+
+    return flag
+
+# ============= #
+#   Store       #
+# ============= #
+class CalibratorStore( object ):
+    """ local HEALPix tiled calibrator catalog """
+
+    def __init__(self, catname="gaia", dirpath=None, order=STORE_ORDER):
+        """
+        Parameters
+        ----------
+        catname: [string] -optional-
+            name of the catalog (subdirectory), e.g. I/350/gaiaedr3 or ps1cal
+
+        dirpath: [string or None] -optional-
+            root of the store (see get_store_dir())
+
+        order: [int] -optional-
+            HEALPix order of the tiles (nside=2**order)
+        """
+        self._catname = catname
+        self._dirpath = get_store_dir(dirpath)
+        self._order = order
+
+    # ------- #
+    #  I/O    #
+    # ------- #
+    def import_catalog(self, data, racol=None, deccol=None, index_col=None, columns=None,
+                           **kwargs):
+        """ add the given catalog data to the store.
+
+        Entries are appended to existing tiles; duplicated index are replaced.
+
+        Parameters
+        ----------
+        data: [DataFrame or string or list of]
+            catalog dataframe or files (parquet, csv, fits) to import.
+
+        racol, deccol: [string or None] -optional-
+            ra and dec columns. Guessed if None (see RADEC_KEYS)
+
+        index_col: [string or None] -optional-
+            column to use as index (e.g. Source). Dataframe index kept if None.
+
+        columns: [list or None] -optional-
+            columns to store. All if None.
+
+        **kwargs goes to the file reader (when data are files)
+
+        Returns
+        -------
+        list of written tiles
+        """
+        if type(data) is not pandas.DataFrame:
+            written = []
+            for filename in np.atleast_1d(data):
+                written += self.import_catalog(_read_catalog_file_(filename, **kwargs),
+                                               racol=racol, deccol=deccol,
+                                               index_col=index_col, columns=columns)
+            return list(np.unique(written))
+
+        if index_col is not None:
+            data = data.set_index(index_col)
+        racol = _guess_key_(data, "ra") if racol is None else racol
+        deccol = _guess_key_(data, "dec") if deccol is None else deccol
+        if columns is not None:
+            data = data[list(np.unique([racol, deccol] + list(columns)))]
+
+        os.makedirs(self.tiledir, exist_ok=True)
+        self._write_metadata_(racol, deccol)
+        pixels = radec_to_healpix(data[racol].values, data[deccol].values, order=self.order)
+        written = []
+        for pix, tile in data.groupby(pixels):
+            filename = self.get_tilefile(pix)
+            if os.path.isfile(filename):
+                tile = pandas.concat([pandas.read_parquet(filename), tile])
+                tile = tile[~tile.index.duplicated(keep="last")]
+            tile.to_parquet(filename)
+            written.append(filename)
+
+        return written
+
+    def _write_metadata_(self, racol, deccol):
+        """ """
+        with open(self.metafile, "w") as fmeta:
+            json.dump({"catname":self.catname, "order":self.order,
+                       "racol":racol, "deccol":deccol}, fmeta)
+
+    # ------- #
+    # GETTER  #
+    # ------- #
+    def get_tilefile(self, pixel):
+        """ parquet file of the given HEALPix pixel """
+        return os.path.join(self.tiledir, f"hpx{int(pixel)}.parquet")
+
+    def get_cone_tiles(self, ra, dec, radius):
+        """ existing tile files overlapping the cone (in deg) """
+        files = [self.get_tilefile(pix_) for pix_ in get_cone_healpix(ra, dec, radius,
+                                                                       order=self.order)]
+        return [f_ for f_ in files if os.path.isfile(f_)]
+
+    def query_cone(self, ra, dec, radius, r_unit="deg", column_filters=None, columns=None):
+        """ catalog entries within the cone.
+
+        Parameters
+        ----------
+        ra, dec: [float]
+            center of the cone [in deg]
+
+        radius: [float]
+            radius of the cone (in r_unit)
+
+        r_unit: [string] -optional-
+            unit of the radius (astropy.units)
+
+        column_filters: [dict or None] -optional-
+            vizier like selection, e.g. {'Gmag': '10..20'}
+
+        columns: [list or None] -optional-
+            columns to return (all if None)
+
+        Returns
+        -------
+        DataFrame
+        """
+        if not self.has_data():
+            raise IOError(f"No local {self.catname} calibrator store in {self.tiledir}. "+
+                          "Use import_catalog() first.")
+
+        from astropy import units
+        radius = (radius*units.Unit(r_unit)).to_value("deg")
+        meta = self.metadata
+        tiles = self.get_cone_tiles(ra, dec, radius)
+        if len(tiles) == 0: # empty, but with the store columns
+            return pandas.read_parquet(_any_file_(self.tiledir), columns=columns).iloc[:0]
+
+        readcols = None if columns is None else \
+          list(np.unique([meta["racol"], meta["deccol"]] + list(columns) +
+                         list(column_filters.keys() if column_filters is not None else [])))
+        data = pandas.concat([pandas.read_parquet(f_, columns=readcols) for f_ in tiles])
+        flag = _get_separation_(data[meta["racol"]], data[meta["deccol"]], ra, dec) <= radius
+        flag &= _parse_column_filters_(data, column_filters)
+        data = data[flag]
+        return data if columns is None else data[columns]
+
+    def has_data(self):
+        """ test if the store contains this catalog """
+        return os.path.isfile(self.metafile)
+
+    # =============== #
+    #   Properties    #
+    # =============== #
+    @property
+    def catname(self):
+        """ name of the catalog """
+        return self._catname
+
+    @property
+    def order(self):
+        """ HEALPix order of the tiles """
+        return self._order
+
+    @property
+    def tiledir(self):
+        """ directory of the tiles """
+        return os.path.join(self._dirpath, self.catname.replace("/", "_"), f"order{self.order}")
+
+    @property
+    def metafile(self):
+        """ json metadata file of the store """
+        return os.path.join(self.tiledir, "metadata.json")
+
+    @property
+    def metadata(self):
+        """ metadata (catname, order, racol, deccol) """
+        if not hasattr(self, "_metadata"):
+            with open(self.metafile) as fmeta:
+                self._metadata = json.load(fmeta)
+        return self._metadata
+
+# ============= #
+#  Functions    #
+# ============= #
+def query_local_catalog(ra, dec, radius, r_unit="deg", catname="gaia", column_filters=None,
+                            dirpath=None, order=STORE_ORDER, columns=None):
+    """ cone query of the local calibrator store (see CalibratorStore.query_cone) """
+    return CalibratorStore(catname, dirpath=dirpath, order=order
+                           ).query_cone(ra, dec, radius, r_unit=r_unit,
+                                        column_filters=column_filters, columns=columns)
+
+def import_calibrators(data, catname="gaia", dirpath=None, order=STORE_ORDER, **kwargs):
+    """ pre-populate the local calibrator store (see CalibratorStore.import_catalog) """
+    return CalibratorStore(catname, dirpath=dirpath, order=order).import_catalog(data, **kwargs)
+
+def _read_catalog_file_(filename, **kwargs):
+    """ """
+    if filename.endswith(".parquet"):
+        return pandas.read_parquet(filename, **kwargs)
+    if filename.endswith(".csv"):
+        return pandas.read_csv(filename, **kwargs)
+    if filename.endswith((".fits", ".fits.gz", ".fit")):
+        from astropy.table import Table
+        return Table.read(filename, **kwargs).to_pandas()
+
+    raise NotImplementedError(f"Only parquet, csv and fits files implemented, {filename} given")
+
+def _guess_key_(dataframe, which):
+    """ """
+    keys = [k_ for k_ in RADEC_KEYS[which] if k_ in dataframe.columns]
+    if len(keys) == 0:
+        raise ValueError(f"Cannot guess the {which} column, please provide it.")
+    return keys[0]
+
+def _any_file_(dirpath):
+    """ """
+    return [os.path.join(dirpath, f_) for f_ in os.listdir(dirpath) if f_.endswith(".parquet")][0]
@@ -3,6 +3,7 @@
 
 import os
 import copy
+import json
 import warnings
 
 import pandas
@@ -13,12 +14,18 @@ from astropy.io import fits #as aio
 from astropy.coordinates import Angle, SkyCoord, search_around_sky
 
 # out for Dask
-from .utils import avoid_duplicate
+from .utils import avoid_duplicate, get_stamp_statistics, STAMP_STATISTICS
 from ztfimg.stamps import stamp_it
 
 from ztfquery.io import CCIN2P3
 _CC = CCIN2P3(connect=False)
 
+# pandas copy-on-write: shallow copies are lazy snapshots (default from pandas 3)
+try:
+    PANDAS_COW = int(pandas.__version__.split(".")[0]) >= 3 or pandas.get_option("mode.copy_on_write") is True
+except Exception:
+    PANDAS_COW = False
+
 
 def fetch_ziff_catalog(ziff, which="gaia", as_collection=True, **kwargs):
     """ High level function that fetch the `which` catalog data for the given ziff.
@@ -56,7 +63,7 @@ def fetch_gaia_catalog(ra, dec, radius= 0.75, r_unit="deg",
                         catname="I/350/gaiaedr3",
                         **kwargs):
     """ query online gaia-catalog in Vizier (I/350/gaiaedr3, eDR3) using astroquery.
-    This function requieres an internet connection.
+    This function requieres an internet connection, unless queryhost="local".
         
     Parameters
     ----------
@@ -79,6 +86,11 @@ def fetch_gaia_catalog(ra, dec, radius= 0.75, r_unit="deg",
     Selection criterium for the queried catalog.
     (we have chosen G badn, it coers from 300 to 1000 nm in wavelength)
 
+    queryhost: [string] -optional-
+    - vizier: astroquery Vizier query
+    - ccin2p3: ccin2p3 catalog service
+    - local: local HEALPix tiled calibrator store (see ziff.calibstore)
+
     **kwargs goes to Catalog.__init__
 
     Returns
@@ -91,9 +103,47 @@ def fetch_gaia_catalog(ra, dec, radius= 0.75, r_unit="deg",
                                              catname=catname)
     elif queryhost == "ccin2p3":
         df = _CC.query_catalog(ra, dec, radius, catname=catname, depth=7, **kwargs)
+    elif queryhost == "local":
+        from .calibstore import query_local_catalog
+        df = query_local_catalog(ra, dec, radius, r_unit=r_unit, catname=catname,
+                                 column_filters=column_filters)
+    else:
+        raise NotImplementedError(f"queryhost {queryhost} not implemented, vizier, ccin2p3 or local available")
     
     return Catalog(dataframe=df, name=name, **kwargs)
 
+def fetch_ps1_catalog(ra, dec, radius= 0.75, r_unit="deg",
+                        column_filters=None, name="ps1",
+                        queryhost="local", catname="ps1cal",
+                        **kwargs):
+    """ query the ps1 calibrator catalog.
+    Only available from the local calibrator store (see ziff.calibstore)
+
+    Parameters
+    ----------
+    ra, dec: [float]
+        center of the Catalog [in degree]
+
+    radius: [float]
+        radius of the region to query (in r_unit)
+
+    column_filters: [dict] -optional-
+        Selection criterium for the queried catalog (e.g. {'gmag': '14..20'})
+
+    **kwargs goes to Catalog.__init__
+
+    Returns
+    -------
+    PS1 Catalog (child of Catalog)
+    """
+    if queryhost != "local":
+        raise NotImplementedError(f"queryhost {queryhost} not implemented for ps1, only local available")
+
+    from .calibstore import query_local_catalog
+    df = query_local_catalog(ra, dec, radius, r_unit=r_unit, catname=catname,
+                             column_filters=column_filters)
+    return Catalog(dataframe=df, name=name, **kwargs)
+
 
 def _fetch_gaia_catalog_vizier_(ra, dec, radius= 0.75, r_unit="deg",
                                     column_filters={'Gmag': '10..20'},
@@ -143,51 +193,76 @@ def _fetch_gaia_catalog_vizier_(ra, dec, radius= 0.75, r_unit="deg",
     
     return gaiatable.to_pandas().set_index('Source')
 
-def dataframe_to_hdu(dataframe, drop_notimplemented=True):
-    """ converts a dataframe into a fits.BinTableHDU """
-    # L: Logical (Boolean)
-    # B: Unsigned Byte
-    # I: 16-bit Integer
-    # J: 32-bit Integer
-    # K: 64-bit Integer
-    # E: Single-precision Floating Point
-    # D: Double-precision Floating Point
-    # C: Single-precision Complex
-    # M: Double-precision Complex
-    # A: Character
-    
-    cols = []
+def _get_chord_(seplimit):
+    """ unit-sphere chord length of the angular separation (arcsec if float) """
+    seplimit = seplimit.to_value(units.rad) if hasattr(seplimit, "unit") \
+      else np.radians(seplimit/3600)
+    return 2*np.sin(seplimit/2)
+
+def _flatten_neighbors_(neighbors):
+    """ list of neighbor lists (cKDTree.query_ball_point) -> query_idx, tree_idx """
+    lengths = np.asarray([len(l_) for l_ in neighbors], dtype="int")
+    tree_idx = np.concatenate([np.asarray(l_, dtype="int") for l_ in neighbors]) \
+      if len(neighbors)>0 else np.asarray([], dtype="int")
+    return np.repeat(np.arange(len(neighbors)), lengths), tree_idx
+
+def dataframe_to_recarray(dataframe, drop_notimplemented=True):
+    """ converts a dataframe (and its index) into a native byte order numpy record array.
+    ints -> int64, floats -> float64 (NA as NaN), bools -> bool (NA as False), strings -> bytes.
+    """
     df = dataframe.reset_index()
+    arrays, dtypes = [], []
     for _key in df.keys():
         type_ = str(df[_key].dtype).lower()
-        
-        if type_ == "object":
+        if type_ == "object" or not any(k_ in type_ for k_ in ["int", "float", "bool", "str"]):
             if drop_notimplemented:
                 warnings.warn(f"column type {type_} conversion to fits format not implemented | {_key} droped")
                 continue
             raise NotImplementedError(f"column type {type_} conversion to fits format not implemented")
         
         if "int" in type_:
-            format = 'K'
-            value = df[_key].astype('int')
+            value = df[_key].to_numpy(dtype="int64")
         elif "float" in type_:
-            format = 'D'
-            value = df[_key].astype('float')
+            value = df[_key].to_numpy(dtype="float64", na_value=np.nan)
         elif 'bool' in type_:
-            format = 'L'
-            value = df[_key].astype('bool')
-        elif 'str' in type_:
-            format = 'A'
-            value = df[_key].astype('string')
+            value = df[_key].to_numpy(dtype="bool", na_value=False)
         else:
-            if drop_notimplemented:
-                warnings.warn(f"column type {type_} conversion to fits format not implemented | {_key} droped")
-                continue
-            raise NotImplementedError(f"column type {type_} conversion to fits format not implemented")
-        
-        cols.append(fits.Column(name=_key, array=value, format=format, ascii=False))
+            value = np.asarray(df[_key].fillna("").astype(str), dtype="bytes")
             
-    return fits.BinTableHDU.from_columns(cols)
+        arrays.append(value)
+        dtypes.append((str(_key), value.dtype))
+
+    data = np.empty(len(df), dtype=dtypes)
+    for (key_, _), value in zip(dtypes, arrays):
+        data[key_] = value
+    return data.view(np.recarray)
+    
+def dataframe_to_hdu(dataframe, drop_notimplemented=True):
+    """ converts a dataframe into a fits.BinTableHDU 
+    (built at once from dataframe_to_recarray())
+    """
+    # L: Logical (Boolean)
+    # K: 64-bit Integer
+    # D: Double-precision Floating Point
+    # A: Character
+    return fits.BinTableHDU(data=dataframe_to_recarray(dataframe,
+                                                       drop_notimplemented=drop_notimplemented))
+
+def recarray_to_dataframe(data, index_col=None):
+    """ converts a (fits) record array into a DataFrame (native byte order, decoded strings) """
+    columns = {}
+    for key_ in data.dtype.names:
+        value = np.asarray(data[key_])
+        if value.dtype.kind == "S":
+            value = np.char.decode(value, "utf-8")
+        elif not value.dtype.isnative:
+            value = value.astype(value.dtype.newbyteorder("="))
+        columns[key_] = value
+        
+    dataframe = pandas.DataFrame(columns)
+    if index_col is not None:
+        dataframe = dataframe.set_index(index_col)
+    return dataframe
 
     
 ######################
@@ -196,6 +271,9 @@ def dataframe_to_hdu(dataframe, drop_notimplemented=True):
 #                    #
 ######################
 class Catalog(object):
+
+    _MAX_FILTERS = 63 # number of filter bits of the int64 filterbits column
+    _ARROW_METAKEY = b"ziff" # parquet/feather schema metadata key
     
     def __init__(self, dataframe=None, name=None, wcs=None, header=None, mask=None,
                      xyformat=None, filename=None):
@@ -252,6 +330,16 @@ class Catalog(object):
                                      header=header, mask=mask, **kwargs)
 
         filename = filename[0]
+        if not os.path.isfile(filename):
+            # compacted quadrant outputs (see ziff.container)
+            from .container import get_file_container
+            container = get_file_container(filename)
+            if container is not None:
+                this = container.read_catalog(filename, name=name, wcs=wcs, mask=mask, **kwargs)
+                if header is not None:
+                    this.set_header(header)
+                return this
+            
         extension = filename.split(".")[-1]
         if extension in ["csv"]:
             return cls.read_cvs(filename, name=name, wcs=wcs, header=header, mask=mask, **kwargs)
@@ -259,7 +347,13 @@ class Catalog(object):
         if extension in ["fits"]:
             return cls.read_fits(filename, name=name, wcs=wcs, header=header, mask=mask, **kwargs)
 
-        raise ValueError("only csv and fits loading implemented.")
+        if extension in ["parquet", "pq"]:
+            return cls.read_parquet(filename, name=name, wcs=wcs, header=header, mask=mask, **kwargs)
+
+        if extension in ["feather", "arrow"]:
+            return cls.read_feather(filename, name=name, wcs=wcs, header=header, mask=mask, **kwargs)
+        
+        raise ValueError("only csv, fits, parquet and feather loading implemented.")
             
     @classmethod
     def read_cvs(cls, filename, name="catalog", index_col=None, readprop={}, **kwargs):
@@ -271,18 +365,67 @@ class Catalog(object):
     def read_fits(cls, filename, dataext=1, headerext=None, name="catalog",
                       index_col='Source', **kwargs):
         """ """
-        from astropy import table
         data = fits.getdata(filename, ext=dataext)
         if headerext is None:
             headerext = dataext
         header = fits.getheader(filename, ext=headerext)
-        dataframe = table.Table(data).to_pandas()
-        if index_col is not None:
-            dataframe = dataframe.set_index(index_col)
-            
+        dataframe = recarray_to_dataframe(data, index_col=index_col)
         this = cls(dataframe, name=name, filename=filename, **kwargs)
         this.set_header(header)
         return this
+
+    @classmethod
+    def read_parquet(cls, filename, name=None, columns=None, memory_map=True, **kwargs):
+        """ loads a catalog stored with to_parquet() (or any parquet file).
+        name, xyformat, filters and header are restored from the file metadata.
+        = as for any catalog, the data dtypes then go through convert_dtypes() (see set_data) =
+
+        Parameters
+        ----------
+        filename: [string]
+            parquet file
+
+        columns: [list or None] -optional-
+            only read these columns (all if None)
+
+        memory_map: [bool] -optional-
+            memory map the file while reading (pyarrow)
+
+        **kwargs goes to __init__ (wcs, header, mask, xyformat)
+
+        Returns
+        -------
+        Catalog
+        """
+        import pyarrow.parquet as pq
+        table = pq.read_table(filename, columns=columns, memory_map=memory_map)
+        return cls._from_arrow_(table, filename, name=name, **kwargs)
+
+    @classmethod
+    def read_feather(cls, filename, name=None, columns=None, memory_map=True, **kwargs):
+        """ loads a catalog stored with to_feather() (arrow IPC file).
+        Uncompressed files are memory mapped without copy.
+        (see read_parquet() for the parameters)
+        """
+        from pyarrow import feather
+        table = feather.read_table(filename, columns=columns, memory_map=memory_map)
+        return cls._from_arrow_(table, filename, name=name, **kwargs)
+
+    @classmethod
+    def _from_arrow_(cls, table, filename, name=None, header=None, xyformat=None, **kwargs):
+        """ builds the catalog from a pyarrow.Table and its ziff metadata """
+        meta = json.loads(table.schema.metadata.get(cls._ARROW_METAKEY, b"{}")) \
+          if table.schema.metadata is not None else {}
+        if header is None and meta.get("header") is not None:
+            header = fits.Header.fromstring(meta["header"])
+            
+        this = cls(table.to_pandas(),
+                   name=meta.get("name", "catalog") if name is None else name,
+                   xyformat=meta.get("xyformat") if xyformat is None else xyformat,
+                   header=header, filename=filename, **kwargs)
+        if len(meta.get("filters", {}))>0:
+            this._filters = meta["filters"]
+        return this
     
     @classmethod
     def read_psfcat(cls, psfcat, name="ztfcat"):
@@ -317,8 +460,12 @@ class Catalog(object):
             self.to_fits(savefile, filtered=filtered, overwrite=overwrite, store_filename=store_filename,**kwargs)
         elif extension in ["csv",".csv"]:
             self.to_csv(savefile, filtered=filtered, overwrite=overwrite, store_filename=store_filename, **kwargs)
+        elif extension in ["parquet",".parquet","pq",".pq"]:
+            self.to_parquet(savefile, filtered=filtered, overwrite=overwrite, store_filename=store_filename, **kwargs)
+        elif extension in ["feather",".feather","arrow",".arrow"]:
+            self.to_feather(savefile, filtered=filtered, overwrite=overwrite, store_filename=store_filename, **kwargs)
         else:
-            raise ValueError("Only fits and csv format implemented")
+            raise ValueError("Only fits, csv, parquet and feather format implemented")
 
     def to_fits(self, savefile, header=None, filtered=True, overwrite=False, shuffled=False, store_filename=True):
         """ Store the catalog as a fits file. 
@@ -342,8 +489,9 @@ class Catalog(object):
         
         # - Primary
         hdul.append(fits.PrimaryHDU([], header))
-        # - Data
-        hdul.append( self.get_data(filtered=filtered, as_hdu=True, shuffled=shuffled) )
+        # - Data (filterbits are meaningless without the filter definitions, see to_parquet)
+        hdul.append( dataframe_to_hdu(self.get_data(filtered=filtered, shuffled=shuffled
+                                                    ).drop(columns="filterbits", errors="ignore")) )
         # -> out
         hdul = fits.HDUList(hdul)
         
@@ -353,11 +501,63 @@ class Catalog(object):
             
         return out
 
+    def to_parquet(self, savefile, filtered=True, overwrite=False, shuffled=False, store_filename=True,
+                       compression="snappy", **kwargs):
+        """ Store the catalog as a parquet file. 
+        The dtypes, index, name, xyformat, filters and header are stored (see read_parquet)
+        
+        Parameters
+        ----------
+        compression: [string or None] -optional-
+            parquet compression codec.
+
+        **kwargs goes to pyarrow.parquet.write_table()
+        """
+        import pyarrow.parquet as pq
+        if os.path.isfile(savefile) and not overwrite:
+            raise IOError(f"Cannot overwrite {savefile}")
+        
+        out = pq.write_table(self._to_arrow_(filtered=filtered, shuffled=shuffled), savefile,
+                             compression=compression, **kwargs)
+        if store_filename:
+            self.set_filename(savefile)
+        return out
+
+    def to_feather(self, savefile, filtered=True, overwrite=False, shuffled=False, store_filename=True,
+                       compression="uncompressed", **kwargs):
+        """ Store the catalog as a feather (arrow IPC) file. 
+        Uncompressed (default) files are memory-mapped at read (see read_feather).
+
+        **kwargs goes to pyarrow.feather.write_feather()
+        """
+        from pyarrow import feather
+        if os.path.isfile(savefile) and not overwrite:
+            raise IOError(f"Cannot overwrite {savefile}")
+        
+        out = feather.write_feather(self._to_arrow_(filtered=filtered, shuffled=shuffled), savefile,
+                                    compression=compression, **kwargs)
+        if store_filename:
+            self.set_filename(savefile)
+        return out
+
+    def _to_arrow_(self, filtered=True, shuffled=False):
+        """ pyarrow.Table of the data with the ziff metadata """
+        import pyarrow
+        table = pyarrow.Table.from_pandas(self.get_data(filtered=filtered, shuffled=shuffled))
+        header = self.header
+        meta = {"name": self.name,
+                "xyformat": getattr(self, "_xyformat", None),
+                "filters": self._filters,
+                "header": header.tostring() if header is not None else None}
+        return table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                              self._ARROW_METAKEY: json.dumps(meta).encode()})
+        
     def to_csv(self, savefile, filtered=True, overwrite=False, shuffled=False, store_filename=True, **kwargs):
         """ """
         if os.path.isfile(savefile) and not overwrite:
             raise IOError(f"Cannot overwrite {savefile}")
-        df = self.get_data(filtered=filtered, shuffled=shuffled).reset_index()
+        df = self.get_data(filtered=filtered, shuffled=shuffled
+                           ).drop(columns="filterbits", errors="ignore").reset_index()
         out = df.to_csv(savefile, **kwargs)
         if store_filename:
             self.set_filename(savefile)
@@ -382,16 +582,22 @@ class Catalog(object):
             except:
                 raise TypeError("The input dataframe is not a DataFrame and cannot be converted into one.")
 
-        # reshaped:
-        self._data = pandas.DataFrame(dataframe.values.byteswap().newbyteorder(),
-                                      index=dataframe.index, columns=dataframe.columns
-                                     ).convert_dtypes() # fixes object dtype issues
+        self.clear_spatialindex()
+        self.touch_data()
+        # native byte order (fits data are big-endian), column by column
+        tonative = {k: dt.newbyteorder("=") for k, dt in dataframe.dtypes.items()
+                    if isinstance(dt, np.dtype) and not dt.isnative}
+        if len(tonative)>0:
+            dataframe = dataframe.astype(tonative)
+        self._data = dataframe.convert_dtypes() # fixes object dtype issues
                                      
         if "Int64" in np.asarray(self._data.dtypes, dtype="str"):
             self._data.astype(self._data.dtypes.replace('Int64','int64')) # avoids warnings
             
         if 'filterout' not in self._data.columns:
             self._data['filterout'] = False
+        if 'filterbits' not in self._data.columns:
+            self._data['filterbits'] = np.zeros(len(self._data), dtype="int64")
     
     def set_wcs(self, wcs):
         """ Attach an astropy WCS solution to the catalog. """
@@ -405,6 +611,8 @@ class Catalog(object):
             self._header = fits.Header(header)
         elif type(header) is not fits.Header:
             raise TypeError(f"input header must be a dict or a fits.Header, {type(header)} given.")
+        else:
+            self._header = header
 
     def set_mask(self, mask):
         """ set the column corresponding to the entry to be masked out. 0 kept, 1 removed. """
@@ -436,7 +644,7 @@ class Catalog(object):
         return prefix+self.name+extension
         
     def build_sky_from_bkgdimg(self, bkgdimg, stampsize, askey="sky",
-                                   npfunc="nanmean"):
+                                   npfunc="nanmean", index=None):
         """ build background entry based on bkgdimg given the stamp size.
         
         Parameters
@@ -454,6 +662,11 @@ class Catalog(object):
 
         npfunc: [string] -optional-
             Which numpy function should be used to go from a background stamp into a unique background ?
+            Those of utils.STAMP_STATISTICS (e.g. nanmean) do not build the stamps 
+            (see get_stamp_statistics)
+
+        index: [list or None] -optional-
+            only compute the sky of these entries (others are set to NaN)
                     
         Returns
         -------
@@ -464,12 +677,19 @@ class Catalog(object):
         if you have a ziff:
         self.build_sky_from_bkgdimg(ziff.get_background(), ziff.get_config_value("stamp_size", squeeze=True))
         """
-        skystamp = self.get_datastamps(bkgdimg, stampsize=stampsize, filtered=False)
-        sky = getattr(np,npfunc)(skystamp, axis=(1,2))
+        if npfunc in STAMP_STATISTICS:
+            sky = self.get_stamp_statistics(bkgdimg, stampsize, statistic=npfunc, filtered=False,
+                                            index=index)
+        else:
+            skystamp = self.get_datastamps(bkgdimg, stampsize=stampsize, filtered=False, index=index)
+            sky = getattr(np,npfunc)(skystamp, axis=(1,2))
+            
+        if index is not None:
+            sky = pandas.Series(sky, index=index).reindex(self.data.index).values
         # - Setting the sky
         self.set_skybackground(sky, askey=askey)
     
-    def build_mask_from_maskimg(self, maskimg, stampsize):
+    def build_mask_from_maskimg(self, maskimg, stampsize, index=None):
         """ build catalog mask based on maskimg given the stamp size.
         
         Parameters
@@ -482,6 +702,9 @@ class Catalog(object):
             Presence of True in maskimg will be looked for for any catalog entry 
             [{x/y}-stampsize/2, {x/y}+stampsize/2]
 
+        index: [list or None] -optional-
+            only compute the mask of these entries (others are masked)
+
         Returns
         -------
         None (set_mask)
@@ -491,8 +714,10 @@ class Catalog(object):
         if you have a ziff:
         self.build_mask_from_maskimg(ziff.mask, ziff.get_config_value("stamp_size", squeeze=True))
         """
-        maskstamp = np.asarray(self.get_datastamps(maskimg, stampsize=stampsize, filtered=False), dtype="bool")
-        maskout   = np.any(maskstamp, axis=(1,2))
+        maskout = self.get_stamp_statistics(maskimg, stampsize, statistic="any", filtered=False,
+                                            index=index)
+        if index is not None:
+            maskout = pandas.Series(maskout, index=index).reindex(self.data.index, fill_value=True).values
         # Setting the masks
         self.set_mask( maskout )
 
@@ -529,6 +754,7 @@ class Catalog(object):
             if 'xpos' not in self.data.keys() or overwrite:
                 self.data['xpos'] = x
                 self.data['ypos'] = y
+                self.touch_data()
         if returns:
             return x,y
 
@@ -565,6 +791,7 @@ class Catalog(object):
             if 'ra' not in self.data.keys() or overwrite:
                 self.data['ra'] = ra
                 self.data['dec'] = dec
+                self.touch_data()
                 
         if returns:
             return ra,dec
@@ -612,13 +839,21 @@ class Catalog(object):
     # -------- #
     
     # - Returns Copy
-    def get_catalog(self, filtered=False, shuffled=False, xyformat=None, name=None, index=None, **kwargs):
+    def get_catalog(self, filtered=False, shuffled=False, xyformat=None, name=None, index=None,
+                        asview=False, **kwargs):
         """ Get the filtered version of the catalog 
+
+        asview: [bool] -optional-
+            returns a CatalogView (no data copy until modified, see get_view)
         
         Returns
         ------
-        self.__class__
+        self.__class__ (or CatalogView)
         """
+        if asview:
+            return self.get_view(filtered=filtered, shuffled=shuffled, xyformat=xyformat,
+                                 name=name, index=index)
+        
         if name is None:
             name = self.name
 
@@ -639,11 +874,38 @@ class Catalog(object):
         if not filtered:
             new_cat._filters = self._filters.copy()
         else:
-            _ = [new_cat.data.pop(k) for k in self._filters.keys()]
+            new_cat.data["filterbits"] = np.zeros(len(new_cat.data), dtype="int64")
             _ = new_cat.data.pop("filterout")
             
         return new_cat
             
+    def get_view(self, filtered=False, shuffled=False, xyformat=None, name=None, index=None,
+                     columns=None):
+        """ zero-copy version of get_catalog(): a CatalogView sharing the data of this catalog.
+        The view data are copied only when modified (or accessed through .data)
+
+        Parameters
+        ----------
+        filtered, shuffled, xyformat, name, index: 
+            see get_catalog()
+
+        columns: [list or None] -optional-
+            subset of columns (all if None)
+
+        Returns
+        -------
+        CatalogView
+        """
+        rows = self._get_rows_(filtered=filtered, index=index)
+        if rows is None:
+            rows = self.data_index
+        if shuffled:
+            rows = rows[np.random.permutation(len(rows))]
+        xyshift = 0 if xyformat is None else self._get_xyorigin_(xyformat)
+        return CatalogView(self, rows=rows, columns=columns, xyshift=xyshift,
+                           xyformat=self.xyformat if xyformat is None else xyformat,
+                           filtered=filtered, name=self.name if name is None else name)
+        
     def get_filtered(self, shuffled=False, **kwargs):
         """ Get the filtered version of the catalog 
         
@@ -670,7 +932,8 @@ class Catalog(object):
         if not self.has_data():
             raise AttributeError("No data set yet. Use self.set_data()")
 
-        d_ = self.data.copy()
+        # only the selected rows are copied
+        d_ = self._select_data_(self._get_rows_(filtered=filtered, index=index))
         if len(d_)==0:
             return d_
             
@@ -679,12 +942,6 @@ class Catalog(object):
             if origin != 0:
                 d_[self._xposkey] -= origin
                 d_[self._yposkey] -= origin
-                
-        if filtered:        
-            d_ = d_[~self.filterout]
-
-        if index is not None:
-            d_ = d_.loc[[i for i in index if i in d_.index]]
 
         if shuffled:
             d_ = d_.sample(frac=1)
@@ -694,6 +951,23 @@ class Catalog(object):
         
         return d_
 
+    def _get_rows_(self, filtered=False, index=None):
+        """ index of the selected rows (None means all) """
+        rows = None
+        if filtered:
+            rows = self.data_index[~self.filterout]
+            
+        if index is not None:
+            index = pandas.Index(index)
+            rows = index[index.isin(self.data_index if rows is None else rows)]
+            
+        return rows
+
+    def _select_data_(self, rows=None, columns=None):
+        """ new DataFrame of the given rows (index) and columns (all if None) """
+        d_ = self.data if columns is None else self.data[columns]
+        return d_.copy() if rows is None else d_.loc[rows]
+    
     def get_header(self):
         """ fits header """
         if self.header is None:
@@ -754,14 +1028,44 @@ class Catalog(object):
         serie_ = self.get_data(filtered=filtered, **kwargs)[self._yposkey]-origin
         return serie_ if asserie else serie_.values
 
-    def get_datastamps(self, array, stampsize, filtered=False, xyformat="numpy"):
+    def get_datastamps(self, array, stampsize, filtered=False, xyformat="numpy", index=None):
         """ """
-        xpos = self.get_xpos(filtered=filtered, xyformat=xyformat)
-        ypos = self.get_ypos(filtered=filtered, xyformat=xyformat)
+        xpos = self.get_xpos(filtered=filtered, xyformat=xyformat, index=index)
+        ypos = self.get_ypos(filtered=filtered, xyformat=xyformat, index=index)
         if len(xpos)==0:
             ValueError("size of xpos is zero.")
         return stamp_it(array, xpos, ypos,
                         dx=stampsize, asarray=True)
+
+    def get_stamp_statistics(self, array, stampsize, statistic="nanmean", filtered=False,
+                                 xyformat="numpy", index=None):
+        """ per entry reduction of the array stamps, without building them
+        (summed-area tables, see utils.get_stamp_statistics).
+
+        Parameters
+        ----------
+        array: [2d-array]
+            image to reduce (e.g. background or mask image)
+
+        stampsize: [int]
+            Size of the stamps (same as get_datastamps())
+
+        statistic: [string] -optional-
+            sum, nansum, mean, nanmean, count, any or nfinite
+
+        filtered: [bool] -optional-
+            only for the entries that are not filtered out.
+
+        index: [list or None] -optional-
+            only for these entries.
+
+        Returns
+        -------
+        1d array
+        """
+        xpos = self.get_xpos(filtered=filtered, xyformat=xyformat, asserie=False, index=index)
+        ypos = self.get_ypos(filtered=filtered, xyformat=xyformat, asserie=False, index=index)
+        return get_stamp_statistics(array, xpos, ypos, dx=stampsize, statistic=statistic)
     
         
     def get_config(self):
@@ -777,16 +1081,120 @@ class Catalog(object):
     #--------- #
     # MATCHING #
     #--------- #
+    def get_spatialcoords(self, which="radec", filtered=False, **kwargs):
+        """ coordinates used by the spatial index.
+
+        Parameters
+        ----------
+        which: [string] -optional-
+            - radec: (N,3) unit vectors of the ra, dec coordinates
+            - xy: (N,2) ccd positions (xpos, ypos data columns, as stored)
+
+        filtered: [bool] -optional-
+            only the entries that are not filtered out.
+
+        **kwargs goes to get_data() (e.g. index)
+
+        Returns
+        -------
+        ndarray
+        """
+        if which == "radec":
+            ra = np.radians(np.asarray(self.get_ra(filtered=filtered, asserie=False, **kwargs),
+                                           dtype="float"))
+            dec = np.radians(np.asarray(self.get_dec(filtered=filtered, asserie=False, **kwargs),
+                                            dtype="float"))
+            return np.asarray([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).T
+        
+        if which == "xy":
+            data = self.get_data(filtered=filtered, **kwargs)
+            return np.asarray(data[[self._xposkey, self._yposkey]], dtype="float")
+
+        raise ValueError(f"which can only be radec or xy, {which} given")
+
+    def get_spatialindex(self, which="radec", filtered=False):
+        """ scipy cKDTree of the catalog coordinates (see get_spatialcoords).
+
+        The tree is built once and stored, for the current data_version. 
+        = The version is only bumped by the catalog methods changing the coordinates
+        or filterout columns (set_data, load_xy_from_radec, update_filter...);
+        call touch_data() after changing them by hand =
+
+        Parameters
+        ----------
+        which: [string] -optional-
+            radec (unit vectors) or xy (ccd positions)
+
+        filtered: [bool] -optional-
+            only the entries that are not filtered out.
+
+        Returns
+        -------
+        scipy.spatial.cKDTree
+        """
+        from scipy.spatial import cKDTree
+        stored = self._spatialindex.get((which, filtered))
+        if stored is None or stored[0] != self.data_version:
+            stored = (self.data_version, cKDTree(self.get_spatialcoords(which=which, filtered=filtered)))
+            self._spatialindex[(which, filtered)] = stored
+            
+        return stored[1]
+
+    def clear_spatialindex(self):
+        """ drops the stored spatial indexes (see get_spatialindex) """
+        self._hspatialindex = {}
+
+    def touch_data(self):
+        """ bumps the data version (outdates the stored spatial indexes) """
+        self._data_version = self.data_version + 1
+
     def match(self, catalog, seplimit = 1*units.arcsec, filtered = False):
-        """ """
-        skcatalog = catalog.get_skycoord(filtered = filtered)
-        sk = self.get_skycoord(filtered = filtered)
+        """ match the entries of self with that of the input catalog.
 
-        catalog_idx, self_idx, d2d, d3d = sk.search_around_sky(skcatalog,
-                                                            seplimit=seplimit)
-        return self_idx, catalog_idx
+        Parameters
+        ----------
+        catalog: [Catalog]
+            catalog to match with (uses its spatial index)
 
-    def measure_isolation(self, refcat=None, seplimit=8):
+        seplimit: [astropy.units.Quantity or float] -optional-
+            matching distance (arcsec if float)
+
+        filtered: [bool] -optional-
+            match the filtered catalogs
+
+        Returns
+        -------
+        self_idx, catalog_idx (positional indexes)
+        """
+        coords = self.get_spatialcoords("radec", filtered=filtered)
+        neighbors = catalog.get_spatialindex("radec", filtered=filtered
+                                            ).query_ball_point(coords, _get_chord_(seplimit))
+        return _flatten_neighbors_(neighbors)
+
+    def match_xy(self, xpos, ypos, seplimit=0.2, filtered=False):
+        """ match the given ccd positions with the catalog ones (xpos, ypos columns)
+
+        Parameters
+        ----------
+        xpos, ypos: [array]
+            ccd position to match (same format as the stored ones)
+
+        seplimit: [float] -optional-
+            matching distance in pixels
+
+        filtered: [bool] -optional-
+            match the filtered catalog
+
+        Returns
+        -------
+        input_idx, self_idx (positional indexes)
+        """
+        neighbors = self.get_spatialindex("xy", filtered=filtered
+                                         ).query_ball_point(np.asarray([xpos, ypos], dtype="float").T,
+                                                                seplimit)
+        return _flatten_neighbors_(neighbors)
+
+    def measure_isolation(self, refcat=None, seplimit=8, index=None):
         """ 
         
         Parameters
@@ -798,6 +1206,10 @@ class Catalog(object):
 
         seplimit: [float] -optional-
             isolation distance in arcsec
+
+        index: [list or None] -optional-
+            only measure the isolation of these entries (still against the full refcat).
+            Others are set to n_nearsources=-1 (not isolated).
         
         Returns
         -------
@@ -805,26 +1217,120 @@ class Catalog(object):
         """
         if refcat is None:
             refcat = self
-            
-        idx1, idx2 = self.match(refcat, seplimit=seplimit*units.arcsec, filtered=False)
-        unique, counts = np.unique(idx1, return_counts=True)
+
+        counts = refcat.get_spatialindex("radec", filtered=False
+                                        ).query_ball_point(self.get_spatialcoords("radec", filtered=False,
+                                                                                  index=index),
+                                                           _get_chord_(seplimit*units.arcsec),
+                                                           return_length=True)
+        if index is not None:
+            counts = pandas.Series(counts, index=index).reindex(self.data.index, fill_value=0).values
         self.data["n_nearsources"] = counts-1
         self.data['is_isolated'] = (self.data["n_nearsources"]==0)
-        
+
+    #---------- #
+    # DEFERRED  #
+    #---------- #
+    def add_deferred(self, name, func, filters=None, **kwargs):
+        """ register a deferred (lazy) column computation.
+
+        Deferred columns are only computed by compute_deferred(), for the entries that
+        survived the filters at that time; the cheap filters should hence be added first.
+        = The other (non-candidate) entries get placeholder values:
+        NaN sky (build_sky_from_bkgdimg), masked=True (build_mask_from_maskimg),
+        n_nearsources=-1 and is_isolated=False (measure_isolation) =
+
+        Parameters
+        ----------
+        name: [string]
+            name of the deferred computation
+
+        func: [string or function]
+            catalog method name (or function) accepting an index= argument,
+            e.g. 'build_sky_from_bkgdimg', 'build_mask_from_maskimg', 'measure_isolation'
+
+        filters: [list or None] -optional-
+            list of add_filter() arguments [key, range_values, filtername]
+            applied once the column is computed.
+
+        **kwargs goes to func
+
+        Returns
+        -------
+        None
+        """
+        if type(func) is str:
+            func = getattr(self, func)
+        self.deferred[name] = {"func":func, "kwargs":kwargs,
+                               "filters":[] if filters is None else filters}
+
+    def compute_deferred(self, names=None, candidates_only=True):
+        """ compute the deferred columns (see add_deferred), in registration order.
+
+        Parameters
+        ----------
+        names: [list or None] -optional-
+            deferred to compute. All if None.
+
+        candidates_only: [bool] -optional-
+            only compute them for the entries not yet filtered out.
+            Each deferred filter hence reduces the next deferred computations.
+
+        Returns
+        -------
+        None
+        """
+        if names is None:
+            names = list(self.deferred.keys())
+            
+        for name in np.atleast_1d(names):
+            deferred = self.deferred.pop(name)
+            index = self.data.index[~self.filterout] if candidates_only else None
+            deferred["func"](index=index, **deferred["kwargs"])
+            for key, range_values, filtername in deferred["filters"]:
+                self.add_filter(key, range_values, name=filtername)
+
     #---------- #
     # FILTERING #
     #---------- #
     def update_filter(self, reset=True, used_filters=None):
-        """ """
+        """ update the filterout column from the filter bits 
+        
+        Parameters
+        ----------
+        reset: [bool] -optional-
+            if False, entries already filtered out stay so.
+
+        used_filters: [list or None] -optional-
+            name of the filters to use. All if None.
+        """
         if used_filters is None:
             used_filters = list(self._filters.keys())
+
+        filterout = (self.filterbits & self.get_filtermask(used_filters)) != 0
         if 'filterout' in self.data.columns and not reset:
-            used_filters += ["filterout"]
+            filterout |= self.filterout
             
-        self.data.loc[:, 'filterout'] = self.data[used_filters].sum(axis=1).astype("bool")
+        self.data['filterout'] = filterout
+        self.touch_data()
     
     def add_filter(self, key, range_values, name = None, update=True, verbose=False):
-        """ """
+        """ add (or replace) a filter, stored as a bit of the filterbits column.
+        
+        Parameters
+        ----------
+        key: [string]
+            data column
+
+        range_values: [list or value]
+            entries are kept if key is within range_values (size 2) or equals it (size 1)
+
+        name: [string or None] -optional-
+            name of the filter. key+str(range_values) if None
+
+        update: [bool] -optional-
+            update the filterout column
+        """
         if name is None:
             name = key + str(range_values)
 
@@ -832,31 +1338,111 @@ class Catalog(object):
             self.load_xy_from_radec(update=True, returns=False)
         elif key in ["ra","dec"] and key not in self.data.keys():
             self.load_radec_from_xy(update=True, returns=False)
-            
-        self.data[name] = False
 
         if len(np.atleast_1d(range_values))==2:
             if verbose: print(f"{key} between {range_values}")
-            self.data.loc[:,name] = ~self.data[key].between(*range_values)
         elif len(np.atleast_1d(range_values))==1:
             if verbose: print(f"{key} equals {range_values}")
-            self.data.loc[:,name] = ~(self.data[key] == np.atleast_1d(range_values)[0])
         else:
             raise ValueError("cannot parse the given range_values, should have size 1 or 2")
-        
+
+        bit = self._filters[name]["bit"] if name in self._filters else self._get_free_filterbit_()
         self._filters[name] = {'range':range_values,
-                               'key':key}
-        if update:
-            self.update_filter()
+                               'key':key,
+                               'bit':bit}
+        self.reevaluate_filters(name, update=update)
 
     def remove_filter(self, name):
         """ """
-        if name in self.data.keys():
-            self.data.drop(name, axis=1, inplace = True)
-            self._filters.pop(name)
+        if name in self._filters:
+            filter_ = self._filters.pop(name)
+            self.data["filterbits"] = self.filterbits & ~(np.int64(1) << filter_["bit"])
             self.update_filter()
         else:
             raise ValueError(f"Filter {name} not found in dataframe.")
+
+    def reevaluate_filters(self, names=None, index=None, update=True):
+        """ re-evaluate the filter predicates (e.g. after a column changed).
+
+        Parameters
+        ----------
+        names: [string or list or None] -optional-
+            filters to re-evaluate. All if None.
+
+        index: [list or None] -optional-
+            only re-evaluate these entries.
+
+        update: [bool] -optional-
+            update the filterout column
+        """
+        if names is None:
+            names = list(self._filters.keys())
+
+        filterbits = self.filterbits.copy()
+        iloc = slice(None) if index is None else self.data.index.get_indexer(index)
+        data = self.data if index is None else self.data.iloc[iloc]
+        for name in np.atleast_1d(names):
+            filter_ = self._filters[name]
+            range_values = np.atleast_1d(filter_["range"])
+            if len(range_values)==2:
+                rejected = ~data[filter_["key"]].between(*range_values)
+            else:
+                rejected = ~(data[filter_["key"]] == range_values[0])
+
+            flag = np.int64(1) << filter_["bit"]
+            # missing values (pd.NA) are not rejected
+            filterbits[iloc] = np.where(rejected.fillna(False).to_numpy(dtype=bool),
+                                        filterbits[iloc] | flag, filterbits[iloc] & ~flag)
+            
+        self.data["filterbits"] = filterbits
+        if update:
+            self.update_filter()
+
+    def get_filtermask(self, names=None):
+        """ int64 bit mask of the given filters (all if None) """
+        if names is None:
+            names = list(self.filters.keys())
+        return np.bitwise_or.reduce([np.int64(1) << self.filters[k]["bit"]
+                                         for k in names if k in self.filters],
+                                    initial=np.int64(0))
+
+    def get_filterflags(self, names=None, filtered=False):
+        """ DataFrame of the filter booleans (True means filtered out by this filter) """
+        if names is None:
+            names = list(self.filters.keys())
+        filterbits = self.filterbits[~self.filterout] if filtered else self.filterbits
+        index = self.data.index[~self.filterout] if filtered else self.data.index
+        return pandas.DataFrame({k: (filterbits & (np.int64(1) << self.filters[k]["bit"])) != 0
+                                     for k in names}, index=index)
+
+    def get_rejecting_filters(self, index):
+        """ name of the filters rejecting the given entry(ies).
+
+        Parameters
+        ----------
+        index: [index or list]
+            data index of the entry (or entries)
+
+        Returns
+        -------
+        list (single index) or pandas.Series of lists
+        """
+        islist = not np.isscalar(index) and type(index) is not tuple
+        filterbits = np.atleast_1d(self.data.loc[index if islist else [index], "filterbits"].values
+                                  ).astype("int64")
+        names = np.asarray(list(self.filters.keys()), dtype=object)
+        bits = np.asarray([f_["bit"] for f_ in self.filters.values()], dtype="int64")
+        rejected = ((filterbits[:,None] >> bits[None,:]) & 1).astype("bool")
+        rejecting = [list(names[r_]) for r_ in rejected]
+        return pandas.Series(rejecting, index=index) if islist else rejecting[0]
+
+    def _get_free_filterbit_(self):
+        """ """
+        used = [f_["bit"] for f_ in self._filters.values()]
+        free = [b_ for b_ in range(self._MAX_FILTERS) if b_ not in used]
+        if len(free) == 0:
+            raise ValueError(f"Maximum number of filters reached ({self._MAX_FILTERS})")
+        return free[0]
     
     # --------- #
     #  Internal #
@@ -867,7 +1453,7 @@ class Catalog(object):
             raise AttributeError("No data set.")
         
         trialkeys = np.asarray(trialkeys)
-        keyin = np.isin(trialkeys, self.data.columns)
+        keyin = np.isin(trialkeys, self.data_columns)
         if not np.any(keyin):
             if safeout:
                 return None
@@ -906,6 +1492,16 @@ class Catalog(object):
     def npoints(self):
         """ number of data entries """
         return len(self.data) if self.has_data() else None
+
+    @property
+    def data_index(self):
+        """ index of the data """
+        return self.data.index
+
+    @property
+    def data_columns(self):
+        """ columns of the data """
+        return self.data.columns
     
     def has_data(self):
         """ test if the data as been set."""
@@ -946,6 +1542,19 @@ class Catalog(object):
         
         return np.asarray(np.zeros(len(self.data)), dtype="bool")
     
+    @property
+    def filterbits(self):
+        """ int64 array of the filter bits (see add_filter) """
+        if 'filterbits' in self.data:
+            return np.asarray(self.data['filterbits'], dtype="int64")
+        
+        return np.zeros(len(self.data), dtype="int64")
+
+    @property
+    def filters(self):
+        """ filter definitions {name: {key, range, bit}} """
+        return self._filters
+
     @property
     def filtered_index(self):
         """ dataframe index of the data filtered """
@@ -1018,6 +1627,171 @@ class Catalog(object):
         """ astropy SkyCoord of ra and dec """
         return self.get_skycoord()
 
+    @property
+    def deferred(self):
+        """ deferred column computations (see add_deferred) """
+        if not hasattr(self, "_deferred"):
+            self._deferred = {}
+        return self._deferred
+
+    @property
+    def data_version(self):
+        """ version of the coordinates and filterout columns (see get_spatialindex) """
+        return getattr(self, "_data_version", 0)
+
+    @property
+    def _spatialindex(self):
+        """ stored spatial indexes {(which, filtered): (data_version, tree)} """
+        if not hasattr(self, "_hspatialindex"):
+            self._hspatialindex = {}
+        return self._hspatialindex
+
+    
+class CatalogView( Catalog ):
+    """ copy-on-write view of a parent Catalog:
+    row selection (index), xyformat offset and column subset over the parent data.
+
+    The parent data are not copied until the view data are accessed through .data
+    (i.e. to be modified, e.g. set_data, add_filter), get_data() and write_to() only copy
+    the selected rows. The view data are those of get_catalog() (same columns and dtypes).
+    = The view holds a snapshot of the parent data: later changes of the parent are not seen.
+    This snapshot is lazy with pandas copy-on-write (see PANDAS_COW), a copy otherwise =
+    """
+    def __init__(self, parent, rows=None, columns=None, xyshift=0, xyformat=None,
+                     filtered=False, name=None, pdata=None):
+        """ """
+        self._parent = parent
+        self._pdata = parent.data.copy(deep=not PANDAS_COW) if pdata is None else pdata
+        self._rows = parent.data_index if rows is None else pandas.Index(rows)
+        self._columns = None if columns is None else list(columns)
+        self._xyshift = xyshift
+        self._viewfiltered = filtered
+        self._name = parent.name if name is None else name
+        self._filters = {} if filtered else copy.deepcopy(parent._filters)
+        self._xyformat = parent.xyformat if xyformat is None else xyformat
+        self._wcs = parent.wcs
+        if hasattr(parent, "_header"):
+            self._header = parent._header
+
+    def get_view(self, filtered=False, shuffled=False, xyformat=None, name=None, index=None,
+                     columns=None):
+        """ see Catalog.get_view(). (Not materialized) views are composed, not chained. """
+        if self.is_materialized():
+            return super().get_view(filtered=filtered, shuffled=shuffled, xyformat=xyformat,
+                                    name=name, index=index, columns=columns)
+        
+        rows = self._get_rows_(filtered=filtered, index=index)
+        if rows is None:
+            rows = self.data_index
+        if shuffled:
+            rows = rows[np.random.permutation(len(rows))]
+        if columns is not None and self._columns is not None:
+            columns = [c_ for c_ in columns if c_ in self._columns]
+        xyshift = self._xyshift + (0 if xyformat is None else self._get_xyorigin_(xyformat))
+        return CatalogView(self._parent, rows=rows,
+                           columns=self._columns if columns is None else columns,
+                           xyshift=xyshift,
+                           xyformat=self.xyformat if xyformat is None else xyformat,
+                           filtered=self._viewfiltered or filtered,
+                           name=self.name if name is None else name, pdata=self._pdata)
+
+    def is_materialized(self):
+        """ test if the view data have been copied from the parent """
+        return hasattr(self, "_data")
+
+    def materialize(self):
+        """ copies the view data from the parent. (automatic when accessing .data) """
+        if not self.is_materialized():
+            self._data = self._select_data_(self._rows)
+        
+    # --------- #
+    #  Internal #
+    # --------- #
+    def _select_data_(self, rows=None, columns=None):
+        """ new DataFrame of the given rows (index) and columns (all if None) """
+        if self.is_materialized():
+            return super()._select_data_(rows=rows, columns=columns)
+
+        columns = self._columns if columns is None else columns
+        pdata = self._pdata
+        # as get_catalog() copies (see set_data, the mask is set as given by set_mask)
+        d_ = pdata.loc[self._rows if rows is None else rows,
+                       pdata.columns if columns is None else columns]
+        d_ = d_.convert_dtypes().assign(**({"masked": d_["masked"]} if "masked" in d_.columns else {}))
+        if self._xyshift != 0:
+            for key in [self._parent._xposkey, self._parent._yposkey]:
+                if key in d_.columns:
+                    d_[key] -= self._xyshift
+                    
+        if self._viewfiltered:
+            if "filterbits" in d_.columns:
+                d_["filterbits"] = np.zeros(len(d_), dtype="int64")
+            d_ = d_.drop(columns="filterout", errors="ignore")
+        return d_
+
+    # ================ #
+    #   Properties     #
+    # ================ #
+    @property
+    def data(self):
+        """ catalog data (materialized copy of the parent selection) """
+        self.materialize()
+        return self._data
+
+    @property
+    def parent(self):
+        """ catalog this is a view of """
+        return self._parent
+
+    @property
+    def npoints(self):
+        """ number of data entries """
+        return len(self.data_index)
+    
+    def has_data(self):
+        """ test if the data as been set."""
+        return True
+
+    @property
+    def data_index(self):
+        """ index of the data """
+        return self._data.index if self.is_materialized() else self._rows
+
+    @property
+    def data_columns(self):
+        """ columns of the data """
+        if self.is_materialized():
+            return self._data.columns
+        if self._columns is not None:
+            return pandas.Index(self._columns)
+        return self._pdata.columns.drop("filterout") if self._viewfiltered and "filterout" in self._pdata \
+          else self._pdata.columns
+
+    @property
+    def filterout(self):
+        """ boolean array of the filtered out entries """
+        if self.is_materialized():
+            return super().filterout
+        if self._viewfiltered or "filterout" not in self._pdata.columns:
+            return np.zeros(len(self._rows), dtype="bool")
+        return np.asarray(self._pdata.loc[self._rows, "filterout"], dtype="bool")
+
+    @property
+    def filterbits(self):
+        """ int64 array of the filter bits (see add_filter) """
+        if self.is_materialized():
+            return super().filterbits
+        if self._viewfiltered or "filterbits" not in self._pdata.columns:
+            return np.zeros(len(self._rows), dtype="int64")
+        return np.asarray(self._pdata.loc[self._rows, "filterbits"], dtype="int64")
+    
+    @property
+    def mask(self):
+        """ """
+        if "masked" not in self.data_columns:
+            return None
+        return np.asarray(self._select_data_(columns=["masked"])["masked"])
+
     
 class CatalogCollection( Catalog ):
 
@@ -1174,7 +1948,8 @@ class CatalogCollection( Catalog ):
         unique_stamp = len(stampsize)==1
         
         out = [c.build_sky_from_bkgdimg(bkgdimg[0] if unique_bkgdimg else bkgdimg[i],
-                                        stampsize[0] if unique_stamp else stampsize[i])
+                                        stampsize[0] if unique_stamp else stampsize[i],
+                                        askey=askey, npfunc=npfunc)
                                       for i,c in enumerate(self.catalogs)
                 ]
     
@@ -1350,13 +2125,37 @@ class CatalogCollection( Catalog ):
         self._call_down_("measure_isolation", refcat=refcat, seplimit=seplimit, isfunc=True)
         self._load_data_()
         
+    #---------- #
+    # DEFERRED  #
+    #---------- #
+    def add_deferred(self, name, func, filters=None, enumkwargs=None, **kwargs):
+        """ register the deferred computation on every catalog (see Catalog.add_deferred)
+
+        enumkwargs: [list of dict or None] -optional-
+            catalog specific func kwargs (e.g. images), one per catalog.
+        """
+        for i, c_ in enumerate(self.catalogs):
+            kwargs_ = {**kwargs, **(enumkwargs[i] if enumkwargs is not None else {})}
+            c_.add_deferred(name, func, filters=filters, **kwargs_)
+            
+    def compute_deferred(self, names=None, candidates_only=True):
+        """ compute the deferred columns of every catalog (see Catalog.compute_deferred) """
+        self._call_down_("compute_deferred", names=names, candidates_only=candidates_only,
+                         isfunc=True)
+        self._load_data_()
+
+    @property
+    def deferred(self):
+        """ deferred column computations of the first catalog (see add_deferred) """
+        return self.catalogs[0].deferred if self.has_catalogs() else {}
+        
     #---------- #
     # FILTERING #
     #---------- #
     def update_filter(self):
         """ """
         self._call_down_("update_filter", isfunc=True)
-        self._load_data_()
+        self._load_filters_()
     
     def add_filter(self, key, range_values, name = None, update=True):
         """ """
@@ -1367,12 +2166,28 @@ class CatalogCollection( Catalog ):
 
     def remove_filter(self, name):
         """ """
-        if name in self.data.keys():
-            self.data.drop(name, axis=1, inplace = True)
-            self._filters.pop(name)
-            self.update_filter()
-        else:
-            raise ValueError(f"Filter {name} not found in dataframe.")
+        self._call_down_("remove_filter", name=name, isfunc=True)
+        self._load_filters_()
+
+    def reevaluate_filters(self, names=None, update=True):
+        """ """
+        self._call_down_("reevaluate_filters", names=names, update=update, isfunc=True)
+        self._load_filters_()
+
+    def _load_filters_(self):
+        """ only reload the filter columns of the catalogs (see _load_data_) """
+        filterbits = self._call_down_("filterbits", isfunc=False)
+        if np.sum([len(f_) for f_ in filterbits]) != len(self.data):
+            return self._load_data_()
+        
+        self.data["filterbits"] = np.concatenate(filterbits)
+        self.data["filterout"] = np.concatenate(self._call_down_("filterout", isfunc=False))
+        self.touch_data()
+
+    @property
+    def filters(self):
+        """ filter definitions of the first catalog {name: {key, range, bit}} """
+        return self.catalogs[0].filters if self.has_catalogs() else {}
     # ================ #
     #   Property       #
     # ================ #
@@ -1478,7 +2293,7 @@ class _CatalogHolder_( object ):
                         filtered=False, shuffled=False, verbose=True,
                         add_filter=None, writeto=None, writetoprop={}):
         """ Eval if catalog is a name or an object. Returns the object 
-        = This returns a copy of the requested catalog = 
+        = This returns a copy (a CatalogView for non-collection) of the requested catalog = 
         
 
         add_filter: [None or dict] -optional-
@@ -1497,8 +2312,9 @@ class _CatalogHolder_( object ):
         if chipnum is not None and CatalogCollection in catalog.__class__.__mro__:
             catalog = catalog.catalogs[chipnum]
 
-        # Build a copy
-        catalog = catalog.get_catalog()
+        # Build a (copy-on-write) view, collections are copied.
+        isview = CatalogCollection not in catalog.__class__.__mro__
+        catalog = catalog.get_catalog(asview=isview)
 
         #
         # - Add filter if any
@@ -1509,8 +2325,9 @@ class _CatalogHolder_( object ):
         #
         # - Change format or
         if xyformat is not None or filtered or shuffled:
-            # This is a copy
-            catalog = catalog.get_catalog(filtered=filtered, shuffled=shuffled, xyformat=xyformat)
+            # This is a view (or a copy)
+            catalog = catalog.get_catalog(filtered=filtered, shuffled=shuffled, xyformat=xyformat,
+                                          asview=isview)
 
         if writeto is not None:
             #
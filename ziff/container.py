@@ -0,0 +1,482 @@
+""" Containers of the per-quadrant ziff outputs.
+
+Each quadrant leaves several small files next to its image
+(psfshape.parquet, psfcat_gaia.fits, shapecat_gaia.fits, *.piff, piff_config.json).
+compact_files() packs the outputs of a night (or an exposure) in a container directory:
+{dirpath}/{YYYY}/{MMDD}[/{filefracday}]/
+    index.parquet             # original file basename -> kind, member, metadata
+    tables/{kind}.parquet     # one table per kind (psfshape, psfcat_gaia, ...), rows tagged by prefix
+    psfs.zip                  # uncompressed archive of the other files (piff, json)
+
+Readers (Catalog.load, read_psf, ZIFF.load_psf, get_local_files) first look for the
+file on disk and then resolve it through the container index (see get_file_container()).
+"""
+
+import os
+import json
+import zipfile
+import numpy as np
+import pandas
+
+INDEX_NAME = "index.parquet"
+ARCHIVE_NAME = "psfs.zip"
+TABLE_DIR = "tables"
+TABLE_KINDS = {"psfshape.parquet": "psfshape",
+               "psfcat_gaia.fits": "psfcat_gaia",
+               "shapecat_gaia.fits": "shapecat_gaia"}
+ARCHIVE_EXTENSIONS = [".piff", ".json"]
+GROUPINGS = ["night", "exposure"]
+_CONTAINERS = {} # memoized containers per directory, see get_container()
+
+
+def get_container_rootdir(dirpath=None):
+    """ root directory of the containers.
+    $ZIFF_CONTAINERDIR if defined, {ZIFFDIR}/containers otherwise. """
+    if dirpath is not None:
+        return dirpath
+    if "ZIFF_CONTAINERDIR" in os.environ:
+        return os.environ["ZIFF_CONTAINERDIR"]
+
+    from .io import ZIFFDIR
+    return os.path.join(ZIFFDIR, "containers")
+
+def parse_filename(filename):
+    """ prefix (ztf_{filefracday}_{field}_{filter}_c{ccd}_{imgtype}_q{qid}_), suffix and filefracday
+    of a ztf (ziff output) filename """
+    basename = os.path.basename(filename)
+    splitted = basename.split("_")
+    if len(splitted) < 8 or splitted[0] != "ztf":
+        raise ValueError(f"{basename} is not a ztf quadrant filename")
+    return "_".join(splitted[:7])+"_", "_".join(splitted[7:]), splitted[1]
+
+def get_file_kind(filename):
+    """ container kind of the file (a table kind, 'archive', or None if not containable) """
+    _, suffix, _ = parse_filename(filename)
+    if suffix in TABLE_KINDS:
+        return TABLE_KINDS[suffix]
+    if os.path.splitext(suffix)[-1] in ARCHIVE_EXTENSIONS:
+        return "archive"
+    return None
+
+def get_container_dir(filename, grouping="night", dirpath=None):
+    """ container directory of the given file (or filefracday)
+
+    Parameters
+    ----------
+    filename: [string]
+        ztf quadrant filename or filefracday
+
+    grouping: [string] -optional-
+        night ({YYYY}/{MMDD}) or exposure ({YYYY}/{MMDD}/{filefracday})
+
+    dirpath: [string or None] -optional-
+        root directory (see get_container_rootdir())
+
+    Returns
+    -------
+    string
+    """
+    if grouping not in GROUPINGS:
+        raise ValueError(f"grouping must be any of {GROUPINGS}, {grouping} given")
+    filefracday = filename if os.path.basename(filename).isdigit() else parse_filename(filename)[2]
+    dirout = os.path.join(get_container_rootdir(dirpath), filefracday[:4], filefracday[4:8])
+    if grouping == "exposure":
+        dirout = os.path.join(dirout, filefracday)
+    return dirout
+
+def get_container(dirpath):
+    """ Container of the given directory, memoized such that its index is only read once.
+    Containers updated through add_files() replace the memoized one, 
+    use clear_containers() if the directory is modified by another process.
+    """
+    dirpath = os.path.normpath(dirpath)
+    if dirpath not in _CONTAINERS:
+        _CONTAINERS[dirpath] = Container(dirpath)
+    return _CONTAINERS[dirpath]
+
+def clear_containers():
+    """ drops the memoized containers (see get_container) """
+    _CONTAINERS.clear()
+
+def get_file_container(filename, dirpath=None):
+    """ Container having the given file (exposure container first), None if none. """
+    try:
+        parse_filename(filename)
+    except ValueError:
+        return None
+
+    for grouping in ["exposure", "night"]:
+        container = get_container(get_container_dir(filename, grouping=grouping, dirpath=dirpath))
+        if container.has_file(filename):
+            return container
+    return None
+
+def file_exists(filename):
+    """ test if the file is on disk or in a container """
+    return os.path.isfile(filename) or get_file_container(filename) is not None
+
+# ============== #
+#   Readers      #
+# ============== #
+def read_psf(filename, logger=None):
+    """ piff.PSF of the given file (on disk or in a container) """
+    if os.path.isfile(filename):
+        import piff
+        return piff.PSF.read(file_name=filename, logger=logger)
+
+    container = get_file_container(filename)
+    if container is None:
+        raise IOError(f"No such file or container entry {filename}")
+    return container.read_psf(filename, logger=logger)
+
+def get_local_files(file_, suffix, **kwargs):
+    """ io.get_file() resolving the files that are in a container.
+
+    Parameters
+    ----------
+    file_: [string]
+        ztf filename (e.g. sciimg)
+
+    suffix: [list of string]
+        requested suffixes
+
+    **kwargs goes to ztfquery.io.get_file (for the files not in a container)
+
+    Returns
+    -------
+    list of filenames (same order as suffix). Containers entries are returned as
+    their original filename, use the readers (read_psf, Catalog.load) to load them.
+    """
+    from ztfquery import io, buildurl
+    suffix = list(np.atleast_1d(suffix))
+    localfiles = [buildurl.filename_to_scienceurl(file_, source="local", suffix=s_, check_suffix=False)
+                  for s_ in suffix]
+    incontainer = [not os.path.isfile(f_) and get_file_container(f_) is not None for f_ in localfiles]
+    tofetch = [s_ for s_, in_ in zip(suffix, incontainer) if not in_]
+    fetched = iter(io.get_file(file_, suffix=tofetch, check_suffix=False, **kwargs)) if len(tofetch)>0 else None
+    return [f_ if in_ else next(fetched) for f_, in_ in zip(localfiles, incontainer)]
+
+# ============== #
+#   Compaction   #
+# ============== #
+def compact_files(files, grouping="night", dirpath=None, remove=False):
+    """ packs the given quadrant output files in their container.
+
+    Parameters
+    ----------
+    files: [list of string]
+        files to compact (psfshape.parquet, psfcat_gaia.fits, shapecat_gaia.fits, piff, json).
+        Other files are ignored.
+
+    grouping: [string] -optional-
+        night or exposure (see get_container_dir())
+
+    dirpath: [string or None] -optional-
+        root directory of the containers (see get_container_rootdir())
+
+    remove: [bool] -optional-
+        remove the original files once stored in their container.
+
+    Returns
+    -------
+    list of updated container directories
+    """
+    files = [f_ for f_ in np.atleast_1d(files) if _is_containable_(f_)]
+    if len(files) == 0:
+        return []
+    groups = pandas.Series(files, dtype="object").groupby([get_container_dir(f_, grouping=grouping, dirpath=dirpath)
+                                                          for f_ in files])
+    for container_dir, gfiles in groups:
+        get_container(container_dir).add_files(list(gfiles.values))
+        if remove:
+            for f_ in gfiles.values:
+                os.remove(f_)
+
+    return list(groups.groups.keys())
+
+def compact_directory(directory, pattern="ztf_*", grouping="night", dirpath=None, remove=False):
+    """ compact_files() on the files of a directory tree (e.g. {LOCALSOURCE}/sci/2019/0301)
+    matching the given pattern """
+    import glob
+    files = glob.glob(os.path.join(directory, "**", pattern), recursive=True)
+    return compact_files(files, grouping=grouping, dirpath=dirpath, remove=remove)
+
+def _is_containable_(filename):
+    """ """
+    try:
+        return get_file_kind(filename) is not None
+    except ValueError:
+        return False
+
+def _read_table_file_(filename):
+    """ dataframe (index as column) and metadata of a table file """
+    if filename.endswith(".fits"):
+        from astropy.io import fits
+        from .catalog import recarray_to_dataframe
+        with fits.open(filename) as hdul:
+            dataframe = recarray_to_dataframe(hdul[1].data)
+            meta = {"format": "fits", "index": None, "header": hdul[1].header.tostring()}
+    else:
+        dataframe = pandas.read_parquet(filename)
+        meta = {"format": "parquet", "index": dataframe.index.name}
+        dataframe = dataframe.reset_index()
+
+    return dataframe, {**meta, "columns": list(dataframe.columns)}
+
+
+class Container( object ):
+    """ container of quadrant outputs (see compact_files) """
+
+    def __init__(self, dirpath):
+        """
+        Parameters
+        ----------
+        dirpath: [string]
+            container directory (see get_container_dir())
+        """
+        self._dirpath = dirpath
+
+    # ------- #
+    #  I/O    #
+    # ------- #
+    def add_files(self, files):
+        """ adds (or replaces) files in the container.
+
+        Parameters
+        ----------
+        files: [list of string]
+            quadrant output files (see compact_files)
+
+        Returns
+        -------
+        None
+        """
+        files = list(np.atleast_1d(files))
+        os.makedirs(os.path.join(self.dirpath, TABLE_DIR), exist_ok=True)
+        entries = []
+        kinds = pandas.Series([get_file_kind(f_) for f_ in files])
+        # - Tables
+        for kind, kfiles in pandas.Series(files).groupby(kinds.values):
+            if kind == "archive":
+                continue
+            data = []
+            for f_ in kfiles.values:
+                df_, meta_ = _read_table_file_(f_)
+                prefix = parse_filename(f_)[0]
+                data.append(df_.assign(prefix=prefix))
+                entries.append({"filename": os.path.basename(f_), "prefix": prefix, "kind": kind,
+                                "member": self.get_tablefile(kind, basename=True), "meta": json.dumps(meta_)})
+            self._update_table_(kind, pandas.concat(data, ignore_index=True))
+
+        # - Archive
+        archived = [f_ for f_, k_ in zip(files, kinds) if k_ == "archive"]
+        if len(archived)>0:
+            self._update_archive_(archived)
+            entries += [{"filename": os.path.basename(f_), "prefix": parse_filename(f_)[0],
+                         "kind": "archive", "member": os.path.basename(f_), "meta": "{}"}
+                        for f_ in archived]
+
+        index = pandas.DataFrame(entries, columns=["filename", "prefix", "kind", "member", "meta"])
+        if self.has_index():
+            index = pandas.concat([self.index[~self.index["filename"].isin(index["filename"])], index])
+        self._write_atomic_(lambda f_: index.to_parquet(f_, index=False), self.indexfile)
+        self._index = index.set_index("filename", drop=False)
+        _CONTAINERS[os.path.normpath(self.dirpath)] = self # memoized one up to date
+
+    def _update_table_(self, kind, data):
+        """ merges data (replacing their prefixes) in the kind table """
+        tablefile = self.get_tablefile(kind)
+        if os.path.isfile(tablefile):
+            current = pandas.read_parquet(tablefile)
+            data = pandas.concat([current[~current["prefix"].isin(data["prefix"].unique())], data],
+                                 ignore_index=True)
+        # sorted by prefix such that reading a quadrant only reads its row groups
+        data = data.sort_values("prefix", kind="stable")
+        self._write_atomic_(lambda f_: data.to_parquet(f_, index=False, row_group_size=2**14), tablefile)
+
+    def _update_archive_(self, files):
+        """ adds the files to the archive (rebuilt if some are already stored) """
+        basenames = [os.path.basename(f_) for f_ in files]
+        if os.path.isfile(self.archivefile):
+            with zipfile.ZipFile(self.archivefile, "r") as zf:
+                existing = zf.namelist()
+            if not np.any(np.isin(basenames, existing)):
+                with zipfile.ZipFile(self.archivefile, "a", compression=zipfile.ZIP_STORED) as zf:
+                    for f_, b_ in zip(files, basenames):
+                        zf.write(f_, arcname=b_)
+                return
+            kept = [k for k in existing if k not in basenames]
+        else:
+            kept = []
+
+        def _write_(tmpfile):
+            with zipfile.ZipFile(tmpfile, "w", compression=zipfile.ZIP_STORED) as zf:
+                if len(kept)>0:
+                    with zipfile.ZipFile(self.archivefile, "r") as current:
+                        for k in kept:
+                            zf.writestr(current.getinfo(k), current.read(k))
+                for f_, b_ in zip(files, basenames):
+                    zf.write(f_, arcname=b_)
+
+        self._write_atomic_(_write_, self.archivefile)
+
+    @staticmethod
+    def _write_atomic_(writer, filename):
+        """ writer(tmpfile) then moved to filename """
+        tmpfile = filename + ".tmp"
+        writer(tmpfile)
+        os.replace(tmpfile, filename)
+
+    # ------- #
+    # GETTER  #
+    # ------- #
+    def has_index(self):
+        """ """
+        return os.path.isfile(self.indexfile)
+
+    def has_file(self, filename):
+        """ test if the file (basename) is in the container """
+        return self.has_index() and os.path.basename(filename) in self.index.index
+
+    def get_entry(self, filename):
+        """ index entry (Series) of the given file """
+        if not self.has_file(filename):
+            raise IOError(f"{os.path.basename(filename)} is not in the container {self.dirpath}")
+        return self.index.loc[os.path.basename(filename)]
+
+    def get_tablefile(self, kind, basename=False):
+        """ table file of the given kind """
+        tablefile = os.path.join(TABLE_DIR, f"{kind}.parquet")
+        return tablefile if basename else os.path.join(self.dirpath, tablefile)
+
+    def get_columns(self, filename):
+        """ columns of the given table file (index excluded for parquet files) """
+        meta = json.loads(self.get_entry(filename)["meta"])
+        return [k for k in meta["columns"] if meta["format"] == "fits" or
+                k != (meta["index"] if meta["index"] is not None else "index")]
+
+    def read_table(self, filename, columns=None):
+        """ DataFrame of the given table file (psfshape, psfcat_gaia, shapecat_gaia)
+
+        Parameters
+        ----------
+        filename: [string]
+            original filename (only the basename matters)
+
+        columns: [list or None] -optional-
+            columns to read. All if None.
+
+        Returns
+        -------
+        DataFrame (as stored in the original parquet file, or as read from the fits file)
+        """
+        entry = self.get_entry(filename)
+        if entry["kind"] == "archive":
+            raise ValueError(f"{entry['filename']} is not a table file")
+
+        meta = json.loads(entry["meta"])
+        indexkey = meta["index"] if meta["index"] is not None else "index"
+        if columns is None:
+            columns = meta["columns"]
+        elif meta["format"] == "parquet":
+            columns = [indexkey] + [k for k in columns if k != indexkey]
+
+        data = pandas.read_parquet(os.path.join(self.dirpath, entry["member"]), columns=columns,
+                                   filters=[("prefix", "==", entry["prefix"])])
+        if meta["format"] == "parquet":
+            data = data.set_index(indexkey)
+            if meta["index"] is None:
+                data.index.name = None
+        return data
+
+    def read_catalog(self, filename, name=None, index_col="Source", **kwargs):
+        """ Catalog of the given catalog file (as Catalog.read_fits)
+
+        **kwargs goes to Catalog.__init__ (wcs, header, mask, xyformat)
+        """
+        from astropy.io import fits
+        from .catalog import Catalog
+        dataframe = self.read_table(filename)
+        if index_col is not None and index_col in dataframe.columns:
+            dataframe = dataframe.set_index(index_col)
+
+        this = Catalog(dataframe, name=name, filename=filename, **kwargs)
+        meta = json.loads(self.get_entry(filename)["meta"])
+        if meta.get("header") is not None:
+            this.set_header(fits.Header.fromstring(meta["header"]))
+        return this
+
+    def read_bytes(self, filename):
+        """ content of the given archived file """
+        entry = self.get_entry(filename)
+        if entry["kind"] != "archive":
+            raise ValueError(f"{entry['filename']} is not an archived file")
+        with zipfile.ZipFile(self.archivefile, "r") as zf:
+            return zf.read(entry["member"])
+
+    def read_json(self, filename):
+        """ dict of the given archived json file (e.g. piff_config.json) """
+        return json.loads(self.read_bytes(filename))
+
+    def read_psf(self, filename, logger=None):
+        """ piff.PSF of the given archived piff file.
+        (piff reads from files: the file is extracted in a temporary file)
+        """
+        import tempfile
+        import piff
+        with tempfile.NamedTemporaryFile(suffix=".piff") as tmp:
+            tmp.write(self.read_bytes(filename))
+            tmp.flush()
+            return piff.PSF.read(file_name=tmp.name, logger=logger)
+
+    def extract(self, filename, dirout):
+        """ writes back the given file in dirout, returns the extracted filename """
+        entry = self.get_entry(filename)
+        fileout = os.path.join(dirout, entry["filename"])
+        if entry["kind"] == "archive":
+            with open(fileout, "wb") as f_:
+                f_.write(self.read_bytes(filename))
+            return fileout
+
+        meta = json.loads(entry["meta"])
+        if meta["format"] == "fits":
+            from astropy.io import fits
+            from .catalog import dataframe_to_recarray
+            dataframe = self.read_table(filename)
+            data = dataframe_to_recarray(dataframe.set_index(dataframe.columns[0]))
+            fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU(data=data,
+                                                              header=fits.Header.fromstring(meta["header"]))]
+                         ).writeto(fileout, overwrite=True)
+        else:
+            self.read_table(filename).to_parquet(fileout)
+        return fileout
+
+    # =============== #
+    #  Properties     #
+    # =============== #
+    @property
+    def dirpath(self):
+        """ """
+        return self._dirpath
+
+    @property
+    def indexfile(self):
+        """ """
+        return os.path.join(self.dirpath, INDEX_NAME)
+
+    @property
+    def archivefile(self):
+        """ """
+        return os.path.join(self.dirpath, ARCHIVE_NAME)
+
+    @property
+    def index(self):
+        """ container index (DataFrame indexed by file basename) """
+        if not hasattr(self, "_index"):
+            self._index = pandas.read_parquet(self.indexfile).set_index("filename", drop=False)
+        return self._index
+
+    @property
+    def filenames(self):
+        """ basenames of the stored files """
+        return list(self.index["filename"])
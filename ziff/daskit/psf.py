@@ -4,16 +4,20 @@
 from ztfquery import io
 from .. import base
 
-def get_ziff_psf_cat(file_, whichpsf="psf_PixelGrid_BasisPolynomial5.piff"):
-    """ """
-    files_needed = io.get_file(file_, suffix=[whichpsf,"sciimg.fits", "mskimg.fits",
-                                              "shapecat_gaia.fits"], check_suffix=False)
+def get_ziff_psf_cat(file_, whichpsf="psf_PixelGrid_BasisPolynomial5.piff", use_cache=True):
+    """ ziff, psf and catalog of the given file (cached per process if use_cache, see ziff.cache) """
+    # psf and catalog may be compacted in a container (see ziff.container)
+    from ..container import get_local_files
+    # worker-level cache of the loaded inputs (see ziff.cache)
+    from ..cache import get_ziff, get_catalog, get_psf
+    files_needed = get_local_files(file_, suffix=[whichpsf,"sciimg.fits", "mskimg.fits",
+                                                  "shapecat_gaia.fits"])
     # Dask
     psffile, sciimg, mkimg, catfile = files_needed[0],files_needed[1],files_needed[2],files_needed[3]
 
-    ziff         = base.ZIFF(sciimg, mkimg, fetch_psf=False)
-    cat_toshape  = base.catlib.Catalog.load(catfile, wcs=ziff.wcs)
-    psf          = base.piff.PSF.read(file_name=psffile, logger=None)
+    ziff         = get_ziff(sciimg, mkimg, fetch_psf=False, lazy=True, use_cache=use_cache)
+    cat_toshape  = get_catalog(catfile, wcs=ziff.wcs, use_cache=use_cache)
+    psf          = get_psf(psffile, logger=None, use_cache=use_cache)
     
     return ziff, psf, cat_toshape
 
@@ -16,6 +16,8 @@ from .. import base
 from .. import io as zio
 from . import basecluster
 from .psf import get_ziff_psf_cat
+from ..stampstore import STAMP_KEYS, fetch_psfshape_stamps
+from ..shapestore import ShapeStore, read_shapes
 
 def compute_shapes(file_, use_dask=False, incl_residual=True, incl_stars=True,
                        whichpsf="psf_PixelGrid_BasisPolynomial5.piff",
@@ -47,14 +49,24 @@ def build_digitalized_shape(filenames, urange, vrange, savefile, bins=200, chunk
 
     - Returns delayed calls - 
 
+    filenames: [list of path or ShapeStore]
+        psfshape.parquet files or ShapeStore.
+        For a ShapeStore, there is one chunk per (filter, yearmonth) partition
+        (chunks ignored, see ShapeStore.get_partitions())
     """
+    bins_u = np.linspace(*urange, bins)
+    bins_v = np.linspace(*vrange, bins)
+    if isinstance(filenames, ShapeStore):
+        partitions = filenames.get_partitions(["filter", "yearmonth"])
+        return [dask.delayed(get_sigma_data)(filenames, bins_u, bins_v, minimal=minimal,
+                                             query={"filtername": p_["filter"], "yearmonth": p_["yearmonth"]},
+                                             savefile=None if savefile is None else savefile.replace(".parquet",f"_chunk{i}.parquet"),**kwargs)
+                    for i, p_ in enumerate(partitions)]
+
     filedf = zio.get_filedataframe(filenames)
     grouped = filedf.groupby("filefracday")
     groupkeys = list( grouped.groups.keys() )
     
-    bins_u = np.linspace(*urange, bins)
-    bins_v = np.linspace(*vrange, bins)
-
     chunck_filenames = [np.concatenate([grouped["filename"].get_group(g_).values for g_ in chunk])
                             for chunk in np.array_split(groupkeys, chunks)]
     
@@ -86,11 +98,16 @@ def build_digitalize_psfdata(filenames, valrange, key, savefile,
     return delayed_chunks
 
 def get_binned_data(files, bin_val, key, savefile=None, columns=None,
-                    quantity='sigma', normref="model"):
-    """ """
-    filefracday = [f.split("/")[-1].split("_")[1] for f in files]
-    df = pandas.concat([pandas.read_parquet(f, columns=columns) for f in files], keys=filefracday
-                           ).reset_index().rename({"level_0":"filefracday"}, axis=1)
+                    quantity='sigma', normref="model", query=None):
+    """ 
+    files: [list of path or ShapeStore]
+        psfshape.parquet files or ShapeStore (see ziff.shapestore.read_shapes)
+
+    query: [dict or None] -optional-
+        // ShapeStore only //
+        predicates of ShapeStore.query() (e.g. obsjd_range, fieldid, rcid, gmag_range)
+    """
+    df = read_shapes(files, columns=columns, query=query)
 
 
     norm = df.groupby(["obsjd"])[f"{quantity}_{normref}"].transform("median")
@@ -109,8 +126,16 @@ def get_sigma_data(files, bins_u, bins_v,
                     minimal=False,
                    quantity='sigma', normref="model", incl_residual=True,
                    basecolumns=['u', 'v', 'ccdid', 'qid', 'rcid', 'obsjd', 'fieldid','filterid', 'maglim'],
-                   savefile=None,
+                   savefile=None, query=None,
                   ):
+    """ 
+    files: [list of path or ShapeStore]
+        psfshape.parquet files or ShapeStore (see ziff.shapestore.read_shapes)
+
+    query: [dict or None] -optional-
+        // ShapeStore only //
+        predicates of ShapeStore.query() (e.g. obsjd_range, fieldid, rcid, gmag_range)
+    """
     if minimal:
         shape_columns = [f"{quantity}_data",  f"{quantity}_model"]
         incl_residual = False
@@ -124,9 +149,7 @@ def get_sigma_data(files, bins_u, bins_v,
     if incl_residual: 
         columns += ["residual"]
 
-    filefracday = [f.split("/")[-1].split("_")[1] for f in files]
-    df = pandas.concat([pandas.read_parquet(f, columns=columns) for f in files], keys=filefracday
-                           ).reset_index().rename({"level_0":"filefracday"}, axis=1)
+    df = read_shapes(files, columns=columns, query=query)
     
     norm = df.groupby(["obsjd"])[f"{quantity}_{normref}"].transform("median")
     
@@ -142,8 +165,11 @@ def get_sigma_data(files, bins_u, bins_v,
 
 def fetch_parquetsource_data(filename, datakey, sources=None):
     """ """
-    data    = pandas.read_parquet(io.get_file(filename, suffix="psfshape.parquet", check_suffix=False),
-                                    columns=[datakey])
+    filename = io.get_file(filename, suffix="psfshape.parquet", check_suffix=False)
+    if datakey in STAMP_KEYS: # (N, ny, nx) stamp cube
+        return fetch_psfshape_stamps(filename, datakey, sources=sources)
+    
+    data    = pandas.read_parquet(filename, columns=[datakey])
     if sources is not None:
         data = data.loc[sources]
         
@@ -205,6 +231,27 @@ class PSFShapeAnalysis( basecluster.DaskCluster ):
         this.load_fromdir(dirout, patern=savefile_base+f"*{bins}*.parquet")
         return this
 
+    @classmethod
+    def from_shapestore(cls, shapestore, urange, vrange, bins, client,
+                            subdir=None, digit_basename="psfshape", **kwargs):
+        """ digitalize the shapes of a ShapeStore (one chunk per filter and yearmonth).
+
+        shapestore: [ShapeStore or string]
+            ShapeStore or its directory (see ziff.shapestore)
+
+        **kwargs goes to build_digitalized_shape (e.g. minimal)
+        """
+        if not isinstance(shapestore, ShapeStore):
+            shapestore = ShapeStore(shapestore)
+            
+        this = cls(client=client)
+        this.set_binning(urange=urange, vrange=vrange, bins=bins)
+
+        dirout = zio.get_digit_dir(subdir=subdir)
+        savefile_base = os.path.join(dirout, digit_basename)
+        this.cbuild_digitalized_shape(shapestore, savefile_base, load_data=True, **kwargs)
+        return this
+
     @classmethod
     def from_shapefiles(cls, shapefiles, urange, vrange, bins, client, chunks=300,
                             subdir=None, digit_basename="psfshape", **kwargs):
@@ -251,8 +298,8 @@ class PSFShapeAnalysis( basecluster.DaskCluster ):
 
         Parameters
         ----------
-        parquetfiles: [list of path]
-            The psfshape parquet files to be digitalized.w
+        parquetfiles: [list of path or ShapeStore]
+            The psfshape parquet files (or ShapeStore) to be digitalized.
 
         savefile_base: [string]
             Incomplete full path used to create the structure of the digitalized data.
@@ -266,7 +313,7 @@ class PSFShapeAnalysis( basecluster.DaskCluster ):
         list of: "futures or delayed" depending on client.
         """
         
-        if len(parquetfiles) <= chunks:
+        if not isinstance(parquetfiles, ShapeStore) and len(parquetfiles) <= chunks:
             raise ValueError(f"more chunks than files ({chunks} vs. {len(parquetfiles)}")
 
         if np.any([v is None for v in self.binning.values()]):
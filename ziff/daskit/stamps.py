@@ -1,6 +1,7 @@
 
 
 """ NOT READY YET """
+from ..stampstore import STAMP_KEYS, fetch_psfshape_stamps
 
 def _fetch_filesource_sky_(filename, buffer=2, datakey="stars", sources=None,
                                statistic="median", **kwargs):
@@ -10,8 +11,11 @@ def _fetch_filesource_sky_(filename, buffer=2, datakey="stars", sources=None,
 
 def _fetch_filesource_data_(filename, datakey, sources=None):
     """ """
-    data    = pandas.read_parquet(io.get_file(filename, suffix="psfshape.parquet", check_suffix=False),
-                                    columns=[datakey])
+    filename = io.get_file(filename, suffix="psfshape.parquet", check_suffix=False)
+    if datakey in STAMP_KEYS: # (N, ny, nx) stamp cube
+        return fetch_psfshape_stamps(filename, datakey, sources=sources)
+    
+    data    = pandas.read_parquet(filename, columns=[datakey])
     if sources is not None:
         data = data.loc[sources]
         
@@ -27,7 +31,7 @@ def _residual_to_skydata_(residuals, buffer=2, statistic="median", returns="all"
     if returns not in ["stamp", "meanstat", "all", "both", "*"]:
         raise ValueError(f"returns must be 'stamp', 'meanstat', 'all'/'both'/'*' {returns} given.")
     
-    residuals  = residuals.reshape(len(residuals), 15, 15)
+    residuals  = np.array(residuals).reshape(len(residuals), 15, 15)
     residuals[:, buffer:-buffer,buffer:-buffer] = np.NaN
     if statistic is not None:
         stampout = getattr(np,statistic)(residuals, axis=0)
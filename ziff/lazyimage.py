@@ -0,0 +1,177 @@
+""" Lazy (memory-mapped, on-demand decoded) ZTF images.
+
+Only the header is read when loading. Pixels are accessed through LazyFitsArray:
+uncompressed fits are memory mapped (only the touched pages are read),
+tile-compressed fits are decoded per requested section (only the needed tiles).
+"""
+
+import numpy as np
+from astropy.io import fits
+
+from ztfimg import image as ztfimage
+
+
+class LazyFitsArray( object ):
+    """ on-demand array of a fits image extension.
+    Slicing (array[y0:y1, x0:x1]) only reads the corresponding part of the file,
+    the full array is read (memory mapped if uncompressed) by np.asarray() or .array.
+    """
+    def __init__(self, filename, ext=None):
+        """
+        Parameters
+        ----------
+        filename: [string]
+            fits file
+
+        ext: [int or None] -optional-
+            image extension, the first extension with data if None.
+        """
+        self._filename = filename
+        self._ext = ext
+
+    def __getitem__(self, key):
+        """ """
+        if not self.is_compressed() or self.is_loaded():
+            return self.array[key]
+        # only decodes the needed tiles.
+        return self.hdu.section[key]
+
+    def __array__(self, dtype=None, copy=None):
+        """ """
+        return np.asarray(self.array, dtype=dtype)
+
+    def __len__(self):
+        """ """
+        return self.shape[0]
+
+    def __getstate__(self):
+        """ pickled without the opened file (e.g. for dask), reopened when needed. """
+        return {"_filename": self._filename, "_ext": self._ext}
+
+    # ================ #
+    #   Methods        #
+    # ================ #
+    def open(self):
+        """ opens (memory mapped) the fits file, see hdu """
+        if not self.is_open():
+            self._hdulist = fits.open(self._filename, memmap=True)
+            if self._ext is None:
+                self._ext = [i for i, hdu_ in enumerate(self._hdulist)
+                             if hdu_.is_image and len(hdu_.shape)>0][0]
+
+    def close(self):
+        """ closes the file (and drops the loaded array) """
+        if self.is_open():
+            self._hdulist.close()
+            del self._hdulist
+        if self.is_loaded():
+            del self._array
+
+    def is_open(self):
+        """ """
+        return hasattr(self, "_hdulist")
+
+    def is_loaded(self):
+        """ test if the full array has been read """
+        return hasattr(self, "_array")
+
+    def is_compressed(self):
+        """ test if the image is a tile-compressed one """
+        return isinstance(self.hdu, fits.CompImageHDU)
+
+    # ================ #
+    #   Properties     #
+    # ================ #
+    @property
+    def filename(self):
+        """ """
+        return self._filename
+
+    @property
+    def hdu(self):
+        """ fits hdu of the image """
+        self.open()
+        return self._hdulist[self._ext]
+
+    @property
+    def array(self):
+        """ full image array (memory mapped for uncompressed images) """
+        if not self.is_loaded():
+            self._array = self.hdu.data
+        return self._array
+
+    @property
+    def shape(self):
+        """ shape (from the header, no data read) """
+        return self.hdu.shape
+
+    @property
+    def ndim(self):
+        """ """
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        """ data type """
+        return self.array.dtype if self.is_loaded() else self[:1, :1].dtype
+
+
+class LazyScienceImage( ztfimage.ScienceImage ):
+    """ ztfimg ScienceImage reading its data and mask on demand (see LazyFitsArray).
+    .data and .mask are the (memory mapped) full arrays, .lazydata and .lazymask
+    the LazyFitsArray to get sections without reading the full images.
+    """
+    def load_data(self, imagefile, **kwargs):
+        """ """
+        self._filename = imagefile
+        self._lazydata = LazyFitsArray(imagefile, **kwargs)
+        self._header = self._lazydata.hdu.header
+
+    def load_mask(self, maskfile, **kwargs):
+        """ """
+        self._lazymask = LazyFitsArray(maskfile, **kwargs)
+        self._maskheader = self._lazymask.hdu.header
+
+    def close(self):
+        """ closes the image and mask files """
+        for lazy_ in [self.lazydata, self.lazymask]:
+            if lazy_ is not None:
+                lazy_.close()
+
+    # =============== #
+    #  Properties     #
+    # =============== #
+    @property
+    def lazydata(self):
+        """ LazyFitsArray of the image """
+        if not hasattr(self, "_lazydata"):
+            return None
+        return self._lazydata
+
+    @property
+    def lazymask(self):
+        """ LazyFitsArray of the mask """
+        if not hasattr(self, "_lazymask"):
+            return None
+        return self._lazymask
+
+    @property
+    def data(self):
+        """ Image data """
+        if not hasattr(self, "_data"):
+            return self.lazydata.array
+        return self._data
+
+    @property
+    def mask(self):
+        """ Mask data associated to the data """
+        if not hasattr(self, "_mask"):
+            if self.lazymask is not None:
+                return self.lazymask.array
+            self._mask = np.asarray(np.zeros(self.shape), dtype='bool')
+        return self._mask
+
+    @property
+    def shape(self):
+        """ Shape of the data (no data read) """
+        return self.lazydata.shape if not hasattr(self, "_data") else self._data.shape
@@ -7,21 +7,62 @@ from __future__ import print_function
 import numpy as np
 import galsim
 
-from scipy.ndimage import gaussian_filter
+from collections import OrderedDict
+from scipy.ndimage import correlate1d
 from piff.pixelgrid import PixelGrid
 from piff.star import Star, StarData, StarFit
 
 
+SPARSE_ERROR = ("ConvolvedPixelGrid(sparse=True) is only supported by interpolators solving "
+                "the normal equations (star.fit.alpha/beta, e.g. BasisPolynomial(use_qr=False)). "
+                "use sparse=False.")
+
+def check_sparse_interp(model, interp):
+    """ raises a NotImplementedError if the model has a sparse design matrix (sparse=True)
+    and the interpolator uses the dense design matrix star.fit.A (use_qr=True or no
+    quadratic chisq fit, i.e. the model.fit path).
+    """
+    if not getattr(model, "sparse", False):
+        return
+    if getattr(interp, "use_qr", False) or not getattr(interp, "degenerate_points", False):
+        raise NotImplementedError(SPARSE_ERROR)
+
 class ConvolvedPixelGrid( PixelGrid ):
     """ """
     _EXTRA_TERM = 1
+    _CACHE_SIZE = 128 # max number of entries per memoization cache
+    _COEFF_CACHE_SIZE = 256 # max number of stars in the interpolation coefficient cache
+    _LUT_OVERSAMPLING = 1000 # number of lanczos table samples per pixel
 
     def __init__(self, scale, size, interp=None, centered=True, logger=None,
-                 start_sigma=None, degenerate=None, **kwargs):
-        """ """
+                 start_sigma=None, degenerate=None, sparse=False, sigma_convol_start=0.5,
+                 sigma_convol_damping=1e-3, **kwargs):
+        """ 
+        sparse: [bool] -optional-
+            if True, the chisq design matrix (star.fit.A) is built and stored as a scipy.sparse
+            csr_matrix (see SparseStarFit). Only for interpolators solving the normal equations
+            (e.g. BasisPolynomial(use_qr=False)), see check_sparse_interp().
+            The convolution spreads the rows: this saves memory for small widths only.
+
+        sigma_convol_start: [float] -optional-
+            initial gaussian convolution width [in grid pixels]. 
+            The model is quadratic in sigma around 0, so this should not be ~0 
+            for the width to be fitted.
+
+        sigma_convol_damping: [float] -optional-
+            damping of the convolution width step (Levenberg-Marquardt like), relative to
+            the mean squared column of the design matrix. The width is degenerate with the
+            pixel grid and its undamped step diverges when interpolated (BasisPolynomial order>=1).
+        """
         _ = super().__init__(scale, size, interp=interp, centered=centered,
                                  logger=logger, start_sigma=start_sigma,
                                  degenerate=degenerate, **kwargs)
+        self.sparse = sparse
+        self.kwargs["sparse"] = sparse
+        self.sigma_convol_start = sigma_convol_start
+        self.kwargs["sigma_convol_start"] = sigma_convol_start
+        self.sigma_convol_damping = sigma_convol_damping
+        self.kwargs["sigma_convol_damping"] = sigma_convol_damping
         
         logger = galsim.config.LoggerWrapper(logger)
         self._nparams = size*size + self._EXTRA_TERM
@@ -86,14 +127,18 @@ class ConvolvedPixelGrid( PixelGrid ):
         # Normalize to get unity flux
         params_pixelgrid /= np.sum(params_pixelgrid)*self.pixel_area
         
-        # + CHANGE: add an extra term ; sigma convolve 0 by default
-        params = np.append(params_pixelgrid, np.ones(self._EXTRA_TERM)*1e-5)
+        # + CHANGE: add an extra term ; sigma convolve
+        params = np.append(params_pixelgrid, np.ones(self._EXTRA_TERM)*self.sigma_convol_start)
 
         starfit = StarFit(params, flux, center)
         return Star(star.data, starfit)
 
 
-    # def fit(self, star, logger=None): # no change
+    def fit(self, star, logger=None):
+        """ PixelGrid.fit (non interpolated fit path), not available for sparse design matrices """
+        if self.sparse:
+            raise NotImplementedError(SPARSE_ERROR)
+        return super().fit(star, logger=logger)
     
     def chisq(self, star, logger=None):
         """Calculate dependence of chi^2 = -2 log L(D|p) on PSF parameters for single star.
@@ -110,32 +155,13 @@ class ConvolvedPixelGrid( PixelGrid ):
         # Start by getting all interpolation coefficients for all observed points
         data, weight, u, v = star.data.getDataVector()
 
-        # Subtract star.fit.center from u, v:
-        u -= star.fit.center[0]
-        v -= star.fit.center[1]
-
         # Only use pixels covered by the model.
-        mask = (np.abs(u) <= self.maxuv) & (np.abs(v) <= self.maxuv)
+        # The returned arrays here are Ndata x Ninterp (see get_interp_coefficients)
+        # coefficients of pixels outside the psf grid are null.
+        mask, coeffs, index1d = self.get_interp_coefficients(star, u, v)[:3]
         data = data[mask]
         weight = weight[mask]
-        u = u[mask]
-        v = v[mask]
-
-        # Compute the full set of coefficients for each pixel in the data
-        # The returned arrays here are Ndata x Ninterp.
-        # Each column column corresponds to a different x,y value in the model that could
-        # contribute information about the given data pixel.
-        coeffs, psfx, psfy = self.interp_calculate(u/self.scale, v/self.scale)
-        # -> coeffs = size**2
-        
-        # Turn the (psfy,psfx) coordinates into an index into 1d parameter vector.
-        index1d = self._indexFromPsfxy(psfx, psfy)
-        # All invalid pixel references now have negative index; record and set to zero
-        nopsf = index1d < 0
-        alt_index1d = np.where(nopsf, 0, index1d)
-        # And null the coefficients for such pixels
-        # This just makes it easier to do the sums, since then the nopsf values won't contribute.
-        coeffs = np.where(nopsf, 0., coeffs)
+        alt_index1d = np.where(index1d < 0, 0, index1d)
 
         # Multiply kernel (and derivs) by current PSF element values to get current estimates
         pvals = self.get_pixelparams(star.fit.params, flatten=True)[alt_index1d]
@@ -153,21 +179,17 @@ class ConvolvedPixelGrid( PixelGrid ):
         #
         # The weights are dealt with in the standard way, by multiplying both A and b by sqrt(w).
 
-        A = np.zeros((len(data), self._nparams), dtype=float)
-        for i in range(len(data)):
-            ii = index1d[i,:]
-            cc = coeffs[i,:]
-            # Select only those with ii >= 0
-            cc = cc[ii>=0] * scaled_flux
-            ii = ii[ii>=0]
-            A[i,ii] = cc
         sw = np.sqrt(weight)
-        Aw = A * sw[:,np.newaxis]
-        bw = resid * sw
+        # the width is degenerate with the grid: its step is damped by an extra row of A
+        # (see get_design_matrix), with a null residual.
+        Aw = self.get_design_matrix(coeffs*scaled_flux*sw[:,np.newaxis], index1d,
+                                        params=star.fit.params, sparse=self.sparse,
+                                        damping=self.sigma_convol_damping)
+        bw = np.append(resid * sw, 0.)
         chisq = np.sum(bw**2)
         dof = np.count_nonzero(weight)
 
-        outfit = StarFit(star.fit.params,
+        outfit = (SparseStarFit if self.sparse else StarFit)(star.fit.params,
                          flux = star.fit.flux,
                          center = star.fit.center,
                          params_var = star.fit.params_var,
@@ -185,9 +207,12 @@ class ConvolvedPixelGrid( PixelGrid ):
 
         :returns: a galsim.GSObject instance
         """
-        im = galsim.Image(self.get_pixelparams(params, flatten=False), scale=self.scale)
-        return galsim.InterpolatedImage(im, x_interpolant=self.interp,
-                                        normalization='sb', use_true_center=False, flux=1.)
+        def _build_profile_():
+            im = galsim.Image(self.get_pixelparams(params, flatten=False).copy(), scale=self.scale)
+            return galsim.InterpolatedImage(im, x_interpolant=self.interp,
+                                            normalization='sb', use_true_center=False, flux=1.)
+
+        return self._get_cached_("profile", self._get_paramskey_(params), _build_profile_)
 
     def normalize(self, star):
         """Make sure star.fit.params are normalized properly.
@@ -203,8 +228,8 @@ class ConvolvedPixelGrid( PixelGrid ):
             raise NotImplementedError(f"size of parameter {nparams1} don't match the expectation {nparams2}+{self._EXTRA_TERM}")
 
         # Normally this is all that is required.
-        star.fit.params[:self._EXTRA_TERM] /= np.sum(star.fit.params[:self._EXTRA_TERM]
-                                                    )*self.pixel_area
+        star.fit.params[:-self._EXTRA_TERM] /= np.sum(star.fit.params[:-self._EXTRA_TERM]
+                                                     )*self.pixel_area
 
     def reflux(self, star, fit_center=True, logger=None):
         """Fit the Model to the star's data, varying only the flux (and
@@ -245,35 +270,13 @@ class ConvolvedPixelGrid( PixelGrid ):
         # Start by getting all interpolation coefficients for all observed points
         data, weight, u, v = star.data.getDataVector()
 
-        u -= center[0]
-        v -= center[1]
-        mask = (np.abs(u) <= self.maxuv) & (np.abs(v) <= self.maxuv)
+        # Build the model and maybe also d(model)/dcenter
+        # This tracks the same steps in chisq (see get_interp_coefficients)
+        mask, coeffs, index1d, dcdu, dcdv = self.get_interp_coefficients(star, u, v)
         data = data[mask]
         weight = weight[mask]
-        u = u[mask]
-        v = v[mask]
-
-        # Build the model and maybe also d(model)/dcenter
-        # This tracks the same steps in chisq.
-        # TODO: Make a helper function to consolidate the common code.
-        if self._centered:
-            coeffs, psfx, psfy, dcdu, dcdv = self.interp_calculate(u/self.scale, v/self.scale,
-                                                                  True)
-            dcdu /= self.scale
-            dcdv /= self.scale
-        else:
-            coeffs, psfx, psfy = self.interp_calculate(u/self.scale, v/self.scale)
-        
-        # Turn the (psfy,psfx) coordinates into an index into 1d parameter vector.
-        index1d = self._indexFromPsfxy(psfx, psfy)
-        # All invalid pixel references now have negative index; record and set to zero
         nopsf = index1d < 0
         alt_index1d = np.where(nopsf, 0, index1d)
-        # And null the coefficients for such pixels
-        coeffs = np.where(nopsf, 0., coeffs)
-        if self._centered:
-            dcdu = np.where(nopsf, 0., dcdu)
-            dcdv = np.where(nopsf, 0., dcdv)
 
         # Multiply kernel (and derivs) by current PSF element values to get current estimates
         pvals = self.get_pixelparams(star.fit.params, flatten=True)[alt_index1d]
@@ -341,20 +344,482 @@ class ConvolvedPixelGrid( PixelGrid ):
                                        A = star.fit.A,
                                        b = star.fit.b))
 
-    # def interp_calculate(self, u, v, derivs=False): # No change
+    def reflux_stars(self, stars, fit_center=True, logger=None):
+        """ batch version of reflux(): all the stars are refluxed at once.
+
+        :param stars:       list of Star instances (with interpolated params)
+        :param fit_center:  ignored, as in reflux() the center moves if the model is centered
+        :param logger:      A logger object for logging debug info. [default: None]
+
+        :returns: list of new Star instances, with updated flux, center, chisq, dof
+        """
+        flux, center, chisq, dof = self.get_reflux_solution(stars, fit_center=fit_center,
+                                                            logger=logger)
+        return [Star(star.data, StarFit(star.fit.params,
+                                        flux = flux_,
+                                        center = tuple(center_),
+                                        params_var = star.fit.params_var,
+                                        chisq = chisq_,
+                                        dof = dof_,
+                                        A = star.fit.A,
+                                        b = star.fit.b))
+                for star, flux_, center_, chisq_, dof_ in zip(stars, flux, center, chisq, dof)]
+
+    def get_reflux_solution(self, stars, fit_center=True, logger=None):
+        """ solve the reflux() problem for all the stars at once.
+
+        The pixels of all stars are stacked and the (1x1 or 3x3) normal equations
+        of every star are solved by a single batched np.linalg.solve.
+
+        Parameters
+        ----------
+        stars: [list of piff.Star]
+            stars with interpolated params.
+
+        fit_center: [bool] -optional-
+            ignored, as in reflux() (and piff's PixelGrid.reflux) the center moves
+            if the model is centered.
+
+        logger: [logger or None] -optional-
+            A logger object for logging debug info.
+
+        Returns
+        -------
+        flux, center, chisq, dof
+        - flux (N,), center (N, 2), chisq (N,) (expected new chisq) and dof (N,) arrays
+        """
+        logger = galsim.config.LoggerWrapper(logger)
+        stars = list(stars)
+        nstars = len(stars)
+        do_center = self._centered # as reflux(), fit_center is not used
+        logger.debug("Reflux for %d stars", nstars)
+
+        # Make sure input is properly normalized
+        for star in stars:
+            self.normalize(star)
+
+        grids = np.asarray([self.get_pixelparams(star.fit.params, flatten=True) for star in stars])
+        scaled_flux = np.asarray([star.fit.flux * star.data.pixel_area for star in stars])
+        pixel_area = np.asarray([star.data.pixel_area for star in stars])
+        center = np.asarray([star.fit.center for star in stars], dtype="float")
+
+        # Current centroid of the models (see reflux)
+        temp = grids.reshape(nstars, self.size, self.size)
+        delta_u = np.arange(-self._origin[0], self.size-self._origin[0])
+        delta_v = np.arange(-self._origin[1], self.size-self._origin[1])
+        norm = np.sum(temp, axis=(1,2))
+        params_cenu = np.sum(temp*delta_u[np.newaxis,np.newaxis,:], axis=(1,2))/norm
+        params_cenv = np.sum(temp*delta_v[np.newaxis,:,np.newaxis], axis=(1,2))/norm
+
+        # Stack the model (and derivs) pixels of all the stars
+        starid, data, weight, derivs = [], [], [], []
+        for i, star in enumerate(stars):
+            data_, weight_, u, v = star.data.getDataVector()
+            mask, coeffs, index1d, dcdu, dcdv = self.get_interp_coefficients(star, u, v)
+            # Multiply kernel (and derivs) by current PSF element values to get current estimates
+            pvals = grids[i][np.where(index1d < 0, 0, index1d)]
+            derivs_ = [np.sum(coeffs*pvals, axis=1)]
+            if do_center:
+                derivs_ += [scaled_flux[i] * np.sum(dcdu*pvals, axis=1),
+                            scaled_flux[i] * np.sum(dcdv*pvals, axis=1)]
+            starid.append(np.full(len(derivs_[0]), i))
+            data.append(data_[mask])
+            weight.append(weight_[mask])
+            derivs.append(np.vstack(derivs_).T)
+
+        starid = np.concatenate(starid)
+        data, weight = np.concatenate(data), np.concatenate(weight)
+        derivs = np.concatenate(derivs)
+        mod = derivs[:,0]
+        resid = data - mod*scaled_flux[starid]
+
+        # Per star normal equations AT A x = AT b (see reflux)
+        nterms = derivs.shape[1]
+        AtA = derivs[:,:,np.newaxis] * derivs[:,np.newaxis,:] * weight[:,np.newaxis,np.newaxis]
+        AtA = np.asarray([np.bincount(starid, weights=w_, minlength=nstars)
+                          for w_ in AtA.reshape(-1, nterms**2).T]).T.reshape(nstars, nterms, nterms)
+        Atb = np.asarray([np.bincount(starid, weights=w_, minlength=nstars)
+                          for w_ in (derivs * (weight*resid)[:,np.newaxis]).T]).T
+        x = np.linalg.solve(AtA, Atb[:,:,np.newaxis])[:,:,0]
+        chisq = np.bincount(starid, weights=resid**2 * weight, minlength=nstars)
+        dchi = np.sum(Atb*x, axis=1)
+        dof = np.bincount(starid, weights=weight != 0, minlength=nstars).astype("int")
+        logger.debug("total chisq = %s - %s => %s", chisq.sum(), dchi.sum(), (chisq-dchi).sum())
+
+        # update the flux (and center) of the stars
+        scaled_flux = scaled_flux + x[:,0]
+        if do_center:
+            # Also shift by the centroid of the model itself (see reflux)
+            center = center + x[:,1:] + np.asarray([params_cenu, params_cenv]).T*self.scale
+
+        return scaled_flux/pixel_area, center, chisq-dchi, dof
+
+    def interp_calculate(self, u, v, derivs=False):
+        """Calculate interpolation coefficient for vector of target points
+
+        Same as PixelGrid.interp_calculate() but the lanczos kernel (and its derivatives)
+        are read from an oversampled lookup table (see get_kernel_table()).
+        Derivatives are analytic rather than finite differences.
+
+        :param u:       1d array of target u coordinates
+        :param v:       1d array of target v coordinates
+        :param derivs:  whether to also return derivatives (default: False)
+
+        :returns: coeff, x, y[, dcdu, dcdv]
+        """
+        n = int(np.ceil(self.interp.xrange))
+        # Here is range of pixels to use in each dimension relative to ceil(u,v)
+        _duv = np.arange(-n, n, dtype=int)
+        # And here are flattened arrays of u, v displacement for whole footprint
+        _du = np.tile(_duv, 2*n)
+        _dv = np.repeat(_duv, 2*n)
+
+        # Get integer and fractional parts of u, v
+        u_ceil = np.ceil(u).astype(int)
+        v_ceil = np.ceil(v).astype(int)
+        # Make arrays giving coordinates of grid points within footprint
+        x = u_ceil[:,np.newaxis] + _du[np.newaxis,:]
+        y = v_ceil[:,np.newaxis] + _dv[np.newaxis,:]
+
+        ku, dku = self._kernel1d_table_(u_ceil-u)
+        kv, dkv = self._kernel1d_table_(v_ceil-v)
+        # Then take outer products to produce kernel
+        coeffs = (ku[:,np.newaxis,:] * kv[:,:,np.newaxis]).reshape(x.shape)
+        if not derivs:
+            return coeffs, x, y
+
+        dcdu = (dku[:,np.newaxis,:] * kv[:,:,np.newaxis]).reshape(x.shape)
+        dcdv = (ku[:,np.newaxis,:] * dkv[:,:,np.newaxis]).reshape(x.shape)
+        return coeffs, x, y, dcdu, dcdv
+
     # def _kernel1d(self, u): # No change
         
         
     # --------------- #
     #  Extra methods  #
     # --------------- #
+    def get_design_matrix(self, coeffs, index1d, params=None, sparse=False, damping=0):
+        """ build the design matrix A of the model.
+
+        Without params, this is A[i,j] = coeffs[i,k] where index1d[i,k] == j,
+        i.e. the derivative with respect to the (non-convolved) grid parameters.
+        With params, A is the derivative of the convolved model:
+        the grid columns include the gaussian convolution and the last column is the
+        analytic derivative with respect to the convolution width (extra term).
+
+        Parameters
+        ----------
+        coeffs: [2d array]
+            (ndata, nkernel) coefficients (already scaled and weighted)
+
+        index1d: [2d array]
+            (ndata, nkernel) parameter index of each coefficient.
+            (negative entries are ignored, see _indexFromPsfxy)
+
+        params: [1d array or None] -optional-
+            current model parameters.
+
+        sparse: [bool] -optional-
+            should this return a scipy.sparse.csr_matrix rather than a dense array ?
+
+        damping: [float] -optional-
+            with params, an extra row damps the step of the convolution width:
+            sqrt(damping * mean squared column of A) on the width column.
+            (the corresponding residual is 0, see chisq())
+
+        Returns
+        -------
+        (ndata, nparams) array or csr_matrix, (ndata+1, nparams) with params.
+        """
+        ndata, nparams_grid = len(index1d), self.size**2
+        valid = index1d >= 0
+        rows = np.broadcast_to(np.arange(ndata)[:,np.newaxis], index1d.shape)[valid]
+        convmatrix = None if params is None else self.get_convolution_matrix(self._get_sigma_(params))
+        if convmatrix is None:
+            # no (effective) convolution, simple scatter of the coefficients.
+            coeffs_, rows_, cols_ = coeffs[valid], rows, index1d[valid]
+        elif sparse:
+            # same as below, as a.(G x G) from the sparse coefficients (no dense A is built)
+            from scipy.sparse import csr_matrix, kron
+            convsparse = csr_matrix(convmatrix)
+            A = csr_matrix((coeffs[valid], (rows, index1d[valid])), shape=(ndata, nparams_grid))
+            A = A.dot(kron(convsparse, convsparse, format="csr")).tocoo()
+            coeffs_, rows_, cols_ = A.data, A.row, A.col
+        else:
+            # d(model)/dP = G^T a G, for a the coefficients on the grid and G the 1d convolution
+            A = np.zeros((ndata, nparams_grid), dtype=float)
+            A[rows, index1d[valid]] = coeffs[valid]
+            A = np.matmul(convmatrix.T, np.matmul(A.reshape(ndata, self.size, self.size),
+                                                  convmatrix)).reshape(ndata, nparams_grid)
+            rows_, cols_ = np.nonzero(A)
+            coeffs_ = A[rows_, cols_]
+
+        if params is not None:
+            # d(model)/dsigma
+            dpvals = self.get_pixelparams_derivative(params, flatten=True)[np.where(valid, index1d, 0)]
+            rows_ = np.concatenate([rows_, np.arange(ndata)])
+            cols_ = np.concatenate([cols_, np.full(ndata, self._nparams-1)])
+            coeffs_ = np.concatenate([coeffs_, np.sum(np.where(valid, coeffs, 0)*dpvals, axis=1)])
+            # damping of the width step
+            rows_ = np.append(rows_, ndata)
+            cols_ = np.append(cols_, self._nparams-1)
+            coeffs_ = np.append(coeffs_, np.sqrt(damping * np.sum(coeffs_**2)/self._nparams))
+            ndata += 1
+
+        if sparse:
+            from scipy.sparse import csr_matrix
+            return csr_matrix((coeffs_, (rows_, cols_)), shape=(ndata, self._nparams))
+
+        A = np.zeros((ndata, self._nparams), dtype=float)
+        A[rows_, cols_] = coeffs_
+        return A
+    
     def get_pixelparams(self, params, flatten=True):
-        """ """
-        im_params, extra_params = params[:-self._EXTRA_TERM], params[-self._EXTRA_TERM:]
-        sigma_convol = np.abs(extra_params[0])
-        
-        params_sq  = gaussian_filter(im_params.reshape(self.size,self.size), sigma_convol)
+        """ get the pixel grid convolved by the gaussian of width the extra term.
+        This is equivalent to scipy.ndimage.gaussian_filter (truncate=4, mode='reflect').
+
+        Results are memoized on the params values (see clear_cache()), 
+        the returned array is therefore read only.
+        """
+        params = np.asarray(params)
+        params_sq = self._get_cached_("pixelparams", self._get_paramskey_(params),
+                                      lambda : self._convolve_pixelparams_(params))
         if flatten:
             return params_sq.reshape(self.size*self.size)
                  
         return params_sq
+
+    def get_pixelparams_derivative(self, params, flatten=True):
+        """ derivative of get_pixelparams() with respect to the extra term (convolution width).
+        (memoized on the params values)
+        """
+        params = np.asarray(params)
+        def _build_derivative_():
+            sigma = self._get_sigma_(params)
+            grid = np.asarray(params[:-self._EXTRA_TERM], dtype=float).reshape(self.size,self.size)
+            convmatrix = self.get_convolution_matrix(sigma)
+            if convmatrix is None:
+                dgrid = np.zeros_like(grid)
+            else:
+                dconvmatrix = self.get_convolution_matrix(sigma, derivative=True)
+                dgrid = dconvmatrix.dot(grid).dot(convmatrix.T) + \
+                        convmatrix.dot(grid).dot(dconvmatrix.T)
+                dgrid *= np.sign(params[-self._EXTRA_TERM]) # sigma = |extra term|
+            dgrid.flags.writeable = False
+            return dgrid
+
+        dgrid = self._get_cached_("dpixelparams", self._get_paramskey_(params), _build_derivative_)
+        return dgrid.reshape(self.size*self.size) if flatten else dgrid
+
+    def get_gaussian_kernel(self, sigma, derivative=False):
+        """ 1d gaussian kernel as used by scipy.ndimage.gaussian_filter (truncate=4)
+        (memoized on sigma) 
+
+        derivative: [bool] -optional-
+            get the derivative of the (normalized) kernel with respect to sigma instead.
+        """
+        def _build_kernel_():
+            radius = int(4. * float(sigma) + 0.5)
+            x = np.arange(-radius, radius+1)
+            kernel = np.exp(-0.5 / sigma**2 * x**2)
+            kernel /= kernel.sum()
+            if derivative:
+                return kernel * (x**2 - np.sum(kernel*x**2)) / sigma**3
+            return kernel
+
+        return self._get_cached_("dkernel" if derivative else "kernel", float(sigma),
+                                 _build_kernel_)
+
+    def get_convolution_matrix(self, sigma, derivative=False):
+        """ (size, size) matrix G of the 1d gaussian convolution (mode='reflect'),
+        such that the convolved grid is G.P.G^T. 
+        Returns None if there is no effective convolution (kernel of size 1).
+        (memoized on sigma)
+
+        derivative: [bool] -optional-
+            get the derivative of G with respect to sigma instead.
+        """
+        if sigma <= 1e-15 or len(self.get_gaussian_kernel(sigma)) == 1: # as gaussian_filter
+            return None
+
+        def _build_matrix_():
+            matrix = correlate1d(np.eye(self.size), self.get_gaussian_kernel(sigma, derivative),
+                                 axis=0, mode="reflect")
+            matrix.flags.writeable = False
+            return matrix
+
+        return self._get_cached_("dconvmatrix" if derivative else "convmatrix", float(sigma),
+                                 _build_matrix_)
+
+    def get_interp_coefficients(self, star, u=None, v=None):
+        """ interpolation coefficients of the star pixels, as used by chisq() and reflux().
+
+        Results are cached per star geometry and center offset (star.fit.center).
+        The offset is part of the key since the pixel indices and the mask depend on it.
+        = As reflux() moves the center, the reuse is limited to the chisq() and reflux()
+        calls of a same fit iteration (and to iterations with a fixed center) =
+        (bounded LRU of _COEFF_CACHE_SIZE stars)
+
+        Parameters
+        ----------
+        star: [piff.Star]
+            star (with its fit.center)
+
+        u, v: [1d array or None] -optional-
+            pixel coordinates from star.data.getDataVector(). Computed if not given.
+
+        Returns
+        -------
+        mask, coeffs, index1d, dcdu, dcdv
+        - mask: pixels (of getDataVector()) covered by the model
+        - coeffs (Ndata x Ninterp): interpolation coefficients, null for pixels outside the grid.
+        - index1d (Ndata x Ninterp): parameter index of each coefficient (<0 outside the grid)
+        - dcdu, dcdv: derivatives of coeffs with respect to the center (None if not centered)
+        """
+        jac = star.data.local_wcs.jacobian()
+        bounds = star.data.image.bounds
+        key = (bounds.xmin, bounds.xmax, bounds.ymin, bounds.ymax,
+               star.data.image_pos.x, star.data.image_pos.y,
+               jac.dudx, jac.dudy, jac.dvdx, jac.dvdy,
+               float(star.fit.center[0]), float(star.fit.center[1]),
+               np.packbits(star.data.weight.array != 0).tobytes())
+
+        def _build_coefficients_():
+            if u is None or v is None:
+                u_, v_ = star.data.getDataVector()[2:]
+            else:
+                u_, v_ = u, v
+            u_ = u_ - star.fit.center[0]
+            v_ = v_ - star.fit.center[1]
+            mask = (np.abs(u_) <= self.maxuv) & (np.abs(v_) <= self.maxuv)
+            if self._centered:
+                coeffs, psfx, psfy, dcdu, dcdv = self.interp_calculate(u_[mask]/self.scale,
+                                                                       v_[mask]/self.scale, True)
+                dcdu /= self.scale
+                dcdv /= self.scale
+            else:
+                coeffs, psfx, psfy = self.interp_calculate(u_[mask]/self.scale,
+                                                           v_[mask]/self.scale)
+                dcdu, dcdv = None, None
+
+            # Turn the (psfy,psfx) coordinates into an index into 1d parameter vector.
+            index1d = self._indexFromPsfxy(psfx, psfy)
+            # And null the coefficients for such pixels
+            nopsf = index1d < 0
+            out = [mask, np.where(nopsf, 0., coeffs), index1d]
+            out += [np.where(nopsf, 0., dcdu), np.where(nopsf, 0., dcdv)] if self._centered \
+              else [dcdu, dcdv]
+            for array_ in out:
+                if array_ is not None:
+                    array_.flags.writeable = False
+            return tuple(out)
+
+        return self._get_cached_("coefficients", key, _build_coefficients_,
+                                 maxsize=self._COEFF_CACHE_SIZE)
+
+    def get_kernel_table(self):
+        """ oversampled lookup table of the (footprint normalized) lanczos kernel
+        and of its derivative, as a function of the fractional offset f = ceil(u)-u in [0,1].
+        (see _kernel1d)
+
+        Returns
+        -------
+        kernel, dkernel [(_LUT_OVERSAMPLING+1, 2n) arrays]
+        """
+        n = int(np.ceil(self.interp.xrange))
+        def _build_table_():
+            lanczos_n = self.interp._n
+            frac = np.linspace(0, 1, self._LUT_OVERSAMPLING+1)
+            x = frac[:,np.newaxis] + np.arange(-n, n)
+            sinc, sinc_n = np.sinc(x), np.sinc(x/lanczos_n)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                dsinc = np.where(x == 0, 0., (np.cos(np.pi*x) - sinc)/x)
+                dsinc_n = np.where(x == 0, 0., (np.cos(np.pi*x/lanczos_n) - sinc_n)/x)
+            kernel, dkernel = sinc*sinc_n, dsinc*sinc_n + sinc*dsinc_n
+            # Normalize Lanczos to unit sum over kernel elements
+            norm, dnorm = np.sum(kernel, axis=1)[:,np.newaxis], np.sum(dkernel, axis=1)[:,np.newaxis]
+            table = np.asarray([kernel/norm, dkernel/norm - kernel*dnorm/norm**2])
+            table.flags.writeable = False
+            return table
+
+        return self._get_cached_("lut", (n, self.interp._n, self._LUT_OVERSAMPLING), _build_table_)
+
+    def _kernel1d_table_(self, frac):
+        """ kernel and derivative for the fractional offsets frac = ceil(u)-u,
+        linearly interpolated from the lookup table """
+        kernel, dkernel = self.get_kernel_table()
+        index = np.asarray(frac, dtype=float) * self._LUT_OVERSAMPLING
+        index0 = np.clip(np.floor(index).astype(int), 0, self._LUT_OVERSAMPLING-1)
+        weight = (index - index0)[:,np.newaxis]
+        return ( kernel[index0]*(1-weight) + kernel[index0+1]*weight,
+                 dkernel[index0]*(1-weight) + dkernel[index0+1]*weight )
+
+    def clear_cache(self, which=None):
+        """ clear the memoization caches.
+
+        Parameters
+        ----------
+        which: [string or list of] -optional-
+            which cache to clear (pixelparams, dpixelparams, kernel, dkernel,
+            convmatrix, dconvmatrix, profile, coefficients, lut). All if None.
+        """
+        if which is None:
+            self._memo = {}
+        else:
+            for which_ in np.atleast_1d(which):
+                _ = self._cache.pop(which_, None)
+
+    def _convolve_pixelparams_(self, params):
+        """ """
+        params_sq = np.asarray(params[:-self._EXTRA_TERM], dtype=float).reshape(self.size,self.size)
+        convmatrix = self.get_convolution_matrix(self._get_sigma_(params))
+        if convmatrix is not None:
+            params_sq = convmatrix.dot(params_sq).dot(convmatrix.T)
+        else:
+            params_sq = params_sq.copy()
+
+        params_sq.flags.writeable = False
+        return params_sq
+
+    def _get_sigma_(self, params):
+        """ gaussian convolution width of the given parameters """
+        return np.abs(params[-self._EXTRA_TERM])
+
+    @staticmethod
+    def _get_paramskey_(params):
+        """ memoization key of the given parameters """
+        return np.ascontiguousarray(params, dtype=float).tobytes()
+
+    def _get_cached_(self, cachename, key, func, maxsize=None):
+        """ returns cache[cachename][key], calling and storing func() if not yet cached.
+        Each cache is a bounded LRU (maxsize, _CACHE_SIZE if None).
+        """
+        cache = self._cache.setdefault(cachename, OrderedDict())
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        cache[key] = value = func()
+        if len(cache) > (self._CACHE_SIZE if maxsize is None else maxsize):
+            _ = cache.popitem(last=False)
+        return value
+
+    @property
+    def _cache(self):
+        """ memoization caches """
+        if not hasattr(self, "_memo"):
+            self._memo = {}
+        return self._memo
+
+
+class SparseStarFit( StarFit ):
+    """ StarFit storing its design matrix A as a scipy.sparse matrix.
+    alpha and beta are returned as dense arrays, as expected by piff's interpolators.
+    """
+    @property
+    def alpha(self):
+        return self.A.T.dot(self.A).toarray()
+
+    @property
+    def beta(self):
+        return self.A.T.dot(self.b)
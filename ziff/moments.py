@@ -0,0 +1,232 @@
+""" Adaptive moments of star stamps """
+
+import numpy as np
+
+# galsim.hsm.HSMParams defaults
+HSM_PARAMS = {"bound_correct_wt": 0.25,
+              "max_amoment": 8000.,
+              "max_ashift": 15.,
+              "max_mom2_iter": 400,
+              "convergence_threshold": 1e-6}
+
+
+def adaptive_moments(stamps, weights=None, guess_sig=5.0, guess_centroid=None,
+                     **kwargs):
+    """ vectorized version of galsim's FindAdaptiveMom (Bernstein & Jarvis 2002).
+
+    All the stamps are iterated at once, stars that converged are frozen while
+    the others keep iterating.
+
+    Parameters
+    ----------
+    stamps: [3d array]
+        (N, ny, nx) stamp cube.
+
+    weights: [3d array or None] -optional-
+        (N, ny, nx) weight cube. As for HSM, the weight is only used in a
+        binary sense: pixels with 0 weight are ignored.
+
+    guess_sig: [float] -optional-
+        initial guess of the gaussian sigma [in pixels]
+
+    guess_centroid: [2d array or None] -optional-
+        (N, 2) initial guess of the (x, y) centroid in array coordinates.
+        If None, the stamp centers.
+
+    **kwargs goes to update the HSM_PARAMS
+
+    Returns
+    -------
+    dict
+    amp, x, y (array coordinates), mxx, mxy, myy, sigma, g1, g2 (in pixel units),
+    niter and flag (0 if converged). Failed stars (flag -1) have NaN measurements.
+    """
+    params = {**HSM_PARAMS, **kwargs}
+    stamps = np.asarray(stamps, dtype="float64")
+    if stamps.ndim == 2:
+        stamps = stamps[None]
+    if weights is not None:
+        stamps = np.where(np.asarray(weights).reshape(stamps.shape) != 0, stamps, 0)
+
+    nstars, ny, nx = stamps.shape
+    stamps = stamps.reshape(nstars, ny*nx)
+    yy, xx = np.mgrid[0:ny, 0:nx].reshape(2, -1).astype("float64")
+    # polynomial basis: the weighted sums are matrix products with the weighted stamps.
+    basis = np.asarray([np.ones_like(xx), xx, yy, xx**2, xx*yy, yy**2])
+    if guess_centroid is None:
+        guess_centroid = np.tile([(nx-1)/2., (ny-1)/2.], (nstars, 1))
+
+    x0, y0 = np.array(guess_centroid, dtype="float64").T
+    x00, y00 = x0.copy(), y0.copy()
+    mxx = np.full(nstars, guess_sig**2, dtype="float64")
+    myy = mxx.copy()
+    mxy = np.zeros(nstars, dtype="float64")
+    amp = np.full(nstars, np.nan)
+    niter = np.zeros(nstars, dtype="int")
+    flag = np.zeros(nstars, dtype="int")
+    shiftscale0 = np.zeros(nstars)
+    active = np.ones(nstars, dtype="bool")
+    bound = params["bound_correct_wt"]
+
+    with np.errstate(all="ignore"):
+        while np.any(active):
+            idx = np.flatnonzero(active)
+            mxx_, mxy_, myy_, x0_, y0_ = mxx[idx], mxy[idx], myy[idx], x0[idx], y0[idx]
+            detm = mxx_*myy_ - mxy_**2
+            ixx, ixy, iyy = myy_/detm, -mxy_/detm, mxx_/detm
+            # rho2 = (r-r0)^T M^-1 (r-r0) expanded on the basis
+            coefs = np.asarray([ixx*x0_**2 + 2*ixy*x0_*y0_ + iyy*y0_**2,
+                                -2*(ixx*x0_ + ixy*y0_), -2*(iyy*y0_ + ixy*x0_),
+                                ixx, 2*ixy, iyy]).T
+            intensity = stamps[idx] * np.exp(-0.5 * coefs.dot(basis))
+            s0, sx, sy, sxx, sxy, syy = intensity.dot(basis.T).T
+            a_  = s0
+            bx_ = sx - x0_*s0
+            by_ = sy - y0_*s0
+            cxx = sxx - 2*x0_*sx + x0_**2*s0
+            cxy = sxy - x0_*sy - y0_*sx + x0_*y0_*s0
+            cyy = syy - 2*y0_*sy + y0_**2*s0
+            amp[idx] = 2*a_
+
+            # configuration of the weight function
+            two_psi = np.arctan2(2*mxy_, mxx_-myy_)
+            semi_a2 = 0.5*((mxx_+myy_) + (mxx_-myy_)*np.cos(two_psi)) + mxy_*np.sin(two_psi)
+            semi_b2 = mxx_ + myy_ - semi_a2
+            shiftscale = np.sqrt(semi_b2)
+            first = niter[idx] == 0
+            shiftscale0[idx[first]] = shiftscale[first]
+
+            # changes
+            dx  = np.clip(2.*bx_/(a_*shiftscale), -bound, bound)
+            dy  = np.clip(2.*by_/(a_*shiftscale), -bound, bound)
+            dxx = np.clip(4.*(cxx/a_ - 0.5*mxx_)/semi_b2, -bound, bound)
+            dxy = np.clip(4.*(cxy/a_ - 0.5*mxy_)/semi_b2, -bound, bound)
+            dyy = np.clip(4.*(cyy/a_ - 0.5*myy_)/semi_b2, -bound, bound)
+
+            # convergence test
+            convergence = np.sqrt(np.max([np.maximum(np.abs(dx), np.abs(dy))**2,
+                                          np.abs(dxx), np.abs(dxy), np.abs(dyy)], axis=0))
+            smaller = shiftscale < shiftscale0[idx]
+            convergence[smaller] *= (shiftscale0[idx]/shiftscale)[smaller]
+
+            # update
+            x0[idx] += dx*shiftscale
+            y0[idx] += dy*shiftscale
+            mxx[idx] += dxx*semi_b2
+            mxy[idx] += dxy*semi_b2
+            myy[idx] += dyy*semi_b2
+            niter[idx] += 1
+
+            failed = (semi_b2 <= 0) | np.isnan(convergence) \
+              | np.any(np.abs([mxx[idx], mxy[idx], myy[idx]]) > params["max_amoment"], axis=0) \
+              | (np.abs(x0[idx]-x00[idx]) > params["max_ashift"]) \
+              | (np.abs(y0[idx]-y00[idx]) > params["max_ashift"]) \
+              | np.isnan(mxx[idx]) | np.isnan(mxy[idx]) | np.isnan(myy[idx]) \
+              | (niter[idx] > params["max_mom2_iter"])
+            flag[idx[failed]] = -1
+            active[idx[failed | (convergence <= params["convergence_threshold"])]] = False
+
+        trace = mxx + myy
+        e1, e2 = (mxx-myy)/trace, 2*mxy/trace
+        e = np.sqrt(e1**2 + e2**2)
+        g_over_e = 1./(1. + np.sqrt(1. - e**2))
+        sigma = (mxx*myy - mxy**2)**0.25
+
+    return _nan_failed_({"amp":amp, "x":x0, "y":y0, "mxx":mxx, "mxy":mxy, "myy":myy,
+                         "sigma":sigma, "g1":e1*g_over_e, "g2":e2*g_over_e,
+                         "niter":niter, "flag":flag})
+
+def hsm_moments(stamps, weights=None, guess_sig=5.0, **kwargs):
+    """ galsim's FindAdaptiveMom looped over the stamps.
+    (Reference implementation of adaptive_moments(), same input and output) """
+    import galsim
+    stamps = np.asarray(stamps, dtype="float64")
+    if stamps.ndim == 2:
+        stamps = stamps[None]
+
+    keys = ["amp", "x", "y", "mxx", "mxy", "myy", "sigma", "g1", "g2", "niter", "flag"]
+    moments = {k:np.full(len(stamps), np.nan) for k in keys}
+    hsmparams = galsim.hsm.HSMParams(**kwargs) if len(kwargs)>0 else None
+    for i, stamp_ in enumerate(stamps):
+        weight_ = galsim.Image(np.asarray(weights[i], dtype="int32"), xmin=0, ymin=0) \
+          if weights is not None else None
+        mom = galsim.Image(stamp_, xmin=0, ymin=0).FindAdaptiveMom(weight=weight_,
+                                                                   guess_sig=guess_sig,
+                                                                   hsmparams=hsmparams,
+                                                                   strict=False)
+        sigma, shape = mom.moments_sigma, mom.observed_shape
+        trace = 2*sigma**2/np.sqrt(1-shape.e**2)
+        mxx, mxy, myy = trace*(1+shape.e1)/2, trace*shape.e2/2, trace*(1-shape.e1)/2
+        for k,v in {"amp":mom.moments_amp, "x":mom.moments_centroid.x,
+                    "y":mom.moments_centroid.y, "mxx":mxx, "mxy":mxy, "myy":myy,
+                    "sigma":sigma, "g1":shape.g1, "g2":shape.g2,
+                    "niter":mom.moments_n_iter, "flag":mom.moments_status}.items():
+            moments[k][i] = v
+
+    moments["niter"] = np.asarray(moments["niter"], dtype="int")
+    moments["flag"] = np.asarray(moments["flag"], dtype="int")
+    return _nan_failed_(moments)
+
+def _nan_failed_(moments):
+    """ NaN measurements for the failed stars (flag != 0), such that both engines
+    (last iterate for adaptive_moments, -1 placeholders for hsm) return the same. """
+    failed = moments["flag"] != 0
+    for k in ["amp", "x", "y", "mxx", "mxy", "myy", "sigma", "g1", "g2"]:
+        moments[k] = np.where(failed, np.nan, moments[k])
+    return moments
+
+def get_moments(stamps, weights=None, engine="numpy", **kwargs):
+    """ adaptive moments of the stamps
+
+    Parameters
+    ----------
+    stamps: [3d array]
+        (N, ny, nx) stamp cube.
+
+    weights: [3d array or None] -optional-
+        (N, ny, nx) weight cube (only used in a binary sense)
+
+    engine: [string] -optional-
+        - numpy: vectorized adaptive_moments()
+        - hsm: galsim FindAdaptiveMom loop (hsm_moments())
+
+    **kwargs goes to the engine.
+
+    Returns
+    -------
+    dict (see adaptive_moments())
+    """
+    if engine == "numpy":
+        return adaptive_moments(stamps, weights=weights, **kwargs)
+    if engine in ["hsm", "galsim"]:
+        return hsm_moments(stamps, weights=weights, **kwargs)
+
+    raise NotImplementedError(f"engine {engine} not implemented, numpy or hsm available")
+
+def moments_to_world(moments, jacobian):
+    """ converts pixel moments into world (u,v) moments as piff.Star.run_hsm() does.
+
+    Parameters
+    ----------
+    moments: [dict]
+        output of get_moments()
+
+    jacobian: [3d array]
+        (N,2,2) local wcs jacobians [[dudx, dudy],[dvdx, dvdy]]
+
+    Returns
+    -------
+    sigma, g1, g2 (in world units)
+    """
+    jacobian = np.asarray(jacobian).reshape(-1, 2, 2)
+    mom = np.moveaxis(np.asarray([[moments["mxx"], moments["mxy"]],
+                                  [moments["mxy"], moments["myy"]]]), -1, 0)
+    # M_world = J M J^T
+    momw = np.einsum("nij,njk,nlk->nil", jacobian, mom, jacobian)
+    muu, muv, mvv = momw[:,0,0], momw[:,0,1], momw[:,1,1]
+    with np.errstate(all="ignore"):
+        trace = muu + mvv
+        e1, e2 = (muu-mvv)/trace, 2*muv/trace
+        g_over_e = 1./(1. + np.sqrt(1. - (e1**2 + e2**2)))
+        sigma = (muu*mvv - muv**2)**0.25
+    return sigma, e1*g_over_e, e2*g_over_e
@@ -0,0 +1,372 @@
+""" Resumable local batch processing of ztf quadrants (ziffit_single without dask).
+
+The files are processed on a local process pool (N workers, bounded memory per worker)
+and the status of each processing stage of each file is recorded in a
+persistent manifest (sqlite), such that re-running the same batch skips
+the completed stages and only retries the failed (or never ran) ones.
+
+Stages (same steps as ziffit.ziffit_single):
+    download  sciimg and mskimg (ztfquery.io.get_file)
+    psf       gaia catalogs (psfcat_gaia.fits, shapecat_gaia.fits) and PSF fit (.piff)
+    shapes    stars and psf-model shapes (psfshape.parquet and stamps)
+
+Usage:
+    batch = ZiffitBatch("night.sqlite", nworkers=16, maxmemory=4)
+    status = batch.run(files)    # re-run the same line after an interruption
+
+See also bin/ziffbatch.py
+"""
+
+import os
+import time
+import sqlite3
+import traceback
+import warnings
+import numpy as np
+import pandas
+
+STAGES = ["download", "psf", "shapes"]
+STATUS = ["done", "failed"]
+MANIFEST_COLUMNS = ["filename", "stage", "status", "output", "start", "end", "attempts", "error"]
+
+# ================ #
+#    Stages        #
+# ================ #
+def _get_psf_suffix_(ziff, interporder):
+    """ piff filename suffix of the PSF fitted by estimate_psf() """
+    from .. import io
+    config = ziff.get_config()
+    return io.get_psf_suffix({"psf":{"model":config["psf"]["model"],
+                                     "interp":{**config["psf"]["interp"], "order":int(interporder)}}})
+
+def stage_download(file_, inputs, overwrite=False, waittime=None, **kwargs):
+    """ downloads the sciimg and mskimg, returns the sciimg filename """
+    from .ziffit import get_file_delayed
+    sciimg, mskimg = get_file_delayed(file_, waittime=waittime,
+                                      suffix=["sciimg.fits","mskimg.fits"],
+                                      overwrite=overwrite, show_progress=False, maxnprocess=1)
+    inputs["sciimg"], inputs["mskimg"] = sciimg, mskimg
+    return sciimg
+
+def stage_psf(file_, inputs, isolationlimit=None, fit_gmag=None, shape_gmag=None,
+                  nstars=800, interporder=3, maxoutliers=None, stamp_size=15, **kwargs):
+    """ gaia catalogs and PSF fit (stored), returns the piff filename suffix """
+    from .ziffit import get_ziffit_gaia_catalog, DEFAULT_ISOLATION, DEFAULT_FIT_GMAG, DEFAULT_SHAPE_GMAG
+    from .. import base
+    from ..cache import get_ziff
+    if "sciimg" not in inputs:
+        from ..container import get_local_files
+        inputs["sciimg"], inputs["mskimg"] = get_local_files(file_, suffix=["sciimg.fits","mskimg.fits"])
+
+    ziff = get_ziff(inputs["sciimg"], inputs["mskimg"], fetch_psf=False, lazy=True)
+    cat_tofit, cat_toshape = get_ziffit_gaia_catalog(ziff,
+                                    isolationlimit=DEFAULT_ISOLATION if isolationlimit is None else isolationlimit,
+                                    fit_gmag=DEFAULT_FIT_GMAG if fit_gmag is None else fit_gmag,
+                                    shape_gmag=DEFAULT_SHAPE_GMAG if shape_gmag is None else shape_gmag,
+                                    shuffled=True, verbose=False)
+    psf = base.estimate_psf(ziff, cat_toshape, stamp_size=stamp_size,
+                            interporder=interporder, nstars=nstars,
+                            maxoutliers=maxoutliers, verbose=False)
+    if psf is None:
+        raise ValueError("the PSF estimation failed (no image or no catalog)")
+
+    inputs.update({"ziff":ziff, "psf":psf, "cat_tofit":cat_tofit})
+    return _get_psf_suffix_(ziff, interporder)
+
+def stage_shapes(file_, inputs, stamp_size=15, shapeprop={}, **kwargs):
+    """ stars and psf-model shapes (stored), returns the median [sigma_model, sigma_data] """
+    from .ziffit import _get_ziff_psf_cat_, _get_ziffit_output_
+    from .. import base
+    if "psf" in inputs:
+        ziff, psf, cat_tofit = inputs["ziff"], inputs["psf"], inputs["cat_tofit"]
+    else: # from the stored psf stage outputs
+        if inputs.get("psfsuffix") is None:
+            raise ValueError("no completed psf stage for this file, run the psf stage first")
+        ziff, psf, cat_tofit = _get_ziff_psf_cat_(file_, whichpsf=inputs["psfsuffix"],
+                                                  catsuffix="psfcat_gaia.fits")
+
+    shapes = base.get_shapes(ziff, psf, cat_tofit, store=True, stamp_size=stamp_size,
+                             incl_residual=True, incl_stars=True, **shapeprop)
+    if shapes is None:
+        raise ValueError("the shape measurement failed")
+
+    return str(list(_get_ziffit_output_(shapes)))
+
+STAGE_FUNCS = {"download":stage_download, "psf":stage_psf, "shapes":stage_shapes}
+
+def run_stages(file_, stages, psfsuffix=None, **kwargs):
+    """ runs the given stages (in order) on the given file, stopping at the first failure.
+
+    Parameters
+    ----------
+    file_: [string]
+        ztf filename (e.g. sciimg)
+
+    stages: [list of string]
+        stages to run (see STAGES)
+
+    psfsuffix: [string or None] -optional-
+        output of a previously completed psf stage (needed to run the shapes stage alone)
+
+    **kwargs goes to the stage functions (see ziffit_single options)
+
+    Returns
+    -------
+    list of dict (filename, stage, status, output, start, end, error), one per ran stage
+    """
+    inputs = {"psfsuffix":psfsuffix}
+    records = []
+    for stage in stages:
+        record = {"filename":file_, "stage":stage, "start":time.time(), "output":None, "error":None}
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                record["output"] = STAGE_FUNCS[stage](file_, inputs, **kwargs)
+            record["status"] = "done"
+        except Exception:
+            record["status"] = "failed"
+            record["error"] = traceback.format_exc()
+
+        record["end"] = time.time()
+        records.append(record)
+        if record["status"] != "done":
+            break
+        if stage == "psf":
+            inputs["psfsuffix"] = record["output"]
+
+    return records
+
+def _init_worker_(maxmemory=None, cachememory=None):
+    """ process pool initializer: bounds the worker memory (GB) and its cache (see ziff.cache) """
+    if maxmemory is not None:
+        import resource
+        nbytes = int(maxmemory*1024**3)
+        resource.setrlimit(resource.RLIMIT_AS, (nbytes, nbytes))
+
+    if cachememory is not None:
+        from ..cache import set_cache_maxbytes
+        set_cache_maxbytes(int(cachememory*1024**3))
+
+# ================ #
+#    Classes       #
+# ================ #
+class Manifest( object ):
+    """ persistent (sqlite) per-file and per-stage processing status """
+
+    def __init__(self, filename):
+        """ """
+        self._filename = filename
+        with self.connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS status (
+                                  filename TEXT, stage TEXT, status TEXT, output TEXT,
+                                  start REAL, end REAL, attempts INTEGER, error TEXT,
+                                  PRIMARY KEY (filename, stage))""")
+
+    def connect(self):
+        """ sqlite connection to the manifest (use as context manager to commit) """
+        return sqlite3.connect(self.filename, timeout=60)
+
+    # ------- #
+    # SETTER  #
+    # ------- #
+    def add_records(self, records):
+        """ stores the given stage records (see run_stages), counting the attempts """
+        with self.connect() as connection:
+            connection.executemany("""INSERT INTO status
+                                      (filename, stage, status, output, start, end, attempts, error)
+                                      VALUES (:filename, :stage, :status, :output, :start, :end, 1, :error)
+                                      ON CONFLICT (filename, stage) DO UPDATE SET
+                                      status=excluded.status, output=excluded.output,
+                                      start=excluded.start, end=excluded.end, error=excluded.error,
+                                      attempts=attempts+1""",
+                                   [{k:r_.get(k) for k in MANIFEST_COLUMNS} for r_ in records])
+
+    def reset(self, filenames=None, stages=None):
+        """ removes the status of the given files and stages (all if None) """
+        query, values = self._get_where_(filenames, stages)
+        with self.connect() as connection:
+            connection.execute(f"DELETE FROM status {query}", values)
+
+    # ------- #
+    # GETTER  #
+    # ------- #
+    def get_status(self, filenames=None, stages=None):
+        """ DataFrame of the stage status (one row per filename and stage) """
+        query, values = self._get_where_(filenames, stages)
+        with self.connect() as connection:
+            return pandas.read_sql_query(f"SELECT * FROM status {query}", connection, params=values)
+
+    def get_todo(self, filenames, stages=STAGES, retry=True):
+        """ stages to (re)run for each file.
+
+        Parameters
+        ----------
+        filenames: [list of string]
+            files of the batch
+
+        stages: [list of string] -optional-
+            requested stages (in order)
+
+        retry: [bool] -optional-
+            should the failed stages be re-ran ?
+
+        Returns
+        -------
+        dict {filename: (stages to run, psfsuffix)} (files with nothing to do are not included)
+        """
+        # all stages: the psf output is needed to resume on the shapes stage only
+        status = self.get_status(filenames).set_index(["filename","stage"])
+        todo = {}
+        for file_ in filenames:
+            stages_ = [s_ for s_ in stages if (file_, s_) not in status.index
+                           or status.loc[(file_, s_),"status"] != "done"]
+            if len(stages_) == 0:
+                continue
+            if not retry and any((file_, s_) in status.index for s_ in stages_):
+                continue
+            # a stage is re-ran along with all the following ones
+            stages_ = stages[stages.index(stages_[0]):]
+            psfsuffix = status.loc[(file_, "psf"),"output"] if (file_, "psf") in status.index else None
+            if psfsuffix is not None and pandas.isna(psfsuffix): # failed psf stage
+                psfsuffix = None
+            todo[file_] = (stages_, psfsuffix)
+
+        return todo
+
+    @staticmethod
+    def _get_where_(filenames=None, stages=None):
+        """ """
+        conditions, values = [], []
+        for key, entries in zip(["filename", "stage"], [filenames, stages]):
+            if entries is not None:
+                entries = list(np.atleast_1d(entries))
+                conditions.append(f"{key} IN ({','.join('?'*len(entries))})")
+                values += entries
+        return ("WHERE "+" AND ".join(conditions) if len(conditions)>0 else ""), values
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def filename(self):
+        """ sqlite manifest file """
+        return self._filename
+
+
+class ZiffitBatch( object ):
+    """ runs ziffit_single's stages on a local process pool, tracked by a Manifest """
+
+    def __init__(self, manifest, nworkers=None, maxmemory=None, cachememory=None,
+                     maxtasksperchild=None, stages=STAGES, ziffitprop={}):
+        """
+        Parameters
+        ----------
+        manifest: [string or Manifest]
+            sqlite manifest file (created if needed)
+
+        nworkers: [int or None] -optional-
+            number of worker processes (os.cpu_count() if None)
+
+        maxmemory: [float or None] -optional-
+            address space limit of each worker, in GB. A task exceeding it fails with a MemoryError.
+
+        cachememory: [float or None] -optional-
+            byte budget of the worker cache in GB (see ziff.cache), maxmemory/4 if None.
+
+        maxtasksperchild: [int or None] -optional-
+            restarts the worker processes after this number of files (releases their memory)
+
+        stages: [list of string] -optional-
+            stages to run (see STAGES)
+
+        ziffitprop: [dict] -optional-
+            options of the stages, as for ziffit_single
+            (e.g. nstars, interporder, maxoutliers, stamp_size, fit_gmag, shape_gmag)
+        """
+        self._manifest = manifest if isinstance(manifest, Manifest) else Manifest(manifest)
+        self._nworkers = os.cpu_count() if nworkers is None else int(nworkers)
+        self._maxmemory = maxmemory
+        self._cachememory = maxmemory/4 if (cachememory is None and maxmemory is not None) else cachememory
+        self._maxtasksperchild = maxtasksperchild
+        if np.any([s_ not in STAGES for s_ in stages]):
+            raise ValueError(f"stages must be in {STAGES}, {stages} given")
+        self._stages = [s_ for s_ in STAGES if s_ in stages]
+        self._ziffitprop = ziffitprop
+
+    def run(self, files, retry=True, force=False, verbose=True):
+        """ processes the stages of the given files that are not done yet.
+
+        Parameters
+        ----------
+        files: [list of string]
+            ztf filenames (e.g. sciimg)
+
+        retry: [bool] -optional-
+            should the failed stages be re-ran ?
+
+        force: [bool] -optional-
+            re-run all stages, ignoring the manifest
+
+        verbose: [bool] -optional-
+            prints the progress
+
+        Returns
+        -------
+        DataFrame (manifest status of the given files)
+        """
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        from concurrent.futures.process import BrokenProcessPool
+
+        files = list(np.unique(files))
+        if force:
+            self.manifest.reset(files, self.stages)
+        todo = self.manifest.get_todo(files, stages=self.stages, retry=retry)
+        if verbose:
+            print(f"{len(todo)}/{len(files)} files to process ({len(files)-len(todo)} already done)")
+
+        poolprop = dict(max_workers=self.nworkers, initializer=_init_worker_,
+                        initargs=(self._maxmemory, self._cachememory))
+        if self._maxtasksperchild is not None:
+            poolprop["max_tasks_per_child"] = int(self._maxtasksperchild)
+
+        nfailed = 0
+        with ProcessPoolExecutor(**poolprop) as pool:
+            futures = {pool.submit(run_stages, file_, stages_, psfsuffix=psfsuffix, **self._ziffitprop): (file_, stages_)
+                           for file_, (stages_, psfsuffix) in todo.items()}
+            for i, future in enumerate(as_completed(futures)):
+                file_, stages_ = futures[future]
+                try:
+                    records = future.result()
+                except BrokenProcessPool: # worker killed (e.g. by the system)
+                    now = time.time()
+                    records = [{"filename":file_, "stage":stages_[0], "status":"failed",
+                                "start":now, "end":now, "error":"worker process died"}]
+                self.manifest.add_records(records)
+                failed = records[-1]["status"] != "done"
+                nfailed += failed
+                if verbose:
+                    print(f"[{i+1}/{len(todo)}] {os.path.basename(file_)}: "+
+                          (f"failed at {records[-1]['stage']}" if failed else "done"))
+
+        if verbose:
+            print(f"{nfailed} failed / {len(todo)} processed (see manifest {self.manifest.filename})")
+
+        return self.manifest.get_status(files, self.stages)
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def manifest(self):
+        """ Manifest of the batch """
+        return self._manifest
+
+    @property
+    def nworkers(self):
+        """ number of worker processes """
+        return self._nworkers
+
+    @property
+    def stages(self):
+        """ stages ran by the batch """
+        return self._stages
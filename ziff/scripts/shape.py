@@ -10,6 +10,7 @@ from dask import delayed, distributed
 
 from . import ziffit
 from .. import io as zio
+from ..stampstore import STAMP_KEYS, fetch_psfshape_stamps
 from ztfquery import buildurl,io
 
 import pandas
@@ -22,8 +23,11 @@ print("ziff.scripts.shape is DEPRECATED, see ziff.daskit.shapes")
 
 def _fetch_filesource_data_(filename, datakey, sources=None):
     """ """
-    data    = pandas.read_parquet(io.get_file(filename, suffix="psfshape.parquet", check_suffix=False),
-                                    columns=[datakey])
+    filename = io.get_file(filename, suffix="psfshape.parquet", check_suffix=False)
+    if datakey in STAMP_KEYS: # (N, ny, nx) stamp cube
+        return fetch_psfshape_stamps(filename, datakey, sources=sources)
+    
+    data    = pandas.read_parquet(filename, columns=[datakey])
     if sources is not None:
         data = data.loc[sources]
         
@@ -46,7 +50,7 @@ def _residual_to_skydata_(residuals, buffer=2, statistic="median", returns="all"
     if returns not in ["stamp", "meanstat", "all", "both", "*"]:
         raise ValueError(f"returns must be 'stamp', 'meanstat', 'all'/'both'/'*' {returns} given.")
     
-    residuals  = residuals.reshape(len(residuals), 15, 15)
+    residuals  = np.array(residuals).reshape(len(residuals), 15, 15)
     residuals[:, buffer:-buffer,buffer:-buffer] = np.NaN
     if statistic is not None:
         stampout = getattr(np,statistic)(residuals, axis=0)
@@ -106,16 +106,21 @@ def ziffit_single(file_, use_dask=False, overwrite=False,
     
     return delayed(_get_ziffit_output_)(shapes)
 
-def _get_ziff_psf_cat_(file_, whichpsf="psf_PixelGrid_BasisPolynomial5.piff"):
-    """ """
-    files_needed = io.get_file(file_, suffix=[whichpsf,"sciimg.fits", "mskimg.fits",
-                                              "shapecat_gaia.fits"], check_suffix=False)
+def _get_ziff_psf_cat_(file_, whichpsf="psf_PixelGrid_BasisPolynomial5.piff", use_cache=True,
+                           catsuffix="shapecat_gaia.fits"):
+    """ ziff, psf and catalog of the given file (cached per process if use_cache, see ziff.cache) """
+    # psf and catalog may be compacted in a container (see ziff.container)
+    from ..container import get_local_files
+    # worker-level cache of the loaded inputs (see ziff.cache)
+    from ..cache import get_ziff, get_catalog, get_psf
+    files_needed = get_local_files(file_, suffix=[whichpsf,"sciimg.fits", "mskimg.fits",
+                                                  catsuffix])
     # Dask
     psffile, sciimg, mkimg, catfile = files_needed[0],files_needed[1],files_needed[2],files_needed[3]
 
-    ziff         = base.ZIFF(sciimg, mkimg, fetch_psf=False)
-    cat_toshape  = base.catlib.Catalog.load(catfile, wcs=ziff.wcs)
-    psf          = base.piff.PSF.read(file_name=psffile, logger=None)
+    ziff         = get_ziff(sciimg, mkimg, fetch_psf=False, lazy=True, use_cache=use_cache)
+    cat_toshape  = get_catalog(catfile, wcs=ziff.wcs, use_cache=use_cache)
+    psf          = get_psf(psffile, logger=None, use_cache=use_cache)
     
     return ziff, psf, cat_toshape
 
@@ -188,11 +193,17 @@ def get_ziffit_gaia_catalog(ziff, isolationlimit=DEFAULT_ISOLATION,
         return None,None
 
 def get_binned_data(files, bin_val, key, savefile=None, columns=None,
-                    quantity='sigma', normref="model"):
-    """ """
-    filefracday = [f.split("/")[-1].split("_")[1] for f in files]
-    df = pandas.concat([pandas.read_parquet(f, columns=columns) for f in files], keys=filefracday
-                           ).reset_index().rename({"level_0":"filefracday"}, axis=1)
+                    quantity='sigma', normref="model", query=None):
+    """ 
+    files: [list of path or ShapeStore]
+        psfshape.parquet files or ShapeStore (see ziff.shapestore.read_shapes)
+
+    query: [dict or None] -optional-
+        // ShapeStore only //
+        predicates of ShapeStore.query() (e.g. obsjd_range, fieldid, rcid, gmag_range)
+    """
+    from ..shapestore import read_shapes
+    df = read_shapes(files, columns=columns, query=query)
 
 
     norm = df.groupby(["obsjd"])[f"{quantity}_{normref}"].transform("median")
@@ -211,8 +222,16 @@ def get_sigma_data(files, bins_u, bins_v,
                     minimal=False,
                    quantity='sigma', normref="model", incl_residual=True,
                    basecolumns=['u', 'v', 'ccdid', 'qid', 'rcid', 'obsjd', 'fieldid','filterid', 'maglim'],
-                   savefile=None,
+                   savefile=None, query=None,
                   ):
+    """ 
+    files: [list of path or ShapeStore]
+        psfshape.parquet files or ShapeStore (see ziff.shapestore.read_shapes)
+
+    query: [dict or None] -optional-
+        // ShapeStore only //
+        predicates of ShapeStore.query() (e.g. obsjd_range, fieldid, rcid, gmag_range)
+    """
     if minimal:
         shape_columns = [f"{quantity}_data",  f"{quantity}_model"]
         incl_residual = False
@@ -226,9 +245,8 @@ def get_sigma_data(files, bins_u, bins_v,
     if incl_residual: 
         columns += ["residual"]
 
-    filefracday = [f.split("/")[-1].split("_")[1] for f in files]
-    df = pandas.concat([pandas.read_parquet(f, columns=columns) for f in files], keys=filefracday
-                           ).reset_index().rename({"level_0":"filefracday"}, axis=1)
+    from ..shapestore import read_shapes
+    df = read_shapes(files, columns=columns, query=query)
     
     norm = df.groupby(["obsjd"])[f"{quantity}_{normref}"].transform("median")
     
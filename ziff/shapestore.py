@@ -0,0 +1,365 @@
+""" Partitioned psfshape dataset (ShapeStore).
+
+Quadrant psfshape results (see base.get_shapes) are appended to a parquet dataset
+partitioned (hive flavor) by filter, year-month (of obsjd) and ccdid:
+{dirpath}/filter={zg,zr,zi}/yearmonth={YYYY-MM}/ccdid={ccdid}/*.parquet
+
+Columns are typed (float32 shapes, small integers, see get_shapestore_table()) and
+written in fixed size row groups sorted by obsjd, such that queries (ShapeStore.query)
+only read the partitions, row groups and columns they need.
+Stamps (stars, residual) are not part of the store, see ziff.stampstore.
+"""
+
+import os
+import uuid
+import numpy as np
+import pandas
+
+from .stampstore import STAMP_KEYS, read_psfshape
+
+PARTITION_KEYS = ["filter", "yearmonth", "ccdid"]
+FILTERNAMES = {1: "zg", 2: "zr", 3: "zi"}
+FLOAT64_KEYS = ["ra", "dec", "obsjd"]
+INT_KEYS = {"ccdid": "int8", "qid": "int8", "rcid": "int8", "filterid": "int8", "fieldid": "int16"}
+ROWGROUP_SIZE = 2**16
+
+
+def get_shapestore_dir(dirpath=None):
+    """ directory of the shape store.
+    $ZIFF_SHAPESTORE if defined, {ZIFFDIR}/shapestore otherwise. """
+    if dirpath is not None:
+        return dirpath
+    if "ZIFF_SHAPESTORE" in os.environ:
+        return os.environ["ZIFF_SHAPESTORE"]
+
+    from .io import ZIFFDIR
+    return os.path.join(ZIFFDIR, "shapestore")
+
+def obsjd_to_yearmonth(obsjd):
+    """ 'YYYY-MM' of the given julian dates """
+    unixsec = (np.asarray(obsjd, dtype="float64") - 2440587.5)*86400
+    return (np.datetime64("1970-01-01", "s") + unixsec.astype("timedelta64[s]")
+            ).astype("datetime64[M]").astype(str)
+
+def get_shapestore_table(shapes, filefracday=None):
+    """ typed pyarrow.Table of the given psfshape dataframe (see base.get_shapes)
+
+    Parameters
+    ----------
+    shapes: [DataFrame]
+        psfshape dataframe (indexed by Source). Stamp columns are ignored.
+
+    filefracday: [string or array or None] -optional-
+        filefracday of the entries (ztf_{filefracday}_... file). Kept if already a column.
+
+    Returns
+    -------
+    pyarrow.Table
+    """
+    import pyarrow
+    shapes = shapes.drop(columns=[k for k in STAMP_KEYS if k in shapes.columns])
+    shapes = shapes.reset_index().rename({"index": "Source"}, axis=1)
+    if filefracday is not None:
+        shapes["filefracday"] = filefracday
+    if "filefracday" in shapes.columns:
+        shapes["filefracday"] = shapes["filefracday"].astype(str)
+
+    for key in shapes.columns:
+        if key in INT_KEYS:
+            shapes[key] = shapes[key].astype(INT_KEYS[key])
+        elif key not in FLOAT64_KEYS and shapes[key].dtype == "float64":
+            shapes[key] = shapes[key].astype("float32")
+
+    shapes["filter"] = shapes["filterid"].map(FILTERNAMES).astype(str)
+    shapes["yearmonth"] = obsjd_to_yearmonth(shapes["obsjd"].values)
+    return pyarrow.Table.from_pandas(shapes.sort_values("obsjd"), preserve_index=False)
+
+def get_filters(obsjd_range=None, fieldid=None, rcid=None, gmag_range=None,
+                filtername=None, ccdid=None, yearmonth=None):
+    """ DNF filters (list of (column, op, value), as for pandas/dask.read_parquet)
+    of the given predicates.
+
+    Parameters
+    ----------
+    obsjd_range, gmag_range: [(float, float) or None] -optional-
+        min and max (included) values. None in any to ignore the bound.
+
+    fieldid, rcid, filtername, ccdid, yearmonth: [value or list or None] -optional-
+        accepted values. (filtername in zg, zr, zi, yearmonth as YYYY-MM)
+
+    Returns
+    -------
+    list (None if no filter)
+    """
+    filters = []
+    for key, value in zip(["fieldid", "rcid", "filter", "ccdid", "yearmonth"],
+                          [fieldid, rcid, filtername, ccdid, yearmonth]):
+        if value is not None:
+            filters.append((key, "in", list(np.atleast_1d(value).tolist())))
+
+    for key, vrange in zip(["obsjd", "gmag"], [obsjd_range, gmag_range]):
+        if vrange is None:
+            continue
+        if vrange[0] is not None:
+            filters.append((key, ">=", vrange[0]))
+        if vrange[1] is not None:
+            filters.append((key, "<=", vrange[1]))
+
+    if obsjd_range is not None and yearmonth is None and None not in obsjd_range:
+        # partition pruning
+        months = np.arange(*obsjd_to_yearmonth(obsjd_range).astype("datetime64[M]")
+                           + np.array([0, 1])).astype(str)
+        filters.append(("yearmonth", "in", months.tolist()))
+
+    return filters if len(filters)>0 else None
+
+# ============= #
+#   Store       #
+# ============= #
+class ShapeStore( object ):
+    """ partitioned parquet dataset of psfshape results """
+
+    def __init__(self, dirpath=None, rowgroup_size=ROWGROUP_SIZE):
+        """
+        Parameters
+        ----------
+        dirpath: [string or None] -optional-
+            root of the store (see get_shapestore_dir())
+
+        rowgroup_size: [int] -optional-
+            number of rows per row group (and maximum per row group when appending).
+        """
+        self._dirpath = get_shapestore_dir(dirpath)
+        self._rowgroup_size = rowgroup_size
+
+    # ------- #
+    #  I/O    #
+    # ------- #
+    def add_shapes(self, shapes, filefracday=None, basename=None):
+        """ appends psfshape results to the store.
+
+        Parameters
+        ----------
+        shapes: [DataFrame]
+            psfshape dataframe (see base.get_shapes)
+
+        filefracday: [string or array or None] -optional-
+            filefracday of the entries (see get_shapestore_table())
+
+        basename: [string or None] -optional-
+            basename of the written files (one per partition).
+            Files are replaced when appending again with the same basename
+            (e.g. the quadrant prefix). A unique name if None.
+
+        Returns
+        -------
+        None
+        """
+        table = get_shapestore_table(shapes, filefracday=filefracday)
+        self._write_table_(table, basename=basename)
+
+    def add_files(self, files, batch_size=500):
+        """ appends psfshape.parquet files to the store.
+
+        Files are read by batches and each batch is written as one file per partition.
+
+        Parameters
+        ----------
+        files: [list of string]
+            psfshape parquet files (ztf_{filefracday}_..._psfshape.parquet)
+
+        batch_size: [int] -optional-
+            number of files per batch.
+
+        Returns
+        -------
+        None
+        """
+        import pyarrow
+        files = list(np.atleast_1d(files))
+        for i in range(0, len(files), batch_size):
+            tables = [get_shapestore_table(read_psfshape(f_),
+                                           filefracday=os.path.basename(f_).split("_")[1])
+                      for f_ in files[i:i+batch_size]]
+            self._write_table_(pyarrow.concat_tables(tables, promote_options="default"))
+
+    def compact(self, partitions=None):
+        """ rewrites each partition as a single file (sorted by obsjd, fixed size row groups).
+        Entries appended several times (same Source, filefracday and rcid) are only kept once.
+
+        Parameters
+        ----------
+        partitions: [list of dict or None] -optional-
+            partitions to compact (see get_partitions()), all if None.
+
+        Returns
+        -------
+        None
+        """
+        import pyarrow
+        import pyarrow.parquet as pq
+        if partitions is None:
+            partitions = self.get_partitions()
+
+        for partition in partitions:
+            dirpath = self.get_partition_dir(partition)
+            files = sorted([os.path.join(dirpath, f_) for f_ in os.listdir(dirpath) if f_.endswith(".parquet")],
+                            key=os.path.getmtime)
+            if len(files) == 0:
+                continue
+            data = pandas.concat([pq.read_table(f_, partitioning=None).to_pandas() for f_ in files]
+                                 ).drop_duplicates(["Source", "filefracday", "rcid"], keep="last")
+            table = pyarrow.Table.from_pandas(data.sort_values("obsjd"), preserve_index=False)
+            tmpfile = os.path.join(dirpath, f".compact-{uuid.uuid4().hex}.tmp")
+            pq.write_table(table, tmpfile, row_group_size=self.rowgroup_size)
+            for f_ in files:
+                os.remove(f_)
+            os.replace(tmpfile, os.path.join(dirpath, "part-0.parquet"))
+
+    def _write_table_(self, table, basename=None):
+        """ writes the table in the store dataset (one file per partition) """
+        import pyarrow.dataset as ds
+        if basename is None:
+            basename = f"part-{uuid.uuid4().hex}"
+
+        ds.write_dataset(table, self.dirpath, format="parquet", partitioning=self.partitioning,
+                         basename_template=basename+"-{i}.parquet",
+                         existing_data_behavior="overwrite_or_ignore",
+                         min_rows_per_group=min(self.rowgroup_size, len(table)),
+                         max_rows_per_group=self.rowgroup_size)
+
+    # ------- #
+    # GETTER  #
+    # ------- #
+    def get_partitions(self, levels=PARTITION_KEYS):
+        """ existing partitions
+
+        Parameters
+        ----------
+        levels: [list] -optional-
+            first partition levels to consider (e.g. ["filter", "yearmonth"])
+
+        Returns
+        -------
+        list of dict
+        """
+        partitions = [{}]
+        for key in levels:
+            partitions = [{**part_, key: dir_.split("=", 1)[1]}
+                          for part_ in partitions
+                          for dir_ in sorted(os.listdir(self.get_partition_dir(part_)))
+                          if dir_.startswith(f"{key}=")]
+        return partitions
+
+    def get_partition_dir(self, partition):
+        """ directory of the given partition ({key: value}) """
+        return os.path.join(self.dirpath, *[f"{k}={partition[k]}" for k in PARTITION_KEYS
+                                            if k in partition])
+
+    def get_dataset(self):
+        """ pyarrow.dataset.Dataset of the store """
+        import pyarrow.dataset as ds
+        return ds.dataset(self.dirpath, format="parquet", partitioning=self.partitioning,
+                          exclude_invalid_files=True)
+
+    def query(self, columns=None, obsjd_range=None, fieldid=None, rcid=None, gmag_range=None,
+                  filtername=None, ccdid=None, yearmonth=None, filters=None, as_table=False):
+        """ reads the store entries matching the given predicates.
+
+        Predicates and columns are pushed down to the parquet reader: only
+        the matching partitions and row groups and the requested columns are read.
+
+        Parameters
+        ----------
+        columns: [list or None] -optional-
+            columns to read. All if None.
+
+        obsjd_range, fieldid, rcid, gmag_range, filtername, ccdid, yearmonth: -optional-
+            predicates, see get_filters()
+
+        filters: [list or None] -optional-
+            additional DNF filters ([(column, op, value), ...])
+
+        as_table: [bool] -optional-
+            returns the pyarrow.Table rather than a DataFrame indexed by Source.
+
+        Returns
+        -------
+        DataFrame (or pyarrow.Table)
+        """
+        import pyarrow.parquet as pq
+        filters = (get_filters(obsjd_range=obsjd_range, fieldid=fieldid, rcid=rcid,
+                               gmag_range=gmag_range, filtername=filtername, ccdid=ccdid,
+                               yearmonth=yearmonth) or []) + (filters or [])
+        if columns is not None:
+            columns = list(columns) + (["Source"] if "Source" not in columns and not as_table else [])
+
+        table = self.get_dataset().to_table(columns=columns,
+                                            filter=pq.filters_to_expression(filters) if len(filters)>0 else None)
+        if as_table:
+            return table
+
+        data = table.to_pandas().set_index("Source")
+        if "filter" in data.columns:
+            data["filter"] = data["filter"].astype("category")
+        return data
+
+    def to_dask(self, columns=None, **kwargs):
+        """ dask.dataframe of the store entries (kwargs are the query predicates, see get_filters()) """
+        import dask.dataframe as dd
+        return dd.read_parquet(self.dirpath, columns=columns, filters=get_filters(**kwargs),
+                               dataset={"partitioning": self.partitioning})
+
+    # =============== #
+    #  Properties     #
+    # =============== #
+    @property
+    def dirpath(self):
+        """ """
+        return self._dirpath
+
+    @property
+    def rowgroup_size(self):
+        """ """
+        return self._rowgroup_size
+
+    @property
+    def partitioning(self):
+        """ pyarrow hive partitioning of the store """
+        import pyarrow
+        import pyarrow.dataset as ds
+        return ds.partitioning(pyarrow.schema([("filter", pyarrow.string()),
+                                               ("yearmonth", pyarrow.string()),
+                                               ("ccdid", pyarrow.int8())]), flavor="hive")
+
+
+def read_shapes(files, columns=None, query=None):
+    """ psfshape data of the given files (or ShapeStore) with a filefracday column.
+
+    Parameters
+    ----------
+    files: [list of string or ShapeStore]
+        psfshape.parquet files (concatenated) or the ShapeStore to query.
+
+    columns: [list or None] -optional-
+        columns to read.
+
+    query: [dict or None] -optional-
+        // ShapeStore only //
+        predicates of ShapeStore.query()
+
+    Returns
+    -------
+    DataFrame (Source and filefracday as columns)
+    """
+    if isinstance(files, ShapeStore):
+        if columns is not None and np.any([k in STAMP_KEYS for k in columns]):
+            raise ValueError(f"stamps ({STAMP_KEYS}) are not stored in the ShapeStore")
+
+        data = files.query(columns=None if columns is None else ["filefracday"]+list(columns),
+                           **({} if query is None else query)).reset_index()
+        return data[["filefracday"] + [k for k in data.columns if k != "filefracday"]]
+
+    filefracday = [f.split("/")[-1].split("_")[1] for f in files]
+    return pandas.concat([read_psfshape(f, columns=columns) for f in files], keys=filefracday
+                         ).reset_index().rename({"level_0":"filefracday"}, axis=1)
@@ -0,0 +1,359 @@
+""" Stamp cube storage (stars, residual) of the psfshape files.
+
+Stamps are stored next to the {prefix}psfshape.parquet file as an uncompressed
+arrow IPC file ({prefix}psfstamps.arrow) with one fixed-size-list column
+per stamp key and the catalog index (Source). The file is memory mapped:
+only the requested stamps are read.
+
+Stamps could be encoded (see STAMP_ENCODINGS and encode_stamps()), decoding is
+transparent when reading.
+"""
+
+import os
+import numpy as np
+import pandas
+
+STAMP_KEYS = ["stars", "residual"]
+SHAPE_SUFFIX = "psfshape.parquet"
+STAMP_SUFFIX = "psfstamps.arrow"
+STAMP_ENCODINGS = ["float32", "float16", "quantized"]
+
+
+def get_stampstore_filename(filename):
+    """ stamp store filename associated to the given psfshape filename """
+    if filename.endswith(SHAPE_SUFFIX):
+        return filename[:-len(SHAPE_SUFFIX)] + STAMP_SUFFIX
+    return os.path.splitext(filename)[0] + ".arrow"
+
+# =============== #
+#   Encoding      #
+# =============== #
+def encode_stamps(cube, encoding="float32", maxerror=None, shuffle=False):
+    """ encodes a stamp cube for the stamp store.
+
+    Parameters
+    ----------
+    cube: [3d array]
+        (N, ny, nx) stamps
+
+    encoding: [string] -optional-
+        - float32: no encoding.
+        - float16: half precision (~1e-3 relative error), values must be within +-65504.
+        - quantized: scale-and-offset unsigned integer quantization,
+          |decoded - stamp| <= maxerror (up to float32 precision).
+          The integer size (8, 16 or 32 bits) follows the stamp dynamic over maxerror.
+
+    maxerror: [float] -optional-
+        // required for encoding='quantized' //
+        maximum absolute error of the quantization.
+
+    shuffle: [bool] -optional-
+        store the bytes of the stamp values plane by plane (byte-shuffle).
+        This is lossless and makes the stamps more compressible (e.g. zstd).
+
+    Returns
+    -------
+    flat, offsets, meta
+    - flat: (N, m) stored array
+    - offsets: (N,) quantization offsets (None if not quantized)
+    - meta: decoding information (see decode_stamps())
+    """
+    if encoding is None:
+        encoding = "float32"
+    if encoding not in STAMP_ENCODINGS:
+        raise ValueError(f"encoding {encoding} not implemented, {STAMP_ENCODINGS} available")
+
+    cube = np.asarray(cube)
+    flat = cube.reshape(len(cube), -1)
+    meta = {"shape": list(cube.shape[1:]), "encoding": encoding, "shuffle": bool(shuffle)}
+    offsets = None
+    if encoding == "quantized":
+        if maxerror is None or maxerror <= 0:
+            raise ValueError("a strictly positive maxerror is required for the quantized encoding.")
+
+        step = 2.*maxerror
+        isnan = np.isnan(flat)
+        offsets = np.min(np.where(isnan, np.inf, flat), axis=1, initial=np.inf).astype("float64")
+        offsets[~np.isfinite(offsets)] = 0 # all NaN stamps
+        levels = np.round((np.where(isnan, 0, flat) - offsets[:,None]) / step)
+        nanlevel = int(np.max(levels, initial=0))+1 # NaN sentinel
+        dtypes = [dt for dt in ["uint8", "uint16", "uint32"] if nanlevel <= np.iinfo(dt).max]
+        if len(dtypes) == 0:
+            raise ValueError(f"maxerror={maxerror} is too small for the stamp dynamic: "
+                             f"{nanlevel+1} quantization levels would be required "
+                             f"(at most {np.iinfo('uint32').max+1}, i.e. maxerror >= "
+                             f"{maxerror*nanlevel/np.iinfo('uint32').max:.3g})")
+        dtype = dtypes[0]
+        flat = np.where(isnan, nanlevel, levels).astype(dtype)
+        meta = {**meta, "step": step, "nanlevel": nanlevel}
+    else:
+        if encoding == "float16" and np.any(np.abs(flat[np.isfinite(flat)]) > np.finfo("float16").max):
+            raise ValueError(f"stamp values exceed the float16 range (|value| > {np.finfo('float16').max}),"
+                             " use the float32 or quantized encoding.")
+        flat = flat.astype(encoding)
+
+    meta["dtype"] = flat.dtype.str
+    if shuffle:
+        # (N, m, itemsize) bytes -> (N, itemsize, m): byte planes
+        flat = np.ascontiguousarray(flat.view("uint8").reshape(len(flat), -1, flat.dtype.itemsize
+                                                              ).transpose(0, 2, 1)).reshape(len(flat), -1)
+    return flat, offsets, meta
+
+def decode_stamps(flat, meta, offsets=None):
+    """ decodes encode_stamps() outputs
+
+    Parameters
+    ----------
+    flat: [2d array]
+        (N, m) stored stamps
+
+    meta: [dict]
+        decoding information (see encode_stamps())
+
+    offsets: [array or None] -optional-
+        quantization offsets (for quantized encoding)
+
+    Returns
+    -------
+    (N, ny, nx) float32 array
+    """
+    ny, nx = meta["shape"]
+    dtype = np.dtype(meta.get("dtype", "float32"))
+    if meta.get("shuffle", False):
+        flat = np.ascontiguousarray(flat.reshape(len(flat), dtype.itemsize, -1).transpose(0, 2, 1)
+                                    ).view(dtype).reshape(len(flat), -1)
+
+    if meta.get("encoding", "float32") == "quantized":
+        cube = (offsets[:,None] + flat*meta["step"]).astype("float32")
+        cube[flat == meta["nanlevel"]] = np.nan
+    else:
+        cube = flat.astype("float32", copy=False)
+
+    return cube.reshape(len(flat), ny, nx)
+
+# =============== #
+#   I/O           #
+# =============== #
+def write_stamps(filename, stamps, index, index_name="Source", encoding=None, maxerror=None,
+                     shuffle=False, compression="uncompressed"):
+    """ stores the stamp cubes as a stamp store file.
+
+    Parameters
+    ----------
+    filename: [string]
+        stamp store file (see get_stampstore_filename())
+
+    stamps: [dict]
+        {key: (N, ny, nx) stamp cube or list of N stamps}
+
+    index: [array]
+        catalog index (e.g. gaia Source id) of the N stamps.
+
+    index_name: [string] -optional-
+        name of the index column.
+
+    encoding, maxerror, shuffle: [string, float, bool or dict] -optional-
+        stamp encoding (see encode_stamps()), could be given per key as dict.
+
+    compression: [string] -optional-
+        arrow file compression (uncompressed, lz4 or zstd).
+        = compressed files are decompressed when read, not memory mapped =
+
+    Returns
+    -------
+    None
+    """
+    import json
+    import pyarrow
+    from pyarrow import feather
+    def _get_keyvalue_(value, key):
+        return value.get(key) if type(value) is dict else value
+
+    columns, encodings = {index_name: pyarrow.array(np.asarray(index))}, {}
+    for key, cube in stamps.items():
+        cube = np.asarray(cube, dtype="float32")
+        if cube.ndim == 2: # raveled square stamps
+            size = int(np.sqrt(cube.shape[1]))
+            cube = cube.reshape(len(cube), size, size)
+
+        flat, offsets, encodings[key] = encode_stamps(cube, encoding=_get_keyvalue_(encoding, key),
+                                                     maxerror=_get_keyvalue_(maxerror, key),
+                                                     shuffle=_get_keyvalue_(shuffle, key))
+        columns[key] = pyarrow.FixedSizeListArray.from_arrays(flat.ravel(), flat.shape[1])
+        if offsets is not None:
+            columns[f"{key}_offset"] = pyarrow.array(offsets)
+
+    table = pyarrow.table(columns)
+    meta = {"index": index_name, "shapes": {k: v["shape"] for k, v in encodings.items()},
+            "encodings": encodings}
+    table = table.replace_schema_metadata({b"ziff": json.dumps(meta).encode()})
+    feather.write_feather(table, filename, compression=compression)
+
+def read_stamps(filename, key, sources=None):
+    """ shortcut to StampStore(filename).get_stamps(key, sources=sources) """
+    return StampStore(filename).get_stamps(key, sources=sources)
+
+def read_psfshape(filename, columns=None):
+    """ reads a psfshape.parquet file (pandas.read_parquet).
+    Requested stamp columns (stars, residual) missing from the parquet file
+    are read from the associated stamp store (as a column of raveled stamps).
+    """
+    import pyarrow.parquet as pq
+    container = None
+    if not os.path.isfile(filename):
+        # compacted quadrant outputs (see ziff.container)
+        from .container import get_file_container
+        container = get_file_container(filename)
+
+    if columns is None:
+        return pandas.read_parquet(filename) if container is None else container.read_table(filename)
+
+    stored = pq.read_schema(filename).names if container is None else container.get_columns(filename)
+    stampkeys = [k for k in columns if k in STAMP_KEYS and k not in stored]
+    tablecolumns = [k for k in columns if k not in stampkeys]
+    data = pandas.read_parquet(filename, columns=tablecolumns) if container is None else \
+      container.read_table(filename, columns=tablecolumns)
+    if len(stampkeys)>0:
+        store = StampStore(get_stampstore_filename(filename))
+        for key in stampkeys:
+            cube = store.get_stamps(key, sources=data.index)
+            data[key] = list(cube.reshape(len(cube), -1))
+
+    return data[columns]
+
+def fetch_psfshape_stamps(filename, key, sources=None):
+    """ stamp cube of the given psfshape file, from its stamp store
+    or, if there is none, from the (former) parquet stamp column.
+
+    Returns
+    -------
+    (N, ny, nx) array
+    """
+    storefile = get_stampstore_filename(filename)
+    if os.path.isfile(storefile):
+        return read_stamps(storefile, key, sources=sources)
+
+    data = pandas.read_parquet(filename, columns=[key])[key]
+    if sources is not None:
+        data = data.loc[sources]
+    flat = np.stack(data.values) if len(data)>0 else np.zeros((0, 0))
+    size = int(np.sqrt(flat.shape[1]))
+    return flat.reshape(len(flat), size, size)
+
+
+class StampStore( object ):
+    """ memory mapped stamp store (see write_stamps) """
+    def __init__(self, filename):
+        """ """
+        self._filename = filename
+
+    # ================ #
+    #   Methods        #
+    # ================ #
+    def load(self):
+        """ opens (memory maps) the file """
+        import json
+        import pyarrow
+        self._table = pyarrow.ipc.open_file(pyarrow.memory_map(self._filename, "r")).read_all()
+        self._meta = json.loads(self._table.schema.metadata[b"ziff"])
+
+    def get_rows(self, sources):
+        """ row numbers of the given sources (catalog index) """
+        rows = self.index.get_indexer(np.atleast_1d(sources))
+        if np.any(rows<0):
+            raise KeyError(f"{np.sum(rows<0)} sources not in the stamp store {self._filename}")
+        return rows
+
+    def get_stamps(self, key, sources=None, rows=None):
+        """ stamp cube of the given key (decoded, see get_stamp_encoding()).
+
+        Parameters
+        ----------
+        key: [string]
+            stamp key (e.g. stars or residual)
+
+        sources: [list or None] -optional-
+            catalog index of the requested stamps.
+
+        rows: [list or None] -optional-
+            row numbers of the requested stamps. (ignored if sources is given)
+            all the stamps if sources and rows are None.
+
+        Returns
+        -------
+        (N, ny, nx) float32 array
+        (read-only and memory mapped if all the stamps of a not-encoded key are requested)
+        """
+        if key not in self.keys:
+            raise ValueError(f"{key} is not a stamp key of the store ({self.keys})")
+
+        if sources is not None:
+            rows = self.get_rows(sources)
+
+        encoding = self.get_stamp_encoding(key)
+        flat = self._get_flatstamps_(key)
+        offsets = self.table.column(f"{key}_offset").to_numpy() \
+          if encoding["encoding"] == "quantized" else None
+        if rows is not None:
+            rows = np.asarray(rows, dtype="int")
+            flat = flat[rows]
+            offsets = offsets[rows] if offsets is not None else None
+
+        return decode_stamps(flat, encoding, offsets=offsets)
+
+    def get_stamp_shape(self, key):
+        """ (ny, nx) of the key stamps """
+        return tuple(self.meta["shapes"][key])
+
+    def get_stamp_encoding(self, key):
+        """ encoding information of the key stamps (see encode_stamps()) """
+        return self.meta.get("encodings", {}).get(key, {"shape": self.meta["shapes"][key],
+                                                        "encoding": "float32"})
+
+    def _get_flatstamps_(self, key):
+        """ (N, m) zero-copy view of the stored (encoded) stamps """
+        column = self.table.column(key)
+        column = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+        size = column.type.list_size
+        values = column.values.slice(column.offset*size, len(column)*size)
+        return values.to_numpy(zero_copy_only=True).reshape(len(column), size)
+
+    # ================ #
+    #   Properties     #
+    # ================ #
+    @property
+    def filename(self):
+        """ """
+        return self._filename
+
+    @property
+    def table(self):
+        """ memory mapped pyarrow.Table """
+        if not hasattr(self, "_table"):
+            self.load()
+        return self._table
+
+    @property
+    def meta(self):
+        """ store metadata (index name, stamp shapes and encodings) """
+        if not hasattr(self, "_meta"):
+            self.load()
+        return self._meta
+
+    @property
+    def index(self):
+        """ catalog index of the stamps """
+        if not hasattr(self, "_index"):
+            self._index = pandas.Index(self.table.column(self.meta["index"]).to_numpy(),
+                                       name=self.meta["index"])
+        return self._index
+
+    @property
+    def keys(self):
+        """ stored stamp keys """
+        return list(self.meta["shapes"].keys())
+
+    @property
+    def nstamps(self):
+        """ number of stored stamps (per key) """
+        return self.table.num_rows
@@ -2,6 +2,8 @@
 import numpy as np
 import pandas 
 
+STAR_INDEX_KEY = "catindex" # star property storing the catalog index (e.g. gaia Source id)
+
 def get_star_psfmodel(star, psf, asarray=False, modeldraw=False, basemodel=False, fit_center=True):
     """ 
     
@@ -40,6 +42,476 @@ def stars_to_array(star, origin="image"):
     """ """
     return np.asarray([getattr(star_, origin).array for star_ in np.atleast_1d(star)])
 
+def get_stars_hsm(stars, engine="numpy", **kwargs):
+    """ equivalent of [star.hsm for star in stars] with a vectorized moments engine.
+
+    Parameters
+    ----------
+    stars: [list of piff.Star]
+        stars to measure.
+
+    engine: [string] -optional-
+        moments engine (see moments.get_moments()).
+        - numpy: all the stamps are measured at once.
+        - hsm: piff's star.hsm (galsim HSM star by star)
+
+    **kwargs goes to moments.get_moments()
+
+    Returns
+    -------
+    2d array (N, 7): flux, center_u, center_v, sigma, g1, g2, flag
+    (NaN measurements for failed fits, flag != 0, whatever the engine)
+    """
+    from .moments import get_moments, moments_to_world
+    stars = np.atleast_1d(stars)
+    if engine == "hsm":
+        hsm = np.asarray([s_.hsm for s_ in stars], dtype="float").reshape(len(stars), 7)
+        hsm[hsm[:,6] != 0, :6] = np.nan # failed fits, as moments.get_moments()
+        return hsm
+
+    hsm = np.full((len(stars), 7), np.nan)
+    shapes = np.asarray([s_.image.array.shape for s_ in stars]).reshape(len(stars), 2)
+    for shape_ in np.unique(shapes, axis=0):
+        index = np.flatnonzero(np.all(shapes == shape_, axis=1))
+        stars_ = stars[index]
+        moments = get_moments([s_.image.array for s_ in stars_],
+                              weights=[s_.weight.array for s_ in stars_],
+                              engine=engine, **kwargs)
+        jacobian = np.asarray([s_.data.local_wcs.jacobian().getMatrix() for s_ in stars_])
+        # centroid offset from the star position, in pixels.
+        dx = np.asarray([s_.image.bounds.xmin - s_.image_pos.x for s_ in stars_]) + moments["x"]
+        dy = np.asarray([s_.image.bounds.ymin - s_.image_pos.y for s_ in stars_]) + moments["y"]
+        sigma, g1, g2 = moments_to_world(moments, jacobian)
+        hsm[index] = np.asarray([moments["amp"],
+                                 jacobian[:,0,0]*dx + jacobian[:,0,1]*dy,
+                                 jacobian[:,1,0]*dx + jacobian[:,1,1]*dy,
+                                 sigma, g1, g2, moments["flag"]]).T
+    return hsm
+
+# ============== #
+#                #
+#  PIFF STARS    #
+#                #
+# ============== #
+def get_stars_index(stars, key=STAR_INDEX_KEY):
+    """ catalog index of the stars (see build_piffstars(index=)).
+    Returns None if any star has no such property (e.g. stars from piff's makeStars)
+    """
+    if len(stars)==0 or not all(key in s_.data.properties for s_ in stars):
+        return None
+    return np.asarray([s_.data.properties[key] for s_ in stars])
+
+def get_header_value(value, header, dtype=float):
+    """ returns dtype(value) or, if this fails, dtype(header[value]).
+    This mimics how piff parses its i/o config entries (e.g. gain: 'GAIN').
+    """
+    if value is None:
+        return None
+    try:
+        return dtype(value)
+    except ValueError:
+        if value not in header:
+            raise KeyError(f"Key {value} not found in the header")
+        return dtype(header[value])
+
+def get_piff_wcs(header):
+    """ get the galsim wcs as piff does when reading the image file.
+    (the image origin, (1,1) for fits images, is that of build_piffstars(origin=None))
+
+    Returns
+    -------
+    galsim.wcs
+    """
+    import galsim
+    return galsim.wcs.readFromFitsHeader(header)[0]
+
+def get_piff_pointing(header, ra="RA", dec="DEC"):
+    """ get the pointing as piff.InputFiles.setPointing(ra, dec) does,
+    but from the given header.
+
+    Parameters
+    ----------
+    header: [fits.Header]
+        image header.
+
+    ra, dec: [string or float]
+        header keys (or values, float in hours and degree or 'hh:mm:ss', 'dd:mm:ss')
+
+    Returns
+    -------
+    galsim.CelestialCoord
+    """
+    import galsim
+    if type(ra) in [float, int]:
+        return galsim.CelestialCoord(float(ra) * galsim.hours, float(dec) * galsim.degrees)
+
+    if ':' in ra and ':' in dec:
+        return galsim.CelestialCoord(galsim.Angle.from_hms(ra), galsim.Angle.from_dms(dec))
+
+    for key in [ra, dec]:
+        if key not in header:
+            raise KeyError(f"Key {key} not found in the header")
+
+    return get_piff_pointing(header, ra=header[ra], dec=header[dec])
+
+def build_piffstars(image, xpos, ypos, wcs, stamp_size, chipnum=0, pointing=None,
+                        sky=None, gain=None, satur=None, noise=None, weight=None,
+                        nstars=None, min_snr=None, max_snr=100, origin=None,
+                        max_mask_pixels=None, max_edge_frac=None, stamp_center_size=13,
+                        index=None, logger=None):
+    """ build piff.Star directly from an image array and star positions.
+
+    This follows piff.InputFiles.makeStars() but without any file I/O.
+
+    Parameters
+    ----------
+    image: [2d-array]
+        image data (as stored in the sciimg, i.e. no background subtraction nor masking)
+        Only the star stamps are read, so this could be a memory-mapped array
+        or a lazy array (see ziff.lazyimage.LazyFitsArray).
+
+    xpos, ypos: [array]
+        star positions in the image (fits/fortran convention, see origin)
+
+    wcs: [galsim.wcs]
+        wcs solution of the image (see get_piff_wcs())
+
+    stamp_size: [int]
+        size of the star stamps.
+
+    chipnum: [int] -optional-
+        chip number stored in the star properties.
+
+    pointing: [galsim.CelestialCoord] -optional-
+        telescope pointing (see get_piff_pointing())
+
+    sky, gain: [float or array or None] -optional-
+        sky level and gain of the stars (per star if array).
+        sky is subtracted from the stamps, the gain is used to add poisson noise to the weight.
+
+    satur: [float or None] -optional-
+        stars with any stamp pixel above this value are discarded.
+
+    noise, weight: [float / 2d-array or None] -optional-
+        weight image (same shape as image) or, if None, uniform weight of 1/noise (or 1).
+
+    nstars: [int or None] -optional-
+        only the first nstars entries are used.
+
+    min_snr, max_snr: [float or None] -optional-
+        snr limits as in piff's i/o config.
+
+    origin: [galsim.PositionI or None] -optional-
+        position of image[0,0]. If None, (1,1) as for a fits file.
+
+    max_mask_pixels, max_edge_frac, stamp_center_size: [int, float, float] -optional-
+        stamp masking and edge flux cuts as in piff's i/o config.
+
+    index: [array or None] -optional-
+        catalog index of the stars (e.g. gaia Source id), stored as the 
+        STAR_INDEX_KEY star property (see get_stars_index())
+
+    Returns
+    -------
+    list of piff.Star
+    """
+    import galsim
+    from piff.star import Star, StarData
+    from piff.util import calculateSNR
+    logger = galsim.config.LoggerWrapper(logger)
+
+    if origin is None:
+        origin = galsim.PositionI(1, 1)
+
+    ny, nx = np.shape(image)
+    image_bounds = galsim.BoundsI(origin.x, origin.x+nx-1, origin.y, origin.y+ny-1)
+    def _get_stamp_(array, bounds):
+        """ float32 galsim image of the array within bounds (only this part is read) """
+        return galsim.ImageF(np.array(array[bounds.ymin-origin.y:bounds.ymax-origin.y+1,
+                                            bounds.xmin-origin.x:bounds.xmax-origin.x+1],
+                                      dtype="float32"),
+                             xmin=bounds.xmin, ymin=bounds.ymin)
+
+    xpos, ypos = np.asarray(xpos, dtype="float"), np.asarray(ypos, dtype="float")
+    sky  = np.broadcast_to(sky, len(xpos)) if sky is not None else None
+    gain = np.broadcast_to(gain, len(xpos)) if gain is not None else [None]*len(xpos)
+    index = np.asarray(index) if index is not None else None
+    if nstars is not None and nstars < len(xpos):
+        xpos, ypos, gain = xpos[:nstars], ypos[:nstars], gain[:nstars]
+        sky = sky[:nstars] if sky is not None else None
+        index = index[:nstars] if index is not None else None
+
+    if max_edge_frac is not None:
+        cen = (stamp_size-1.)/2.
+        i_, j_ = np.ogrid[0:stamp_size,0:stamp_size]
+        edge_mask = (i_-cen)**2 + (j_-cen)**2 > stamp_center_size**2
+
+    half_size = stamp_size // 2
+    big_bounds = image_bounds.expand(stamp_size)
+
+    stars = []
+    for k, (x, y) in enumerate(zip(xpos, ypos)):
+        if not big_bounds.includes(galsim.PositionD(x, y)):
+            continue
+
+        icen, jcen = int(x+0.5), int(y+0.5)
+        bounds = galsim.BoundsI(icen+half_size-stamp_size+1, icen+half_size,
+                                jcen+half_size-stamp_size+1, jcen+half_size)
+        if not image_bounds.includes(bounds):
+            logger.warning("Star at position %f,%f overlaps the edge of the image. Skipped.", x, y)
+            continue
+
+        stamp    = _get_stamp_(image, bounds)
+        stamp.wcs = wcs
+        wt_stamp = _get_stamp_(weight, bounds) if weight is not None else \
+          galsim.ImageF(bounds, init_value=1./noise if noise is not None else 1)
+        props    = {'chipnum': chipnum, 'gain': gain[k]}
+        if index is not None:
+            props[STAR_INDEX_KEY] = index[k]
+        if np.all(wt_stamp.array == 0):
+            logger.warning("Star at position %f,%f is completely masked. Skipped.", x, y)
+            continue
+
+        if satur is not None and np.max(stamp.array) > satur:
+            logger.warning("Star at position %f,%f has saturated pixels. Skipped.", x, y)
+            continue
+
+        if max_mask_pixels is not None and np.sum(wt_stamp.array == 0) >= max_mask_pixels:
+            logger.warning("Star at position %f,%f has too many masked pixels. Skipped.", x, y)
+            continue
+
+        if sky is not None:
+            stamp -= sky[k]
+            props['sky'] = sky[k]
+
+        snr = calculateSNR(stamp, wt_stamp)
+        if min_snr is not None and snr < min_snr:
+            continue
+        if max_snr is not None and max_snr > 0 and snr > max_snr:
+            wt_stamp *= (max_snr / snr)**2
+            snr = max_snr
+        props['snr'] = snr
+
+        star = Star(StarData(stamp, galsim.PositionD(x, y), weight=wt_stamp,
+                             pointing=pointing, properties=props), None)
+        if gain[k] is not None:
+            star = star.addPoisson(gain=gain[k])
+
+        if max_edge_frac is not None and max_edge_frac < 1 and \
+          np.sum(star.image.array[edge_mask]) / np.sum(star.image.array) > max_edge_frac:
+            logger.warning("Star at position %f,%f has too much flux near the stamp edge. Skipped.", x, y)
+            continue
+
+        stars.append(star)
+
+    return stars
+
+# ============== #
+#                #
+#  BATCH PSF     #
+#                #
+# ============== #
+def get_field_positions(wcs, x, y, pointing=None):
+    """ vectorized version of piff.StarData.calculateFieldPos() and of wcs.local().
+
+    Parameters
+    ----------
+    wcs: [galsim.wcs]
+        wcs of the chip (psf.wcs[chipnum])
+
+    x, y: [array]
+        image (fortran) positions
+
+    pointing: [galsim.CelestialCoord or None]
+        pointing of the exposure, required for celestial wcs.
+
+    Returns
+    -------
+    u, v, jacobian
+    (u, v in arcsec, jacobian (N,2,2) [[dudx, dudy],[dvdx, dvdy]] in arcsec/pixel)
+    """
+    import galsim
+    x = np.asarray(x, dtype=float) - wcs.x0
+    y = np.asarray(y, dtype=float) - wcs.y0
+    # position, x+1, x-1, y+1, y-1 (dx=dy=1 as galsim's wcs.local())
+    xlist = np.stack([x, x+1, x-1, x, x])
+    ylist = np.stack([y, y, y, y+1, y-1])
+    if wcs.isCelestial():
+        if pointing is None:
+            raise ValueError("If the wcs is celestial then pointing is required.")
+
+        ra, dec = wcs._radec(xlist.ravel(), ylist.ravel())
+        ra, dec = ra.reshape(xlist.shape), dec.reshape(xlist.shape)
+        u, v = pointing.project_rad(ra[0], dec[0])
+        # Wrap ra to be near ra[0]
+        ra[ra < ra[0]-np.pi] += 2*np.pi
+        ra[ra > ra[0]+np.pi] -= 2*np.pi
+        factor = galsim.radians / galsim.arcsec
+        cosdec = np.cos(dec[0])
+        jacobian = np.asarray([[-0.5*(ra[1]-ra[2])*cosdec, -0.5*(ra[3]-ra[4])*cosdec],
+                               [0.5*(dec[1]-dec[2]), 0.5*(dec[3]-dec[4])]]) * factor
+        u, v = u*factor, v*factor
+    else:
+        ulist = wcs._u(xlist, ylist)
+        vlist = wcs._v(xlist, ylist)
+        u, v = ulist[0], vlist[0]
+        jacobian = np.asarray([[0.5*(ulist[1]-ulist[2]), 0.5*(ulist[3]-ulist[4])],
+                               [0.5*(vlist[1]-vlist[2]), 0.5*(vlist[3]-vlist[4])]])
+
+    return u, v, np.moveaxis(jacobian, -1, 0)
+
+def get_interp_params(interp, properties):
+    """ vectorized version of the piff.BasisPolynomial.interpolate().
+    Evaluates the interpolated model parameters for all positions with a single matrix product.
+
+    Parameters
+    ----------
+    interp: [piff.BasisPolynomial]
+        the (solved) psf interpolator.
+
+    properties: [dict]
+        arrays of the interp keys (e.g. {"u":u_array, "v":v_array})
+
+    Returns
+    -------
+    2d array (N, nparams)
+    """
+    from piff import BasisPolynomial
+    if not isinstance(interp, BasisPolynomial):
+        raise NotImplementedError(f"Only BasisPolynomial interpolation implemented, {type(interp)} given")
+    if interp.q is None:
+        raise ValueError("The interpolator has not been solved (q is None)")
+
+    vals = [np.atleast_1d(np.asarray(properties[k], dtype=float)) for k in interp._keys]
+    pows = np.ones((len(vals[0]),) + (1,)*len(vals))
+    for i, (vals_, order_) in enumerate(zip(vals, interp._orders)):
+        pows1d = np.cumprod(np.column_stack([np.ones_like(vals_)] + [vals_]*order_), axis=1)
+        shape = [len(vals_)] + [1]*len(vals)
+        shape[i+1] = order_+1
+        pows = pows * pows1d.reshape(shape)
+
+    basis = pows[:, interp._mask] # (N, nbasis)
+    return basis.dot(interp.q.T)
+
+def draw_pixelgrid(model, params, du, dv, flux=1., pixel_area=1.):
+    """ vectorized rendering of a piff.PixelGrid model.
+    This is the model the PixelGrid fits the stars with (see PixelGrid.chisq()):
+    the lanczos interpolation of the pixel grid, integrated over the pixel area.
+
+    Parameters
+    ----------
+    model: [piff.PixelGrid]
+        the psf model.
+
+    params: [2d array]
+        (N, nparams) normalized grid parameters (see get_interp_params())
+
+    du, dv: [2d array]
+        (N, npix) field offsets [arcsec] of the pixel centers from the psf center.
+
+    flux, pixel_area: [float or array]
+        flux of the psf and area [arcsec**2] of the pixels.
+
+    Returns
+    -------
+    2d array (N, npix)
+    """
+    nstars, npix = np.shape(du)
+    n = int(np.ceil(model.interp.xrange))
+    _duv = np.arange(-n, n, dtype=int)
+    grid = np.reshape(params[:, :model.size**2], (nstars, model.size, model.size))
+
+    def _get_kernel_(uv, origin):
+        """ dense (nstars, npix, size) kernel matrix, zero outside of the lanczos footprint """
+        uv_ceil = np.ceil(uv).astype(int)
+        kernel = model._kernel1d( ((uv_ceil-uv)[...,None] + _duv).reshape(-1, 2*n) )
+        # one extra column on each side, out-of-grid references are clipped there.
+        index = np.clip(uv_ceil[...,None] + _duv + origin + 1, 0, model.size+1)
+        dense = np.zeros((nstars, npix, model.size+2))
+        np.put_along_axis(dense, index, kernel.reshape(nstars, npix, 2*n), axis=-1)
+        return dense[...,1:-1]
+
+    ku = _get_kernel_(np.asarray(du, dtype=float)/model.scale, model._origin[1])
+    kv = _get_kernel_(np.asarray(dv, dtype=float)/model.scale, model._origin[0])
+    # sum_{y,x} kv[y] grid[y,x] ku[x] for every pixel as a batched matrix product.
+    mod = np.sum(np.matmul(kv, grid) * ku, axis=-1)
+    return mod * np.reshape(np.asarray(flux)*pixel_area, (-1, 1))
+
+def draw_psf_batch(psf, x, y, stamp_size, chipnum=0, flux=1.0, offset=(0, 0),
+                   chunksize=256, dtype="float32", **kwargs):
+    """ batched version of psf.draw() for a piff.SimplePSF with a PixelGrid
+    (or ConvolvedPixelGrid) model and a BasisPolynomial interpolation.
+
+    Parameters
+    ----------
+    psf: [piff.SimplePSF]
+        the psf
+
+    x, y: [array]
+        image (fortran) positions of the psf centers.
+
+    stamp_size: [int]
+        size of the returned stamps.
+
+    chipnum: [int] -optional-
+        chip number (psf.wcs key) of the positions.
+
+    flux: [float or array] -optional-
+        flux of the psfs
+
+    offset: [(float, float)] -optional-
+        additional offset of the psf centers (in pixels)
+
+    chunksize: [int] -optional-
+        number of psf rendered at once (memory control).
+
+    **kwargs goes to the interpolation properties (i.e. extra_interp_properties)
+
+    Returns
+    -------
+    3d array (N, stamp_size, stamp_size)
+    """
+    from piff import PixelGrid
+    from .psfbundle import BUNDLE_MODELS, convolve_grids
+    modelname = type(psf.model).__name__
+    if not isinstance(psf.model, PixelGrid) or modelname not in BUNDLE_MODELS:
+        raise NotImplementedError(f"Only {BUNDLE_MODELS} models implemented, {modelname} given")
+    size = psf.model.size
+
+    x, y = np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+    flux = np.broadcast_to(np.asarray(flux, dtype=float), x.shape)
+    u, v, jacobian = get_field_positions(psf.wcs[chipnum], x, y, pointing=psf.pointing)
+    properties = {**{"u":u, "v":v, "chipnum":np.full(len(x), chipnum)},
+                  **{k:np.broadcast_to(v_, x.shape) for k,v_ in kwargs.items()}}
+
+    # stamps as built by piff.Star.makeTarget()
+    halfsize = 0.5 if stamp_size % 2 == 1 else 0
+    xmin = np.ceil(x - halfsize).astype(int) - stamp_size//2
+    ymin = np.ceil(y - halfsize).astype(int) - stamp_size//2
+    pix = np.arange(stamp_size)
+
+    cube = np.empty((len(x), stamp_size, stamp_size), dtype=dtype)
+    for start in range(0, len(x), chunksize):
+        sl = slice(start, start+chunksize)
+        params = get_interp_params(psf.interp, {k:v_[sl] for k,v_ in properties.items()})
+        grids = params[:, :size**2] # model.normalize()
+        grids /= np.sum(grids, axis=1)[:,None] * psf.model.pixel_area
+        if modelname == "ConvolvedPixelGrid": # model.get_pixelparams()
+            grids = convolve_grids(grids.reshape(-1, size, size), params[:, -1]).reshape(-1, size**2)
+
+        dx = (xmin[sl,None,None] + pix[None,None,:]) - (x[sl]+offset[0])[:,None,None]
+        dy = (ymin[sl,None,None] + pix[None,:,None]) - (y[sl]+offset[1])[:,None,None]
+        jac = jacobian[sl]
+        du = jac[:,0,0,None,None]*dx + jac[:,0,1,None,None]*dy
+        dv = jac[:,1,0,None,None]*dx + jac[:,1,1,None,None]*dy
+        pixel_area = np.abs(np.linalg.det(jac))
+
+        cube[sl] = draw_pixelgrid(psf.model, grids,
+                                  du.reshape(len(params), -1), dv.reshape(len(params), -1),
+                                  flux=flux[sl], pixel_area=pixel_area
+                                  ).reshape(len(grids), stamp_size, stamp_size)
+    return cube
+
 
 def show_psfmodeling(star, modelstar, axes=None, title="", tight_layout=True, **kwargs):
     """ """
@@ -119,8 +591,27 @@ class StarCollection( object ):
         self._psfmodelarray = stars_to_array(self.psfmodel, origin="image")
 
     def measure_shapes(self, which=["stars","psfmodel"], normalisation="nanmedian",
-                           nopsf=False):
-        """ """
+                           nopsf=False, engine="numpy"):
+        """ measure the adaptive moments of the stars and/or of the psf models.
+
+        Parameters
+        ----------
+        which: [string or list of] -optional-
+            stars and/or psfmodel
+
+        normalisation: [string] -optional-
+            numpy function used to normalise the sigma (sigma_normalized)
+
+        nopsf: [bool] -optional-
+            if True, the psfmodel shapes are set to NaN.
+
+        engine: [string] -optional-
+            moments engine (see get_stars_hsm()): numpy (vectorized) or hsm (galsim)
+
+        Returns
+        -------
+        None (see self.shapes)
+        """
         for which in np.atleast_1d(which):
             shapes = {'flux': [], 'sigma': [], 
                       'shape_g1': [], 'shape_g2': [],
@@ -134,28 +625,24 @@ class StarCollection( object ):
                 shapes['sigma_normalized'] = shapes['sigma'].copy() # NaNs
                 
             else:
-                for s_ in getattr(self, which):
-                    flux, center_x, center_y, sigma, shape_g1, shape_g2, flag = s_.hsm
-                
-                    shapes['flux'].append(flux)
-                    #
-                    shapes['sigma'].append(sigma)
-                    #
-                    shapes['shape_g1'].append(shape_g1)
-                    shapes['shape_g2'].append(shape_g2)
-                    shapes['u'].append(s_.u)
-                    shapes['v'].append(s_.v)
-                    shapes['x'].append(s_.x)
-                    shapes['y'].append(s_.y)
-                    #
-                    shapes['center_x'].append(center_x)
-                    shapes['center_y'].append(center_y)
-                    shapes['center_u'].append(s_.center[0])
-                    shapes['center_v'].append(s_.center[1])
-                    #
-                    shapes['flagout'].append(flag)
-
-                shapes['flagout'] = np.asarray(shapes['flagout'], dtype="bool")
+                stars_ = getattr(self, which)
+                flux, center_x, center_y, sigma, shape_g1, shape_g2, flag = \
+                  get_stars_hsm(stars_, engine=engine).T
+                shapes['flux'] = flux
+                #
+                shapes['sigma'] = sigma
+                #
+                shapes['shape_g1'] = shape_g1
+                shapes['shape_g2'] = shape_g2
+                shapes['u'], shapes['v'], shapes['x'], shapes['y'] = \
+                  np.asarray([[s_.u, s_.v, s_.x, s_.y] for s_ in stars_]).reshape(-1, 4).T
+                #
+                shapes['center_x'] = center_x
+                shapes['center_y'] = center_y
+                shapes['center_u'], shapes['center_v'] = \
+                  np.asarray([s_.center for s_ in stars_]).reshape(-1, 2).T
+                #
+                shapes['flagout'] = np.asarray(flag, dtype="bool")
                 shapes['sigma']   = np.asarray(shapes['sigma'], dtype="float")
                 shapes['sigma_normalized'] = shapes['sigma']/ getattr(np,normalisation)(shapes['sigma'][~shapes['flagout']])
             
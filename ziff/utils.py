@@ -45,3 +45,99 @@ def vminvmax_parser(data_, vmin, vmax):
         vmax = np.percentile(data_, float(vmax))
         
     return vmin, vmax
+
+# ================== #
+#  Stamp statistics  #
+# ================== #
+STAMP_STATISTICS = ["sum", "nansum", "mean", "nanmean", "count", "any", "nfinite"]
+
+def get_integral_image(array):
+    """ summed-area table of array, with a leading row and column of zeros:
+    sum(array[y0:y1, x0:x1]) = S[y1,x1] - S[y0,x1] - S[y1,x0] + S[y0,x0]
+    """
+    table = np.zeros((np.shape(array)[0]+1, np.shape(array)[1]+1), dtype="float64")
+    table[1:,1:] = array
+    # in place, contiguous cumsums
+    table.cumsum(axis=1, out=table)
+    table.cumsum(axis=0, out=table)
+    return table
+
+def get_stamp_bounds(shape, x0, y0, dx, dy=None):
+    """ pixel bounds of the stamps, as ztfimg.stamps.stamp_it() cuts them.
+
+    Returns
+    -------
+    xmin, xmax, ymin, ymax (slices [ymin:ymax, xmin:xmax]), flagout (stamps out of the array)
+    """
+    if dy is None:
+        dy = dx
+    x0, y0 = np.asarray(x0, dtype="float"), np.asarray(y0, dtype="float")
+    flagout = (x0-dx/2+0.5<0) | (y0-dy/2+0.5<0) | \
+              (y0+dy/2+0.5>shape[0]) | (x0+dx/2+0.5>shape[1])
+    xmin, xmax = np.round(x0-dx/2+0.5), np.round(x0+dx/2+0.5)
+    ymin, ymax = np.round(y0-dy/2+0.5), np.round(y0+dy/2+0.5)
+    bounds = [np.clip(np.where(flagout, 0, b_), 0, None).astype("int")
+                  for b_ in [xmin, xmax, ymin, ymax]]
+    return (*bounds, flagout)
+
+def get_stamp_statistics(array, x0, y0, dx, dy=None, statistic="sum"):
+    """ per stamp reduction of array without building the stamp cube,
+    using summed-area tables (O(1) per stamp).
+
+    Stamps are the ztfimg.stamps.stamp_it() ones. Stamps (partially) outside the
+    array are NaN (True for 'any') as their stamp_it() stamp is full of NaN.
+
+    Parameters
+    ----------
+    array: [2d array]
+        image
+
+    x0, y0: [1d array]
+        stamp centers (numpy format)
+
+    dx, dy: [int]
+        stamp size (dy=dx if None)
+
+    statistic: [string] -optional-
+        - sum, mean: (NaN if any non-finite pixel)
+        - nansum, nanmean: ignoring non-finite pixels
+        - count: number of non-zero pixels
+        - any: any non-zero pixel
+        - nfinite: number of finite pixels
+
+    Returns
+    -------
+    1d array
+    """
+    if statistic not in STAMP_STATISTICS:
+        raise NotImplementedError(f"statistic {statistic} not implemented, {STAMP_STATISTICS} available")
+
+    array = np.asarray(array)
+    xmin, xmax, ymin, ymax, flagout = get_stamp_bounds(array.shape, x0, y0, dx, dy=dy)
+    def _boxsum_(table):
+        return table[ymax, xmax] - table[ymin, xmax] - table[ymax, xmin] + table[ymin, xmin]
+
+    if statistic in ["count", "any"]:
+        count = _boxsum_(get_integral_image(array != 0))
+        return np.where(flagout, True, count>0) if statistic == "any" \
+          else np.where(flagout, np.nan, count)
+
+    isfinite = np.isfinite(array)
+    npix = (xmax-xmin)*(ymax-ymin)
+    allfinite = np.all(isfinite)
+    nfinite = npix if allfinite else _boxsum_(get_integral_image(isfinite))
+    if statistic == "nfinite":
+        return np.where(flagout, np.nan, nfinite)
+
+    total = _boxsum_(get_integral_image(array if allfinite else np.where(isfinite, array, 0)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if statistic == "sum":
+            values = np.where(nfinite == npix, total, np.nan)
+        elif statistic == "nansum":
+            values = total
+        elif statistic == "mean":
+            values = np.where(nfinite == npix, total/npix, np.nan)
+        else: # nanmean
+            values = total/nfinite
+
+    return np.where(flagout, np.nan, values)